@@ -0,0 +1,288 @@
+"""
+End-to-end benchmark of the Twitcher WSGI application.
+
+Fake WPS and WMS backends serve the capabilities documents in ``tests/resources``, GetMap images
+of ``--payload-size`` bytes and Execute responses. Twitcher runs with waitress and the memory store
+in its own process, with both services registered and a local access token. Every scenario is driven
+by ``--concurrency`` client processes for ``--duration`` seconds and reports the requests per second
+and the p50/p95/p99 latency. The peak RSS of the Twitcher process is reported at the end.
+
+The results are saved as JSON in ``--output-dir`` and can be compared with an earlier run::
+
+    $ python benchmarks/bench_e2e.py
+    $ python benchmarks/bench_e2e.py --compare benchmarks/results/20190601-120000.json
+"""
+
+import os
+import json
+import math
+import time
+import socket
+import argparse
+import datetime
+import subprocess
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESOURCES = os.path.join(HERE, os.pardir, 'tests', 'resources')
+
+TOKEN = 'bench-token'
+
+EXECUTE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<wps:Execute service="WPS" version="1.0.0" xmlns:wps="http://www.opengis.net/wps/1.0.0"
+    xmlns:ows="http://www.opengis.net/ows/1.1">
+  <ows:Identifier>hello</ows:Identifier>
+</wps:Execute>'''
+
+EXECUTE_RESPONSE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<wps:ExecuteResponse xmlns:wps="http://www.opengis.net/wps/1.0.0" service="WPS" version="1.0.0"
+    serviceInstance="http://127.0.0.1:{port}/wps?service=WPS&amp;request=GetCapabilities">
+  <wps:Status><wps:ProcessSucceeded>done</wps:ProcessSucceeded></wps:Status>
+</wps:ExecuteResponse>'''
+
+# name: (method, path and query, body)
+SCENARIOS = {
+    'wps_getcaps': ('GET', '/ows/proxy/wps?service=wps&request=getcapabilities', None),
+    'wms_getcaps': ('GET', '/ows/proxy/wms?service=wms&request=getcapabilities&version=1.3.0', None),
+    'wms_getmap': ('GET', '/ows/proxy/wms?service=wms&request=getmap&version=1.3.0&layers=tas&crs=EPSG:4326'
+                          '&width=256&height=256&format=image/png&access_token=' + TOKEN, None),
+    'wps_execute': ('POST', '/ows/proxy/wps?access_token=' + TOKEN, EXECUTE),
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _read(name):
+    with open(os.path.join(RESOURCES, name), 'rb') as fh:
+        return fh.read()
+
+
+def run_backend(port, payload_size):
+    documents = {
+        '/wps': (_read('wps_caps_emu.xml'), 'text/xml'),
+        '/wms': (_read('wms_caps_ncwms2_130.xml'), 'text/xml'),
+    }
+    image = b'\x89PNG' + os.urandom(max(payload_size - 4, 0))
+    executed = EXECUTE_RESPONSE.replace(b'{port}', str(port).encode())
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body are written separately
+        disable_nagle_algorithm = True
+
+        def _send(self, body, content_type):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            if 'getmap' in query.lower():
+                self._send(image, 'image/png')
+            else:
+                self._send(*documents[path])
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            self._send(executed, 'text/xml')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def run_twitcher(port, backend_port, args):
+    from twitcher import main
+    from twitcher.datatype import Service, AccessToken
+    from twitcher.store import servicestore_factory, tokenstore_factory
+    from twitcher.utils import expires_at
+    settings = {
+        'twitcher.url': 'http://127.0.0.1:{}'.format(port),
+        'twitcher.database': 'memory',
+        'twitcher.ows_proxy_pool_maxsize': str(args.threads),
+        'twitcher.ows_proxy_caps_cache': str(not args.no_caps_cache).lower(),
+        'twitcher.esgf_keypool': 'false',
+    }
+    app = main({}, **settings)
+    url = 'http://127.0.0.1:{}'.format(backend_port)
+    services = servicestore_factory(app.registry)
+    services.save_service(Service(name='wps', url=url + '/wps', type='wps', public=False))
+    services.save_service(Service(name='wms', url=url + '/wms', type='wms', public=False))
+    tokenstore_factory(app.registry).save_token(AccessToken(token=TOKEN, expires_at=expires_at(hours=24)))
+    import waitress
+    waitress.serve(app, host='127.0.0.1', port=port, threads=args.threads, connection_limit=1000, _quiet=True)
+
+
+def wait_for(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server on port {} did not start.".format(port))
+
+
+def client(url, method, body, start, deadline, queue):
+    session = requests.Session()
+    latencies = []
+    errors = 0
+    while time.time() < start:
+        time.sleep(0.001)
+    while time.time() < deadline:
+        begin = time.perf_counter()
+        try:
+            resp = session.request(method, url, data=body)
+            resp.content
+            ok = resp.status_code == 200 and b'ExceptionReport' not in resp.content[:1024]
+        except requests.RequestException:
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - begin)
+        else:
+            errors += 1
+    queue.put((latencies, errors))
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[max(int(math.ceil(p * len(values))) - 1, 0)]
+
+
+def run_scenario(port, name, args):
+    method, path, body = SCENARIOS[name]
+    url = 'http://127.0.0.1:{}{}'.format(port, path)
+    # warm up the caches and connection pools
+    for _ in range(10):
+        requests.request(method, url, data=body).content
+    queue = multiprocessing.Queue()
+    start = time.time() + 0.5
+    deadline = start + args.duration
+    clients = [multiprocessing.Process(target=client, args=(url, method, body, start, deadline, queue))
+               for _ in range(args.concurrency)]
+    for process in clients:
+        process.start()
+    latencies = []
+    errors = 0
+    for _ in clients:
+        client_latencies, client_errors = queue.get()
+        latencies.extend(client_latencies)
+        errors += client_errors
+    for process in clients:
+        process.join()
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / args.duration,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def peak_rss_mb(pid):
+    """
+    Returns the peak resident set size of process ``pid`` in MB (Linux only).
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, previous=None):
+    print("{:<14} {:>10} {:>9} {:>9} {:>9} {:>8}".format('scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for name, result in results['scenarios'].items():
+        line = "{:<14} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>8d}".format(
+            name, result['rps'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['errors'])
+        before = (previous or {}).get('scenarios', {}).get(name)
+        if before and before['rps']:
+            line += "   req/s {:+.1f}%  p99 {:+.1f}%".format(
+                (result['rps'] / before['rps'] - 1) * 100, (result['p99_ms'] / before['p99_ms'] - 1) * 100)
+        print(line)
+    if results['peak_rss_mb'] is not None:
+        line = "peak RSS {:.1f} MB".format(results['peak_rss_mb'])
+        if previous and previous.get('peak_rss_mb'):
+            line += " ({:+.1f}%)".format((results['peak_rss_mb'] / previous['peak_rss_mb'] - 1) * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="Scenario to run, can be repeated (default: all).")
+    parser.add_argument('--concurrency', type=int, default=8, help="Concurrent client processes.")
+    parser.add_argument('--duration', type=float, default=5, help="Duration of each scenario in seconds.")
+    parser.add_argument('--threads', type=int, default=16, help="Waitress worker threads.")
+    parser.add_argument('--payload-size', type=int, default=256 * 1024, help="Size of the GetMap images in bytes.")
+    parser.add_argument('--no-caps-cache', action='store_true', help="Disable the capabilities cache.")
+    parser.add_argument('--output-dir', default=os.path.join(HERE, 'results'), help="Directory of the results.")
+    parser.add_argument('--compare', help="Results of an earlier run to compare with.")
+    args = parser.parse_args()
+
+    backend_port = free_port()
+    port = free_port()
+    backend = multiprocessing.Process(target=run_backend, args=(backend_port, args.payload_size), daemon=True)
+    server = multiprocessing.Process(target=run_twitcher, args=(port, backend_port, args), daemon=True)
+    backend.start()
+    server.start()
+    try:
+        wait_for(backend_port)
+        wait_for(port)
+        scenarios = {}
+        for name in args.scenario or sorted(SCENARIOS):
+            scenarios[name] = run_scenario(port, name, args)
+        rss = peak_rss_mb(server.pid)
+    finally:
+        server.terminate()
+        backend.terminate()
+        server.join()
+        backend.join()
+
+    results = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'options': {key: value for key, value in vars(args).items() if key not in ('output_dir', 'compare')},
+        'scenarios': scenarios,
+        'peak_rss_mb': rss,
+    }
+    previous = None
+    if args.compare:
+        with open(args.compare) as fh:
+            previous = json.load(fh)
+    report(results, previous)
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(path, 'w') as fh:
+        json.dump(results, fh, indent=2)
+    print("Saved results to {}".format(path))
+
+
+if __name__ == '__main__':
+    main()
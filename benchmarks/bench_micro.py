@@ -0,0 +1,217 @@
+"""
+Micro-benchmarks of the per-request code paths of Twitcher.
+
+Every benchmark calls one function in a loop for ``--time`` seconds and reports the calls per second.
+The memory allocated by one call is measured separately with :mod:`tracemalloc`: ``peak KiB`` is
+the largest amount of memory allocated during a call and ``kept B`` the memory still allocated
+after it. The capabilities documents in ``tests/resources`` are scaled up
+to ``--layers`` layers or processes.
+
+Usage::
+
+    $ make bench
+    $ python benchmarks/bench_micro.py --filter caps --layers 5000
+"""
+
+import io
+import os
+import copy
+import time
+import argparse
+import tracemalloc
+
+from lxml import etree
+from webob import Request
+
+from twitcher.owsrequest import Get, Post
+from twitcher.utils import replace_caps_url, iter_replace_caps_url, parse_service_name, expires_at
+from twitcher.datatype import Service, AccessToken
+from twitcher.store.memory import MemoryServiceStore, MemoryTokenStore
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESOURCES = os.path.join(HERE, os.pardir, 'tests', 'resources')
+
+PROXY_URL = 'https://localhost/ows/proxy/emu'
+CHUNK_SIZE = 64 * 1024
+
+EXECUTE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<wps:Execute service="WPS" version="1.0.0" xmlns:wps="http://www.opengis.net/wps/1.0.0"
+    xmlns:ows="http://www.opengis.net/ows/1.1">
+  <ows:Identifier>hello</ows:Identifier>
+  <wps:DataInputs>
+    <wps:Input>
+      <ows:Identifier>name</ows:Identifier>
+      <wps:Data><wps:LiteralData>%s</wps:LiteralData></wps:Data>
+    </wps:Input>
+  </wps:DataInputs>
+</wps:Execute>'''
+
+
+def scale_caps(xml, count):
+    """
+    Returns the capabilities document ``xml`` with its layers (WMS) or processes (WPS) copied
+    until there are ``count`` of them.
+    """
+    doc = etree.fromstring(xml)
+    items = [element for element in doc.iter('{*}Layer', '{*}Process')
+             if element.find('{*}Layer') is None]
+    for index in range(count - len(items)):
+        template = items[index % len(items)]
+        template.addnext(copy.deepcopy(template))
+    return etree.tostring(doc, xml_declaration=True, encoding='UTF-8')
+
+
+def _read(name):
+    with open(os.path.join(RESOURCES, name), 'rb') as fh:
+        return fh.read()
+
+
+def _get(query):
+    environ = Request.blank('/ows/proxy/emu?' + query).environ
+
+    def parse():
+        return Get(Request(dict(environ))).parse()
+    return parse
+
+
+def _post(body):
+    environ = Request.blank('/ows/proxy/emu', method='POST', content_type='text/xml').environ
+    environ['CONTENT_LENGTH'] = str(len(body))
+
+    def parse():
+        request = Request(dict(environ, **{'wsgi.input': io.BytesIO(body)}))
+        return Post(request).parse()
+    return parse
+
+
+def _replace(xml):
+    def replace():
+        return replace_caps_url(xml, PROXY_URL)
+    return replace
+
+
+def _iter_replace(xml):
+    chunks = [xml[offset:offset + CHUNK_SIZE] for offset in range(0, len(xml), CHUNK_SIZE)]
+
+    def replace():
+        for _ in iter_replace_caps_url(chunks, PROXY_URL):
+            pass
+    return replace
+
+
+def _service():
+    service = Service(name='emu', url='http://localhost:5000/wps', type='wps', public=False, verify='false')
+    return service.url, service.name, service.type, service.public, service.auth, service.verify
+
+
+def _access_token():
+    access_token = AccessToken(token='abc', expires_at=expires_at(hours=1), data={'esgf_access_token': 'xyz'})
+    return access_token.token, access_token.is_expired(), access_token.data, access_token.params
+
+
+def _service_store(size):
+    store = MemoryServiceStore()
+    for index in range(size):
+        # service names may not contain digits
+        name = 'service_' + ''.join(chr(ord('a') + int(digit)) for digit in str(index))
+        url = 'http://localhost:{}/wps'.format(index)
+        last = store.save_service(Service(name=name, url=url)).name
+    return {
+        'service_store.fetch_by_name': lambda: store.fetch_by_name(last),
+        'service_store.fetch_by_url': lambda: store.fetch_by_url(url),
+        'service_store.save_service': lambda: store.save_service(Service(name=last, url=url)),
+    }
+
+
+def _token_store(size):
+    store = MemoryTokenStore()
+    for index in range(size):
+        store.save_token(AccessToken(token='token_{}'.format(index), expires_at=expires_at(hours=1)))
+    access_token = AccessToken(token='token_0', expires_at=expires_at(hours=1))
+    return {
+        'token_store.fetch_by_token': lambda: store.fetch_by_token('token_0'),
+        'token_store.save_token': lambda: store.save_token(access_token),
+    }
+
+
+def benchmarks(layers):
+    wms_111 = scale_caps(_read('wms_caps_ncwms2_111.xml'), layers)
+    wms_130 = scale_caps(_read('wms_caps_ncwms2_130.xml'), layers)
+    wps = scale_caps(_read('wps_caps_emu.xml'), layers)
+    funcs = {
+        'owsrequest.get_getcaps': _get('service=WPS&request=GetCapabilities'),
+        'owsrequest.get_getmap': _get('service=WMS&request=GetMap&version=1.3.0&layers=tas&crs=EPSG:4326'
+                                      '&bbox=-90,-180,90,180&width=256&height=256&format=image/png'),
+        'owsrequest.post_execute': _post(EXECUTE % b'stranger'),
+        'owsrequest.post_execute_1mb': _post(EXECUTE % (b'x' * 1024 * 1024)),
+        'caps.replace_wms_111': _replace(wms_111),
+        'caps.replace_wms_130': _replace(wms_130),
+        'caps.replace_wps': _replace(wps),
+        'caps.iter_replace_wms_111': _iter_replace(wms_111),
+        'caps.iter_replace_wms_130': _iter_replace(wms_130),
+        'caps.iter_replace_wps': _iter_replace(wps),
+        'utils.parse_service_name': lambda: parse_service_name(PROXY_URL + '?service=wps', '/ows'),
+        'datatype.service': _service,
+        'datatype.access_token': _access_token,
+    }
+    funcs.update(_service_store(100))
+    funcs.update(_token_store(1000))
+    return funcs
+
+
+def measure_speed(func, seconds):
+    """
+    Returns the calls per second of ``func``.
+    """
+    calls = 0
+    batch = 1
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            func()
+        calls += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return calls / elapsed
+        batch = min(batch * 2, 10000)
+
+
+def measure_memory(func, repeat=5):
+    """
+    Returns the peak and the retained memory in bytes allocated by one call of ``func``.
+    """
+    # warm up caches and interned objects
+    func()
+    tracemalloc.start()
+    try:
+        peak = kept = 0
+        for _ in range(repeat):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            func()
+            current, call_peak = tracemalloc.get_traced_memory()
+            peak = max(peak, call_peak - before)
+            kept = max(kept, current - before)
+        return peak, kept
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--time', type=float, default=0.5, help="Seconds per benchmark.")
+    parser.add_argument('--layers', type=int, default=1000, help="Layers or processes of the capabilities documents.")
+    parser.add_argument('--filter', help="Run only benchmarks with this string in their name.")
+    args = parser.parse_args()
+
+    print("{:<30} {:>14} {:>10} {:>8}".format('benchmark', 'calls/s', 'peak KiB', 'kept B'))
+    for name, func in benchmarks(args.layers).items():
+        if args.filter and args.filter not in name:
+            continue
+        speed = measure_speed(func, args.time)
+        peak, kept = measure_memory(func)
+        print("{:<30} {:>14,.1f} {:>10.1f} {:>8d}".format(name, speed, peak / 1024.0, kept))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Compares the threaded (waitress) and the async (uvicorn) OWS proxy.
+
+A fake WPS answers Execute requests after ``--delay`` seconds while a fake WMS answers GetMap
+requests immediately. The benchmark keeps ``--slow`` Execute requests in flight and measures the
+GetMap throughput and latency seen by ``--clients`` concurrent clients during ``--duration`` seconds.
+
+Usage::
+
+    $ pip install aiohttp uvicorn
+    $ python benchmarks/bench_proxy.py --slow 200 --delay 5
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import socket
+import statistics
+import time
+
+import aiohttp
+from aiohttp import web
+
+EXECUTE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<wps:Execute service="WPS" version="1.0.0" xmlns:wps="http://www.opengis.net/wps/1.0.0"
+    xmlns:ows="http://www.opengis.net/ows/1.1">
+  <ows:Identifier>sleep</ows:Identifier>
+</wps:Execute>'''
+
+GETMAP = 'service=WMS&request=GetMap&version=1.3.0&layers=tas&crs=EPSG:4326&width=256&height=256&format=image/png'
+
+SETTINGS = {
+    'twitcher.database': 'memory',
+    'twitcher.ows_proxy_pool_maxsize': '1000',
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_backend(port, delay):
+    async def wps(request):
+        await request.read()
+        await asyncio.sleep(delay)
+        return web.Response(body=b'<wps:ExecuteResponse/>', content_type='text/xml')
+
+    async def wms(request):
+        return web.Response(body=b'\x89PNG' + b'\0' * 16 * 1024, content_type='image/png')
+
+    app = web.Application()
+    app.router.add_post('/wps', wps)
+    app.router.add_get('/wms', wms)
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+def register_services(registry, backend_port):
+    from twitcher.datatype import Service
+    from twitcher.store import servicestore_factory
+    store = servicestore_factory(registry)
+    url = 'http://127.0.0.1:{}'.format(backend_port)
+    store.save_service(Service(name='wps', url=url + '/wps', public=True))
+    store.save_service(Service(name='wms', url=url + '/wms', type='wms', public=True))
+
+
+def run_threaded(port, backend_port, threads):
+    logging.basicConfig(level=logging.ERROR)
+    import waitress
+    from twitcher import main
+    app = main({}, **SETTINGS)
+    register_services(app.registry, backend_port)
+    waitress.serve(app, host='127.0.0.1', port=port, threads=threads, connection_limit=10000,
+                   _quiet=True)
+
+
+def run_async(port, backend_port):
+    logging.basicConfig(level=logging.ERROR)
+    import uvicorn
+    from twitcher.asgi import make_asgi_app
+    app = make_asgi_app(dict(SETTINGS))
+    register_services(app.registry, backend_port)
+    uvicorn.run(app, host='127.0.0.1', port=port, log_level='warning', backlog=4096)
+
+
+async def wait_for(port):
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("Server on port {} did not start.".format(port))
+
+
+async def load(port, args):
+    base = 'http://127.0.0.1:{}/ows/proxy'.format(port)
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=None)
+    latencies = []
+    errors = 0
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def execute():
+            async with session.post(base + '/wps', data=EXECUTE) as resp:
+                await resp.read()
+                return resp.status
+
+        async def getmap(deadline):
+            nonlocal errors
+            while time.monotonic() < deadline:
+                start = time.monotonic()
+                try:
+                    async with session.get(base + '/wms?' + GETMAP) as resp:
+                        await resp.read()
+                        if resp.status != 200:
+                            errors += 1
+                            continue
+                except aiohttp.ClientError:
+                    errors += 1
+                    continue
+                latencies.append(time.monotonic() - start)
+
+        slow = [asyncio.ensure_future(execute()) for _ in range(args.slow)]
+        await asyncio.sleep(0.5)
+        deadline = time.monotonic() + args.duration
+        await asyncio.gather(*[getmap(deadline) for _ in range(args.clients)])
+        statuses = await asyncio.gather(*slow, return_exceptions=True)
+    return latencies, errors, sum(1 for status in statuses if status == 200)
+
+
+def report(name, latencies, errors, executed, args):
+    if latencies:
+        latencies.sort()
+        p50 = statistics.median(latencies) * 1000
+        p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    else:
+        p50 = p99 = float('nan')
+    print("{:<10} {:>10.1f} {:>10.1f} {:>10.1f} {:>8d} {:>7d}/{}".format(
+        name, len(latencies) / args.duration, p50, p99, errors, executed, args.slow))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--slow', type=int, default=100, help="Execute requests kept in flight.")
+    parser.add_argument('--delay', type=float, default=5, help="Execute response delay of the fake WPS.")
+    parser.add_argument('--clients', type=int, default=10, help="Concurrent GetMap clients.")
+    parser.add_argument('--duration', type=float, default=3, help="Duration of the GetMap load in seconds.")
+    parser.add_argument('--threads', type=int, default=16, help="Waitress worker threads.")
+    args = parser.parse_args()
+
+    backend_port = free_port()
+    backend = multiprocessing.Process(target=run_backend, args=(backend_port, args.delay), daemon=True)
+    backend.start()
+    engines = [
+        ('threaded', run_threaded, (args.threads,)),
+        ('async', run_async, ()),
+    ]
+    print("{:<10} {:>10} {:>10} {:>10} {:>8} {:>9}".format(
+        'engine', 'getmap/s', 'p50 ms', 'p99 ms', 'errors', 'executed'))
+    try:
+        for name, target, extra in engines:
+            port = free_port()
+            server = multiprocessing.Process(target=target, args=(port, backend_port) + extra, daemon=True)
+            server.start()
+            try:
+                asyncio.run(wait_for(port))
+                report(name, *asyncio.run(load(port, args)), args=args)
+            finally:
+                server.terminate()
+                server.join()
+    finally:
+        backend.terminate()
+        backend.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -34,6 +34,9 @@ setup(name='pyramid_twitcher',
       test_suite='twitcher',
       install_requires=reqs,
       extra_requires=extra_reqs,
+      extras_require={
+          'async': ['aiohttp', 'uvicorn'],
+      },
       entry_points="""\
       [paste.app_factory]
       main = twitcher:main
@@ -42,7 +42,9 @@ class XMLRPCInterfaceAppTest(unittest.TestCase):
     def test_register_service_and_unregister_it(self):
         service = {'url': WPS_TEST_SERVICE, 'name': 'test_emu',
                    'type': 'wps', 'public': False, 'auth': 'token',
-                   'verify': True, 'purl': 'http://purl/wps'}
+                   'verify': True, 'purl': 'http://purl/wps', 'cache_ttl': -1, 'tile_cache_ttl': -1,
+                   'max_concurrency': 0, 'request_concurrency': {}, 'max_queue': 0, 'queue_timeout': -1,
+                   'urls': [WPS_TEST_SERVICE], 'balance': 'round_robin', 'weights': [1]}
         # register
         resp = call_FUT(self.app, 'register_service', (
             service['url'],
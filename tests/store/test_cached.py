@@ -0,0 +1,176 @@
+import mock
+import pytest
+
+from pyramid.testing import DummyRequest, Registry
+
+from twitcher.datatype import Service, AccessToken
+from twitcher.exceptions import ServiceNotFound, AccessTokenNotFound
+from twitcher.utils import expires_at
+from twitcher.store.memory import MemoryServiceStore, MemoryTokenStore
+from twitcher.store.cached import CachedServiceStore, ServiceCache, MongodbServiceWatcher
+from twitcher.store.cached import CachedTokenStore, TokenCache
+from twitcher.store.cached import fetch_service_by_name, get_servicecache
+from twitcher.cache import get_capscache
+
+
+class TestCachedServiceStore(object):
+    def setup_method(self):
+        self.backend = MemoryServiceStore()
+        self.backend.save_service(Service(url='http://localhost:5000/wps', name='emu'))
+        self.cache = ServiceCache(ttl=60)
+        self.store = CachedServiceStore(self.backend, self.cache)
+
+    def test_fetch_by_name_is_cached(self):
+        with mock.patch.object(self.backend, 'fetch_by_name', wraps=self.backend.fetch_by_name) as fetch:
+            assert self.store.fetch_by_name('emu').url == 'http://localhost:5000/wps'
+            assert self.store.fetch_by_name('emu').url == 'http://localhost:5000/wps'
+            assert fetch.call_count == 1
+
+    def test_unknown_service_is_cached(self):
+        with mock.patch.object(self.backend, 'fetch_by_name', wraps=self.backend.fetch_by_name) as fetch:
+            with pytest.raises(ServiceNotFound):
+                self.store.fetch_by_name('hummingbird')
+            with pytest.raises(ServiceNotFound):
+                self.store.fetch_by_name('hummingbird')
+            assert fetch.call_count == 1
+        # registration invalidates the cache
+        self.store.save_service(Service(url='http://localhost:5001/wps', name='hummingbird'))
+        assert self.store.fetch_by_name('hummingbird').url == 'http://localhost:5001/wps'
+
+    def test_unknown_services_do_not_evict_services(self):
+        cache = ServiceCache(ttl=60, maxsize=2, negative_ttl=60, negative_maxsize=2)
+        store = CachedServiceStore(self.backend, cache)
+        store.fetch_by_name('emu')
+        with mock.patch.object(self.backend, 'fetch_by_name', wraps=self.backend.fetch_by_name) as fetch:
+            for index in range(10):
+                with pytest.raises(ServiceNotFound):
+                    store.fetch_by_name('random{}'.format(index))
+            assert store.fetch_by_name('emu').name == 'emu'
+            assert fetch.call_count == 10
+
+    def test_unknown_service_expires(self):
+        cache = ServiceCache(ttl=60, negative_ttl=0)
+        store = CachedServiceStore(self.backend, cache)
+        with pytest.raises(ServiceNotFound):
+            store.fetch_by_name('hummingbird')
+        # registered by another process
+        self.backend.save_service(Service(url='http://localhost:5001/wps', name='hummingbird'))
+        assert store.fetch_by_name('hummingbird').url == 'http://localhost:5001/wps'
+
+    def test_changes_invalidate_cache(self):
+        self.store.fetch_by_name('emu')
+        self.store.save_service(Service(url='http://localhost:5002/wps', name='emu'))
+        assert self.store.fetch_by_name('emu').url == 'http://localhost:5002/wps'
+        self.store.delete_service('emu')
+        with pytest.raises(ServiceNotFound):
+            self.store.fetch_by_name('emu')
+
+    def test_fetch_service_by_name_memo(self):
+        request = DummyRequest()
+        with mock.patch.object(self.store, 'fetch_by_name', wraps=self.store.fetch_by_name) as fetch:
+            service = fetch_service_by_name(request, self.store, 'emu')
+            assert fetch_service_by_name(request, self.store, 'emu') is service
+            assert fetch.call_count == 1
+
+
+def test_watcher_polls_version():
+    db = mock.MagicMock()
+    cache = ServiceCache()
+    cache.set('emu', Service(url='http://localhost:5000/wps', name='emu'))
+    watcher = MongodbServiceWatcher(db, cache)
+    db.counters.find_one.return_value = {'version': 1}
+    watcher.check_version()
+    assert cache.get('emu') is not None
+    db.counters.find_one.return_value = {'version': 2}
+    watcher.check_version()
+    assert cache.get('emu') is None
+
+
+def test_watcher_poll_reads_version_at_start():
+    db = mock.MagicMock()
+    cache = ServiceCache()
+    watcher = MongodbServiceWatcher(db, cache)
+    db.counters.find_one.return_value = {'version': 1}
+    with mock.patch.object(watcher._stopped, 'wait', side_effect=[False, True]):
+        # a service changed before the first poll
+        db.counters.find_one.side_effect = [{'version': 1}, {'version': 2}]
+        cache.set('emu', Service(url='http://localhost:5000/wps', name='emu'))
+        watcher.poll()
+    assert cache.get('emu') is None
+
+
+def test_watcher_returns_when_change_stream_is_closed():
+    db = mock.MagicMock()
+    stream = db.services.watch.return_value.__enter__.return_value
+    # the stream is closed by the invalidate event of a dropped collection
+    type(stream).alive = mock.PropertyMock(side_effect=[True, False])
+    stream.try_next.return_value = {'operationType': 'invalidate'}
+    cache = ServiceCache()
+    watcher = MongodbServiceWatcher(db, cache)
+    cache.set('emu', Service(url='http://localhost:5000/wps', name='emu'))
+    watcher.watch()
+    assert stream.try_next.call_count == 1
+    assert cache.get('emu') is None
+
+
+def test_watcher_invalidates_capabilities_cache():
+    registry = Registry()
+    registry.settings = {}
+    cache = get_servicecache(registry, db=mock.MagicMock())
+    capscache = get_capscache(registry)
+    service = Service(url='http://localhost:5000/wps', name='emu')
+    key = capscache.key(service, {'service': 'wps', 'request': 'getcapabilities'}, 'http://localhost/ows/proxy/emu')
+    capscache.store(key, service, b'<Capabilities/>')
+    db = cache.watcher.db
+    db.counters.find_one.return_value = {'version': 1}
+    cache.watcher.check_version()
+    assert capscache.lookup(key, service)[0] is not None
+    # changed by another process
+    db.counters.find_one.return_value = {'version': 2}
+    cache.watcher.check_version()
+    assert capscache.lookup(key, service)[0] is None
+
+
+def test_cache_changed_notifies_watcher():
+    cache = ServiceCache()
+    cache.watcher = mock.Mock()
+    cache.changed('emu')
+    cache.watcher.notify.assert_called_once_with()
+
+
+class TestCachedTokenStore(object):
+    def setup_method(self):
+        self.backend = MemoryTokenStore()
+        self.access_token = AccessToken(token='abcdef', expires_at=expires_at(hours=1))
+        self.backend.save_token(self.access_token)
+        self.store = CachedTokenStore(self.backend, TokenCache(max_age=60, negative_ttl=60))
+
+    def test_fetch_by_token_is_cached(self):
+        with mock.patch.object(self.backend, 'fetch_by_token', wraps=self.backend.fetch_by_token) as fetch:
+            assert self.store.fetch_by_token('abcdef') == self.access_token
+            assert self.store.fetch_by_token('abcdef') == self.access_token
+            assert fetch.call_count == 1
+
+    def test_unknown_token_is_cached(self):
+        with mock.patch.object(self.backend, 'fetch_by_token', wraps=self.backend.fetch_by_token) as fetch:
+            for _ in range(3):
+                with pytest.raises(AccessTokenNotFound):
+                    self.store.fetch_by_token('xyz')
+            assert fetch.call_count == 1
+
+    def test_expired_token_is_not_cached(self):
+        self.backend.save_token(AccessToken(token='expired', expires_at=expires_at(hours=-1)))
+        self.store.fetch_by_token('expired')
+        assert self.store.cache.get('expired') is None
+
+    def test_revoke_token(self):
+        self.store.fetch_by_token('abcdef')
+        self.store.delete_token('abcdef')
+        with pytest.raises(AccessTokenNotFound):
+            self.store.fetch_by_token('abcdef')
+
+    def test_revoke_all_tokens(self):
+        self.store.fetch_by_token('abcdef')
+        self.store.clear_tokens()
+        with pytest.raises(AccessTokenNotFound):
+            self.store.fetch_by_token('abcdef')
@@ -2,6 +2,7 @@ import unittest
 
 from twitcher.datatype import AccessToken
 from twitcher.store.memory import MemoryTokenStore
+from twitcher.utils import expires_at
 
 from twitcher.datatype import Service
 from twitcher.store.memory import MemoryServiceStore
@@ -20,6 +21,13 @@ class MemoryTokenStoreTestCase(unittest.TestCase):
         assert self.test_store.save_token(access_token)
         assert self.test_store.fetch_by_token(access_token.token) == access_token
 
+    def test_purge_expired_tokens(self):
+        self.test_store.save_token(AccessToken(token="abc", expires_at=expires_at(hours=1)))
+        self.test_store.save_token(AccessToken(token="xyz", expires_at=expires_at(hours=-1)))
+
+        assert self.test_store.purge_expired_tokens() == 1
+        assert self.test_store.fetch_by_token("abc")
+
 
 class MemoryServiceStoreTestCase(unittest.TestCase):
     def setUp(self):
@@ -30,6 +38,15 @@ class MemoryServiceStoreTestCase(unittest.TestCase):
                              'auth': 'token',
                              'type': 'WPS',
                              'verify': True,
+                             'cache_ttl': -1,
+                             'tile_cache_ttl': 600,
+                             'max_concurrency': 2,
+                             'request_concurrency': {'execute': 1},
+                             'max_queue': 4,
+                             'queue_timeout': 5,
+                             'urls': ['http://localhost:5000/wps', 'http://localhost:5001/wps'],
+                             'balance': 'weighted',
+                             'weights': [2, 1],
                              }
         self.test_store = MemoryServiceStore()
 
@@ -5,6 +5,7 @@ Based on unitests in https://github.com/wndhydrnt/python-oauth2/tree/master/oaut
 import pytest
 import unittest
 import mock
+from datetime import datetime
 
 from twitcher.datatype import AccessToken
 from twitcher.utils import expires_at
@@ -28,21 +29,53 @@ class MongodbTokenStoreTestCase(unittest.TestCase):
         collection_mock.find_one.assert_called_with({"token": self.access_token.token})
         assert isinstance(access_token, AccessToken)
 
+    def test_fetch_by_token_with_date(self):
+        collection_mock = mock.Mock(spec=["find_one"])
+        collection_mock.find_one.return_value = dict(
+            token="abcdef", expires_at=datetime.utcfromtimestamp(self.access_token.expires_at))
+
+        store = MongodbTokenStore(collection=collection_mock)
+        access_token = store.fetch_by_token(token=self.access_token.token)
+
+        assert access_token.expires_at == self.access_token.expires_at
+
     def test_save_token(self):
         collection_mock = mock.Mock(spec=["insert_one"])
 
         store = MongodbTokenStore(collection=collection_mock)
         store.save_token(self.access_token)
 
-        collection_mock.insert_one.assert_called_with(self.access_token)
+        collection_mock.insert_one.assert_called_with(dict(
+            token="abcdef", expires_at=datetime.utcfromtimestamp(self.access_token.expires_at)))
+
+    def test_purge_expired_tokens(self):
+        collection_mock = mock.Mock(spec=["delete_many"])
+        collection_mock.delete_many.return_value.deleted_count = 3
+
+        store = MongodbTokenStore(collection=collection_mock)
+        assert store.purge_expired_tokens() == 3
+
+    def test_clear_tokens_keeps_indexes(self):
+        collection_mock = mock.Mock(spec=["delete_many"])
+
+        store = MongodbTokenStore(collection=collection_mock)
+        store.clear_tokens()
+
+        collection_mock.delete_many.assert_called_with({})
 
 
 class MongodbServiceStoreTestCase(unittest.TestCase):
     def setUp(self):
         self.service = dict(name="loving_flamingo", url="http://somewhere.over.the/ocean", type="wps",
-                            public=False, auth='token', verify=True, purl="http://purl/wps")
+                            public=False, auth='token', verify=True, purl="http://purl/wps", cache_ttl=-1,
+                            tile_cache_ttl=-1, max_concurrency=0, request_concurrency={}, max_queue=0,
+                            queue_timeout=-1,
+                            urls=["http://somewhere.over.the/ocean"], balance='round_robin', weights=[1])
         self.service_public = dict(name="open_pingu", url="http://somewhere.in.the/deep_ocean", type="wps",
-                                   public=True, auth='token', verify=True, purl="http://purl/wps")
+                                   public=True, auth='token', verify=True, purl="http://purl/wps", cache_ttl=-1,
+                                   tile_cache_ttl=-1, max_concurrency=0, request_concurrency={}, max_queue=0,
+                                   queue_timeout=-1,
+                                   urls=["http://somewhere.in.the/deep_ocean"], balance='round_robin', weights=[1])
         self.service_special = dict(url="http://wonderload", name="A special Name", type='wps',
                                     auth='token', verify=False, purl="http://purl/wps")
 
@@ -76,7 +109,9 @@ class MongodbServiceStoreTestCase(unittest.TestCase):
 
         collection_mock.insert_one.assert_called_with({
             'url': 'http://wonderload', 'type': 'wps', 'name': 'a_special_name', 'public': False, 'auth': 'token',
-            'verify': False, 'purl': "http://purl/wps"})
+            'verify': False, 'purl': "http://purl/wps", 'cache_ttl': -1,
+            'tile_cache_ttl': -1, 'max_concurrency': 0, 'request_concurrency': {}, 'max_queue': 0, 'queue_timeout': -1,
+            'urls': ['http://wonderload'], 'balance': 'round_robin', 'weights': [1]})
 
     def test_save_service_public(self):
         collection_mock = mock.Mock(spec=["insert_one", "find_one", "count_documents"])
@@ -87,3 +122,11 @@ class MongodbServiceStoreTestCase(unittest.TestCase):
         store.save_service(Service(self.service_public))
 
         collection_mock.insert_one.assert_called_with(self.service_public)
+
+    def test_clear_services_keeps_indexes(self):
+        collection_mock = mock.Mock(spec=["delete_many"])
+
+        store = MongodbServiceStore(collection=collection_mock)
+        assert store.clear_services() is True
+
+        collection_mock.delete_many.assert_called_with({})
@@ -3,6 +3,7 @@ Testing the Twitcher API.
 """
 import pytest
 import unittest
+import mock
 
 from twitcher.api import TokenManager
 from twitcher.tokengenerator import UuidTokenGenerator
@@ -10,6 +11,8 @@ from twitcher.store.memory import MemoryTokenStore
 
 from twitcher.api import Registry
 from twitcher.store.memory import MemoryServiceStore
+from twitcher.breaker import BreakerRegistry
+from twitcher.tilecache import TileCache
 
 
 class TokenManagerTest(unittest.TestCase):
@@ -41,6 +44,26 @@ class TokenManagerTest(unittest.TestCase):
         access_token = self.tokenmgr.store.fetch_by_token(resp['access_token'])
         assert access_token.data == {'esgf_token': 'abcdef'}
 
+    def test_generate_token_fetch_credentials(self):
+        fetcher = mock.Mock()
+        fetcher.fetch.return_value = {'esgf_credentials_pem': 'pem', 'esgf_credentials_expires': 1}
+        self.tokenmgr.credentials_fetcher = fetcher
+        data = {'esgf_access_token': 'abcdef'}
+        resp = self.tokenmgr.generate_token(valid_in_hours=1, data=data)
+        assert fetcher.fetch.call_count == 0
+        resp = self.tokenmgr.generate_token(valid_in_hours=1, data=data, fetch_credentials=True)
+        assert fetcher.fetch.call_count == 1
+        access_token = self.tokenmgr.store.fetch_by_token(resp['access_token'])
+        assert access_token.data == {'esgf_access_token': 'abcdef', 'esgf_credentials_pem': 'pem',
+                                     'esgf_credentials_expires': 1}
+        assert data == {'esgf_access_token': 'abcdef'}
+
+    def test_purge_expired_tokens(self):
+        self.tokenmgr.generate_token(valid_in_hours=1)
+        self.tokenmgr.generate_token(valid_in_hours=-1)
+        assert self.tokenmgr.purge_expired_tokens() == 1
+        assert self.tokenmgr.purge_expired_tokens() == 0
+
 
 class RegistryTest(unittest.TestCase):
 
@@ -50,7 +73,9 @@ class RegistryTest(unittest.TestCase):
     def test_register_service_and_unregister_it(self):
         service = {'url': 'http://localhost/wps', 'name': 'test_emu',
                    'type': 'wps', 'public': False, 'auth': 'token', 'verify': True,
-                   'purl': 'http://myservice/wps'}
+                   'purl': 'http://myservice/wps', 'cache_ttl': -1, 'tile_cache_ttl': -1,
+                   'max_concurrency': 0, 'request_concurrency': {'execute': 2}, 'max_queue': 0, 'queue_timeout': -1,
+                   'urls': ['http://localhost/wps'], 'balance': 'round_robin', 'weights': [1]}
         # register
         resp = self.reg.register_service(
             service['url'],
@@ -73,3 +98,44 @@ class RegistryTest(unittest.TestCase):
         # clear
         resp = self.reg.clear_services()
         assert resp is True
+
+    def test_register_service_notifies_listeners(self):
+        changed = []
+        reg = Registry(servicestore=MemoryServiceStore(), listeners=[changed.append])
+        reg.register_service('http://localhost/wps', {'name': 'test_emu'})
+        reg.unregister_service('test_emu')
+        reg.clear_services()
+        assert changed == ['test_emu', 'test_emu', None]
+
+    def test_register_service_with_several_urls(self):
+        resp = self.reg.register_service(['http://localhost:5000/wps', 'http://localhost:5001/wps'],
+                                         {'name': 'test_emu', 'balance': 'least_outstanding'})
+        assert resp['url'] == 'http://localhost:5000/wps'
+        assert resp['urls'] == ['http://localhost:5000/wps', 'http://localhost:5001/wps']
+        assert resp['balance'] == 'least_outstanding'
+        # the first url is not repeated and duplicates are dropped
+        resp = self.reg.register_service(
+            ['http://localhost:5000/wps', 'http://localhost:5001/wps', 'http://localhost:5001/wps'],
+            {'name': 'test_emu'})
+        assert resp['urls'] == ['http://localhost:5000/wps', 'http://localhost:5001/wps']
+        with pytest.raises(ValueError):
+            self.reg.register_service(['http://localhost:5000/wps', 'http://localhost:5001/wps'],
+                                      {'name': 'test_emu', 'balance': 'random'})
+
+    def test_list_breakers(self):
+        assert self.reg.list_breakers() == []
+        breakers = BreakerRegistry()
+        breakers.get('emu')
+        reg = Registry(servicestore=MemoryServiceStore(), breakers=breakers)
+        assert reg.list_breakers() == [{'name': 'emu', 'state': 'closed', 'requests': 0, 'failures': 0,
+                                        'retry_in': 0.0}]
+
+    def test_purge_tile_cache(self):
+        assert self.reg.purge_tile_cache() == 0
+        tilecache = mock.Mock(spec=TileCache)
+        tilecache.purge.return_value = 3
+        reg = Registry(servicestore=MemoryServiceStore(), tilecache=tilecache)
+        assert reg.purge_tile_cache('emu') == 3
+        tilecache.purge.assert_called_with('emu')
+        reg.purge_tile_cache('')
+        tilecache.purge.assert_called_with(None)
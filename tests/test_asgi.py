@@ -0,0 +1,191 @@
+import asyncio
+
+import pytest
+
+from twitcher.datatype import Service
+from twitcher.store import servicestore_factory
+
+from .common import WPS_CAPS_EMU_XML
+
+EXECUTE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<wps:Execute service="WPS" version="1.0.0" xmlns:wps="http://www.opengis.net/wps/1.0.0"
+    xmlns:ows="http://www.opengis.net/ows/1.1">
+  <ows:Identifier>hello</ows:Identifier>
+</wps:Execute>'''
+
+web = pytest.importorskip('aiohttp.web')
+
+from twitcher.asgi import make_asgi_app  # noqa: E402
+
+
+async def _backend():
+    with open(WPS_CAPS_EMU_XML, 'rb') as fp:
+        caps = fp.read()
+    calls = []
+
+    async def wps(request):
+        if request.headers.get('If-None-Match') == '"1"':
+            calls.append('GET If-None-Match')
+            return web.Response(status=304)
+        calls.append(request.method)
+        if request.method == 'POST':
+            body = await request.read()
+            return web.Response(body=b'<ExecuteResponse>%d</ExecuteResponse>' % len(body), content_type='text/xml')
+        return web.Response(body=caps, content_type='text/xml', headers={'ETag': '"1"'})
+
+    async def wms(request):
+        return web.Response(body=b'PNG', content_type='image/png', headers={'X-Backend': request.path[1:]})
+
+    async def broken(request):
+        return web.Response(status=502, text='Bad Gateway')
+
+    app = web.Application()
+    app.router.add_route('*', '/wps', wps)
+    app.router.add_get('/wms', wms)
+    app.router.add_get('/wms2', wms)
+    app.router.add_get('/broken', broken)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, 'http://127.0.0.1:{}'.format(port), calls
+
+
+async def _call(app, method, path, query=b'', body=b'', chunks=None):
+    chunks = chunks or [body]
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': True} for chunk in chunks]
+    messages[-1]['more_body'] = False
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'root_path': '',
+             'headers': [(b'host', b'localhost:8000')], 'server': ('localhost', 8000), 'scheme': 'http'}
+    await app(scope, receive, send)
+    headers = dict(sent[0]['headers'])
+    return sent[0]['status'], headers, b''.join(m.get('body', b'') for m in sent[1:])
+
+
+def _run(test, **settings):
+    async def main():
+        runner, url, calls = await _backend()
+        app = make_asgi_app(dict(settings, **{'twitcher.database': 'memory',
+                                              'twitcher.ows_proxy_health_interval': '0'}))
+        store = servicestore_factory(app.registry)
+        store.save_service(Service(name='emu', url=url + '/wps', public=True))
+        store.save_service(Service(name='wms', url=url + '/wms', type='wms', public=True))
+        try:
+            await test(app, url, calls)
+        finally:
+            await app.close()
+            await runner.cleanup()
+    asyncio.run(main())
+
+
+def test_proxy_getcapabilities_is_rewritten_and_cached():
+    async def test(app, url, calls):
+        query = b'service=wps&request=getcapabilities'
+        status, headers, body = await _call(app, 'GET', '/ows/proxy/emu', query)
+        assert status == 200
+        assert headers[b'content-type'] == b'text/xml'
+        assert b'http://localhost:8000/ows/proxy/emu' in body
+        assert url.encode() not in body
+        status, _, cached = await _call(app, 'GET', '/ows/proxy/emu', query)
+        assert status == 200
+        assert cached == body
+        assert calls == ['GET']
+    _run(test)
+
+
+def test_proxy_revalidates_expired_capabilities():
+    async def test(app, url, calls):
+        query = b'service=wps&request=getcapabilities'
+        status, headers, body = await _call(app, 'GET', '/ows/proxy/emu', query)
+        assert headers[b'etag'] == b'"1"'
+        for key in list(app.capscache._cache._data):
+            app.capscache._cache.touch(key, ttl=-1)
+        status, _, revalidated = await _call(app, 'GET', '/ows/proxy/emu', query)
+        assert status == 200
+        assert revalidated == body
+        assert calls == ['GET', 'GET If-None-Match']
+        # fresh again
+        await _call(app, 'GET', '/ows/proxy/emu', query)
+        assert len(calls) == 2
+    _run(test)
+
+
+def test_proxy_circuit_breaker():
+    async def test(app, url, calls):
+        store = servicestore_factory(app.registry)
+        store.save_service(Service(name='broken', url=url + '/broken', type='wms', public=True,
+                                   max_concurrency=1))
+        query = b'service=wms&request=getmap&version=1.3.0'
+        status, _, body = await _call(app, 'GET', '/ows/proxy/broken', query)
+        assert (status, body) == (502, b'Bad Gateway')
+        # the concurrency slot was released
+        assert app.bulkheads._get(store.fetch_by_name('broken'))[1].active == 0
+        status, _, body = await _call(app, 'GET', '/ows/proxy/broken', query)
+        assert status == 503
+        assert b'Service broken is unavailable' in body
+        text = app.metrics.render()
+        assert 'twitcher_upstream_responses_total{service="broken",status="502"} 1' in text
+        assert 'twitcher_upstream_rejected_total{service="broken",reason="circuit_open"} 1' in text
+    _run(test, **{'twitcher.ows_proxy_breaker_min_requests': '1'})
+
+
+def test_proxy_execute_post():
+    async def test(app, url, calls):
+        status, _, body = await _call(app, 'POST', '/ows/proxy/emu', body=EXECUTE)
+        assert status == 200
+        assert body == b'<ExecuteResponse>%d</ExecuteResponse>' % len(EXECUTE)
+    _run(test)
+
+
+def test_proxy_execute_post_in_several_messages():
+    async def test(app, url, calls):
+        chunks = [EXECUTE[:10], EXECUTE[10:], b' ' * 200000]
+        status, _, body = await _call(app, 'POST', '/ows/proxy/emu', chunks=chunks)
+        assert status == 200
+        assert body == b'<ExecuteResponse>%d</ExecuteResponse>' % (len(EXECUTE) + 200000)
+    _run(test)
+
+
+def test_proxy_streams_other_services():
+    async def test(app, url, calls):
+        status, headers, body = await _call(app, 'GET', '/ows/proxy/wms', b'service=wms&request=getmap&version=1.3.0')
+        assert status == 200
+        assert headers[b'x-backend'] == b'wms'
+        assert body == b'PNG'
+    _run(test)
+
+
+def test_proxy_balances_backends():
+    async def test(app, url, calls):
+        store = servicestore_factory(app.registry)
+        store.save_service(Service(name='balanced', url=url + '/wms', urls=[url + '/wms', url + '/wms2'],
+                                   type='wms', public=True))
+        backends = []
+        query = b'service=wms&request=getmap&version=1.3.0'
+        for _ in range(4):
+            status, headers, _ = await _call(app, 'GET', '/ows/proxy/balanced', query)
+            assert status == 200
+            backends.append(headers[b'x-backend'])
+        assert sorted(backends) == [b'wms', b'wms', b'wms2', b'wms2']
+        balancer = app.registry.balancers.get(store.fetch_by_name('balanced'))
+        assert [endpoint.outstanding for endpoint in balancer.endpoints] == [0, 0]
+    _run(test)
+
+
+def test_proxy_unknown_service():
+    async def test(app, url, calls):
+        status, _, body = await _call(app, 'GET', '/ows/proxy/unknown', b'service=wps&request=getcapabilities')
+        assert status == 200
+        assert b'Could not find service unknown' in body
+        status, _, _ = await _call(app, 'GET', '/other')
+        assert status == 404
+    _run(test)
@@ -0,0 +1,119 @@
+import mock
+
+from pyramid.testing import Registry
+
+from twitcher.datatype import Service
+from twitcher.balancer import Balancer, BalancerRegistry, Endpoint, get_balancers
+from twitcher.api import Registry as ServiceRegistry
+from twitcher.store.memory import MemoryServiceStore
+from twitcher.rpcinterface import service_listeners
+
+URLS = ['http://wps1/wps', 'http://wps2/wps', 'http://wps3/wps']
+
+
+def _choose(balancer, count):
+    return [balancer.choose().endpoint.url for _ in range(count)]
+
+
+def test_round_robin():
+    balancer = Balancer([Endpoint(url) for url in URLS])
+    assert _choose(balancer, 4) == URLS + URLS[:1]
+
+
+def test_least_outstanding():
+    balancer = Balancer([Endpoint(url) for url in URLS], strategy='least_outstanding')
+    first = balancer.choose()
+    second = balancer.choose()
+    assert balancer.choose().endpoint.url == URLS[2]
+    first.release()
+    first.release()
+    assert balancer.choose().endpoint.url == URLS[0]
+    second.release()
+    assert balancer.choose().endpoint.url == URLS[1]
+
+
+def test_weighted():
+    balancer = Balancer([Endpoint(URLS[0], 3), Endpoint(URLS[1], 1)], strategy='weighted')
+    chosen = _choose(balancer, 8)
+    assert chosen.count(URLS[0]) == 6
+    assert chosen[:4] == [URLS[0], URLS[0], URLS[1], URLS[0]]
+
+
+def test_unhealthy_endpoints_are_skipped():
+    endpoints = [Endpoint(url) for url in URLS]
+    balancer = Balancer(endpoints)
+    endpoints[1].healthy = False
+    assert _choose(balancer, 4) == [URLS[0], URLS[2], URLS[0], URLS[2]]
+    assert balancer.choose(exclude=[URLS[0], URLS[2]]).endpoint.url == URLS[1]
+    assert balancer.choose(exclude=URLS) is None
+    # all backends are used when none is healthy
+    for endpoint in endpoints:
+        endpoint.healthy = False
+    assert balancer.choose() is not None
+
+
+def test_health_checks():
+    balancers = BalancerRegistry(health_failures=2)
+    service = Service(name='emu', url=URLS[0], urls=URLS[:2], type='wps')
+    balancer = balancers.get(service)
+    assert balancers.get(service) is balancer
+    session = mock.Mock()
+    session.get.side_effect = [mock.Mock(status_code=200), IOError('refused')] * 2 + [mock.Mock(status_code=200)] * 2
+    balancers.check_all(session)
+    assert [endpoint.healthy for endpoint in balancer.endpoints] == [True, True]
+    balancers.check_all(session)
+    assert [endpoint.healthy for endpoint in balancer.endpoints] == [True, False]
+    assert session.get.call_args[1]['params'] == {'service': 'WPS', 'request': 'GetCapabilities'}
+    balancers.check_all(session)
+    assert [endpoint.healthy for endpoint in balancer.endpoints] == [True, True]
+
+
+def test_registry_rebuilt_on_change():
+    balancers = BalancerRegistry()
+    balancer = balancers.get(Service(name='emu', url=URLS[0], urls=URLS[:2]))
+    other = balancers.get(Service(name='emu', url=URLS[0], urls=URLS[:2], balance='weighted', weights=[2]))
+    assert other is not balancer
+    assert [endpoint.weight for endpoint in other.endpoints] == [2, 1]
+
+
+def test_get_balancers_from_settings():
+    registry = Registry()
+    registry.settings = {'twitcher.ows_proxy_health_interval': '0'}
+    balancers = get_balancers(registry)
+    assert balancers.health_interval == 0
+    balancers.ensure_started()
+    assert balancers._pid is None
+
+
+def test_removed_balancer_stops_health_checks():
+    balancers = BalancerRegistry(health_interval=60)
+    balancers.get(Service(name='emu', url=URLS[0], urls=URLS[:2]))
+    balancers.get(Service(name='ncwms', url=URLS[1], urls=URLS[1:]))
+    balancers.ensure_started()
+    stopped = balancers._stopped
+    balancers.remove('emu')
+    assert list(balancers._balancers) == ['ncwms']
+    assert not stopped.is_set()
+    balancers.remove()
+    assert balancers._balancers == {}
+    assert stopped.is_set()
+    # started again for the next balancer
+    balancers.get(Service(name='emu', url=URLS[0], urls=URLS[:2]))
+    balancers.ensure_started()
+    assert balancers._pid is not None and not balancers._stopped.is_set()
+    balancers.stop()
+
+
+def test_balancer_dropped_when_service_changes():
+    registry = Registry()
+    registry.settings = {'twitcher.ows_proxy_health_interval': '0'}
+    balancers = get_balancers(registry)
+    reg = ServiceRegistry(MemoryServiceStore(), listeners=service_listeners(registry))
+    reg.register_service(URLS[:2], {'name': 'emu', 'type': 'wps'})
+    balancers.get(Service(name='emu', url=URLS[0], urls=URLS[:2]))
+    # reduced to a single url
+    reg.register_service(URLS[0], {'name': 'emu', 'type': 'wps'})
+    assert 'emu' not in balancers._balancers
+    balancers.get(Service(name='emu', url=URLS[0], urls=URLS[:2]))
+    reg.unregister_service('emu')
+    assert 'emu' not in balancers._balancers
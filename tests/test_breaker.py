@@ -0,0 +1,129 @@
+from pyramid.testing import Registry
+
+from twitcher.breaker import CircuitBreaker, BreakerRegistry, Trial, get_breakers, CLOSED, OPEN, HALF_OPEN
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _breaker(clock, **options):
+    return CircuitBreaker('emu', window=10, min_requests=4, error_rate=0.5, open_seconds=5, clock=clock, **options)
+
+
+def test_breaker_opens_on_error_rate():
+    clock = Clock()
+    breaker = _breaker(clock)
+    for failed in (True, False, True):
+        breaker.record(failed)
+    # too few requests
+    assert breaker.state == CLOSED
+    breaker.record(False)
+    assert breaker.state == OPEN
+    assert breaker.allow() is False
+    status = breaker.status()
+    assert status['state'] == OPEN
+    assert status['retry_in'] == 5
+
+
+def test_breaker_window():
+    clock = Clock()
+    breaker = _breaker(clock)
+    breaker.record(True)
+    breaker.record(True)
+    clock.now += 11
+    breaker.record(True)
+    breaker.record(False)
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.state == CLOSED
+    assert breaker.status()['requests'] == 4
+
+
+def test_breaker_slow_requests_fail():
+    clock = Clock()
+    breaker = _breaker(clock, slow_threshold=1)
+    for _ in range(4):
+        breaker.record(False, elapsed=2)
+    assert breaker.state == OPEN
+
+
+def test_breaker_half_open_trial():
+    clock = Clock()
+    breaker = _breaker(clock)
+    for _ in range(4):
+        breaker.record(True)
+    clock.now += 5
+    trial = breaker.allow()
+    assert isinstance(trial, Trial)
+    assert breaker.state == HALF_OPEN
+    # a single trial request
+    assert breaker.allow() is False
+    breaker.record(True, trial=trial)
+    assert breaker.state == OPEN
+    assert breaker.allow() is False
+    clock.now += 5
+    trial = breaker.allow()
+    assert trial
+    breaker.record(False, trial=trial)
+    assert breaker.state == CLOSED
+    assert breaker.allow() is True
+    assert breaker.status()['requests'] == 0
+
+
+def test_breaker_lost_trial_is_replaced():
+    clock = Clock()
+    breaker = _breaker(clock)
+    for _ in range(4):
+        breaker.record(True)
+    clock.now += 5
+    lost = breaker.allow()
+    assert lost
+    clock.now += 5
+    trial = breaker.allow()
+    assert trial and trial is not lost
+    # the outcome of the replaced trial does not count
+    breaker.record(False, trial=lost)
+    assert breaker.state == HALF_OPEN
+    breaker.record(False, trial=trial)
+    assert breaker.state == CLOSED
+
+
+def test_breaker_ignores_other_requests_when_half_open():
+    clock = Clock()
+    breaker = _breaker(clock)
+    for _ in range(4):
+        breaker.record(True)
+    clock.now += 5
+    trial = breaker.allow()
+    # slow requests sent before the breaker opened
+    breaker.record(False)
+    assert breaker.state == HALF_OPEN
+    breaker.record(True)
+    assert breaker.state == HALF_OPEN
+    breaker.record(True, trial=trial)
+    assert breaker.state == OPEN
+
+
+def test_registry():
+    breakers = BreakerRegistry(min_requests=1)
+    breakers.get('wps').record(True)
+    assert breakers.get('emu') is breakers.get('emu')
+    assert [(status['name'], status['state']) for status in breakers.list_status()] == [
+        ('emu', CLOSED), ('wps', OPEN)]
+
+
+def test_get_breakers_from_settings():
+    registry = Registry()
+    registry.settings = {'twitcher.ows_proxy_breaker_min_requests': '3',
+                         'twitcher.ows_proxy_breaker_slow_threshold': ''}
+    breakers = get_breakers(registry)
+    assert breakers.options['min_requests'] == 3
+    assert breakers.options['slow_threshold'] is None
+    registry = Registry()
+    registry.settings = {'twitcher.ows_proxy_breaker': 'false'}
+    assert get_breakers(registry) is None
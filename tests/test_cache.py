@@ -0,0 +1,81 @@
+from twitcher.cache import LRUCache, CapabilitiesCache
+from twitcher.datatype import Service
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=10)
+    cache.set('a', 1, size=4)
+    cache.set('b', 2, size=4)
+    assert cache.get('a') == 1
+    cache.set('c', 3, size=4)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.currsize == 8
+    assert cache.set('d', 4, size=11) is False
+    assert len(cache) == 2
+
+
+def test_lru_cache_expiry():
+    cache = LRUCache()
+    cache.set('a', 1, ttl=-1)
+    assert cache.get('a') is None
+    assert cache.get('a', stale=True) == 1
+    cache.touch('a', ttl=60)
+    assert cache.get('a') == 1
+
+
+def test_lru_cache_pop_matching():
+    cache = LRUCache()
+    cache.set(('emu', 1), 1)
+    cache.set(('emu', 2), 2)
+    cache.set(('wms', 1), 3)
+    assert cache.pop_matching(lambda key: key[0] == 'emu') == 2
+    assert len(cache) == 1
+    assert cache.currsize == 1
+
+
+class TestCapabilitiesCache(object):
+    def setup_method(self):
+        self.service = Service(url='http://localhost:5000/wps', name='emu')
+        self.cache = CapabilitiesCache(ttl=60, maxsize=1024, max_entry_size=100)
+        self.key = self.cache.key(self.service, {'service': 'wps', 'request': 'getcapabilities', 'token': 'abc'},
+                                  'https://localhost/ows/proxy/emu')
+
+    def test_key_ignores_token(self):
+        key = self.cache.key(self.service, {'service': 'wps', 'request': 'getcapabilities'},
+                             'https://localhost/ows/proxy/emu')
+        assert key == self.key
+
+    def test_store_and_lookup(self):
+        assert self.cache.lookup(self.key, self.service) == (None, False)
+        assert self.cache.store(self.key, self.service, b'<Capabilities/>', content_type='text/xml')
+        cached, fresh = self.cache.lookup(self.key, self.service)
+        assert fresh is True
+        assert cached.body == b'<Capabilities/>'
+        # service was registered again with another url
+        other = Service(url='http://localhost:5001/wps', name='emu')
+        assert self.cache.lookup(self.key, other) == (None, False)
+
+    def test_store_too_big_or_disabled(self):
+        assert self.cache.store(self.key, self.service, b'x' * 101) is False
+        disabled = Service(url='http://localhost:5000/wps', name='emu', cache_ttl=0)
+        assert self.cache.store(self.key, disabled, b'<Capabilities/>') is False
+
+    def test_revalidate(self):
+        service = Service(url='http://localhost:5000/wps', name='emu', cache_ttl=1)
+        self.cache.store(self.key, service, b'<Capabilities/>', etag='"1"')
+        self.cache._cache.touch(self.key, ttl=-1)
+        cached, fresh = self.cache.lookup(self.key, service)
+        assert fresh is False
+        assert cached.etag == '"1"'
+        self.cache.revalidated(self.key, service)
+        assert self.cache.lookup(self.key, service)[1] is True
+
+    def test_invalidate(self):
+        self.cache.store(self.key, self.service, b'<Capabilities/>')
+        self.cache.invalidate('wms')
+        assert self.cache.lookup(self.key, self.service)[0] is not None
+        self.cache.invalidate('emu')
+        assert self.cache.lookup(self.key, self.service)[0] is None
+        assert self.cache.currsize == 0
@@ -0,0 +1,213 @@
+import threading
+
+from pyramid import testing
+from pyramid.response import Response
+from pyramid.testing import DummyRequest, Registry
+
+from twitcher import owsproxy
+from twitcher.coalesce import Coalescer, FollowerAppIter, get_coalescer
+from twitcher.datatype import Service
+from twitcher.owsexceptions import OWSAccessFailed
+
+
+class Backend(object):
+    """
+    A request to a service held until :meth:`finish` is called.
+    """
+
+    def __init__(self, chunks=(b'abc', b'def')):
+        self.chunks = list(chunks)
+        self.calls = 0
+        self.started = threading.Event()
+        self.finished = threading.Event()
+
+    def send(self):
+        self.calls += 1
+        self.started.set()
+        self.finished.wait(5)
+        return Response(status=200, content_type='image/png', app_iter=iter(self.chunks))
+
+    def finish(self):
+        self.finished.set()
+
+
+def _send_in_thread(coalescer, key, send, results):
+    def run():
+        response, coalesced = coalescer.send(key, send)
+        results.append((b''.join(response.app_iter), coalesced))
+        if hasattr(response.app_iter, 'close'):
+            response.app_iter.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def _wait_for_followers(coalescer, key, count):
+    for _ in range(500):
+        flight = coalescer._flights.get(key)
+        if flight is not None and flight.followers >= count:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("followers did not join")
+
+
+def test_identical_requests_share_one_request():
+    coalescer = Coalescer(timeout=5)
+    backend = Backend()
+    results = []
+    leader = _send_in_thread(coalescer, 'key', backend.send, results)
+    backend.started.wait(5)
+    followers = [_send_in_thread(coalescer, 'key', backend.send, results) for _ in range(3)]
+    _wait_for_followers(coalescer, 'key', 3)
+    backend.finish()
+    for thread in [leader] + followers:
+        thread.join()
+    assert backend.calls == 1
+    assert sorted(results) == [(b'abcdef', False)] + [(b'abcdef', True)] * 3
+    assert coalescer._flights == {}
+
+
+def test_followers_send_own_request_after_ows_exception():
+    coalescer = Coalescer(timeout=5)
+    calls = []
+    started = threading.Event()
+    finished = threading.Event()
+
+    def send():
+        calls.append(1)
+        if len(calls) == 1:
+            started.set()
+            finished.wait(5)
+            return OWSAccessFailed("refused")
+        return Response(body=b'ok')
+
+    results = []
+
+    def follow():
+        results.append(coalescer.send('key', send))
+    leader = threading.Thread(target=follow)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=follow)
+    follower.start()
+    _wait_for_followers(coalescer, 'key', 1)
+    finished.set()
+    leader.join()
+    follower.join()
+    assert len(calls) == 2
+    assert sorted(isinstance(response, OWSAccessFailed) for response, _ in results) == [False, True]
+    assert all(not coalesced for _, coalesced in results)
+
+
+def test_body_is_read_for_followers_when_leader_is_closed():
+    coalescer = Coalescer(timeout=5)
+    backend = Backend()
+    responses = []
+    leader = threading.Thread(target=lambda: responses.append(coalescer.send('key', backend.send)))
+    leader.start()
+    backend.started.wait(5)
+    results = []
+    follower = _send_in_thread(coalescer, 'key', backend.send, results)
+    _wait_for_followers(coalescer, 'key', 1)
+    backend.finish()
+    leader.join()
+    response, coalesced = responses[0]
+    # the client of the leader went away without reading the body
+    response.app_iter.close()
+    follower.join()
+    assert results == [(b'abcdef', True)]
+
+
+def test_large_body_is_not_joined():
+    coalescer = Coalescer(timeout=5, max_size=4)
+    response, _ = coalescer.send('key', lambda: Response(app_iter=iter([b'abc', b'def', b'ghi'])))
+    chunks = iter(response.app_iter)
+    assert next(chunks) == b'abc'
+    assert 'key' in coalescer._flights
+    assert next(chunks) == b'def'
+    assert 'key' not in coalescer._flights
+    assert b''.join(chunks) == b'ghi'
+    response.app_iter.close()
+
+
+def test_body_is_not_kept_without_followers():
+    coalescer = Coalescer(timeout=5, max_size=1024)
+    response, _ = coalescer.send('key', lambda: Response(app_iter=iter([b'x' * 1000] * 100)))
+    flight = coalescer._flights['key']
+    assert sum(len(chunk) for chunk in response.app_iter) == 100000
+    assert flight.chunks == [] and flight.size == 0
+    response.app_iter.close()
+    assert flight.chunks == [] and flight.size == 0
+
+    response, _ = coalescer.send('key', lambda: Response(app_iter=iter([b'abc', b'def'])))
+    flight = coalescer._flights['key']
+    assert b''.join(response.app_iter) == b'abcdef'
+    assert flight.chunks == []
+
+
+def test_follower_of_large_body_fails():
+    coalescer = Coalescer(timeout=5, max_size=4)
+    response, _ = coalescer.send('key', lambda: Response(app_iter=iter([b'abc', b'def', b'ghi'])))
+    flight = coalescer._flights['key']
+    flight.followers += 1
+    follower = FollowerAppIter(flight, 5)
+    chunks = iter(response.app_iter)
+    next(chunks)
+    next(chunks)
+    assert flight.chunks == []
+    try:
+        list(follower)
+    except IOError:
+        pass
+    else:
+        raise AssertionError("IOError not raised")
+
+
+def test_follower_of_failed_flight_raises():
+    coalescer = Coalescer(timeout=5)
+    response, _ = coalescer.send('key', lambda: Response(app_iter=iter([b'abc', b'def'])))
+    flight = coalescer._flights['key']
+    follower = FollowerAppIter(flight, 5)
+    chunks = iter(response.app_iter)
+    next(chunks)
+    coalescer._land('key', flight, failed=True)
+    try:
+        list(follower)
+    except IOError:
+        pass
+    else:
+        raise AssertionError("IOError not raised")
+
+
+def test_get_coalescer_disabled():
+    registry = Registry()
+    registry.settings = {'twitcher.ows_proxy_coalesce': 'false'}
+    assert get_coalescer(registry) is None
+    registry = Registry()
+    registry.settings = {'twitcher.ows_proxy_coalesce_timeout': '2'}
+    assert get_coalescer(registry).timeout == 2.0
+
+
+def test_coalesce_key():
+    config = testing.setUp()
+    try:
+        config.add_route('owsproxy', '/ows/proxy/{service_name}')
+        service = Service(name='emu', url='http://localhost:5000/wps', type='wps')
+        key = owsproxy._coalesce_key(
+            DummyRequest(params={'service': 'WPS', 'request': 'GetCapabilities', 'access_token': 'abc'}), service)
+        other = owsproxy._coalesce_key(
+            DummyRequest(params={'Request': 'getcapabilities', 'SERVICE': 'wps'}), service)
+        assert key == other
+        request = DummyRequest(params={'service': 'WPS', 'request': 'GetCapabilities'},
+                               headers={'Authorization': 'Basic xyz'})
+        assert owsproxy._coalesce_key(request, service) != key
+        assert owsproxy._coalesce_key(
+            DummyRequest(params={'service': 'WPS', 'request': 'GetCapabilities', 'token': 'xyz'}), service) == key
+        request = DummyRequest(post={})
+        request.method = 'POST'
+        assert owsproxy._coalesce_key(request, service) is None
+        # not read-only
+        request = DummyRequest(params={'service': 'WPS', 'request': 'Execute', 'identifier': 'hello'})
+        assert owsproxy._coalesce_key(request, service) is None
+    finally:
+        testing.tearDown()
@@ -62,5 +62,14 @@ class ServiceTestCase(unittest.TestCase):
                                   'type': 'WPS',
                                   'url': 'http://nowhere/wps',
                                   'verify': True,
-                                  'purl': 'http://myservice/wps'}
+                                  'purl': 'http://myservice/wps',
+                                  'cache_ttl': -1,
+                                  'tile_cache_ttl': -1,
+                                  'max_concurrency': 0,
+                                  'request_concurrency': {},
+                                  'max_queue': 0,
+                                  'queue_timeout': -1,
+                                  'urls': ['http://nowhere/wps'],
+                                  'balance': 'round_robin',
+                                  'weights': [1]}
         assert service.has_purl() is True
@@ -0,0 +1,49 @@
+import mock
+
+from pyramid.testing import Registry
+
+from twitcher import db
+
+
+def _registry():
+    registry = Registry()
+    registry.settings = {'mongodb.host': '127.0.0.1', 'mongodb.port': '27017', 'mongodb.db_name': 'twitcher_test',
+                         'mongodb.max_pool_size': '10'}
+    return registry
+
+
+@mock.patch('twitcher.db.pymongo.MongoClient')
+def test_mongodb_client_is_shared(client_mock):
+    registry = _registry()
+    first = db.mongodb(registry)
+    second = db.mongodb(registry)
+    assert first is second
+    assert client_mock.call_count == 1
+    args, kwargs = client_mock.call_args
+    assert args == ('127.0.0.1', 27017)
+    assert kwargs['maxPoolSize'] == 10
+    assert kwargs['connect'] is False
+    # indexes are only created once
+    first.services.create_index.assert_called_once_with("name", unique=True)
+
+
+@mock.patch('twitcher.db.pymongo.MongoClient')
+def test_mongodb_command_metrics(client_mock):
+    registry = _registry()
+    db.mongodb(registry)
+    args, kwargs = client_mock.call_args
+    listener, = kwargs['event_listeners']
+    listener.succeeded(mock.Mock(command_name='find', duration_micros=1500))
+    listener.failed(mock.Mock(command_name='insert', duration_micros=500))
+    text = registry.metrics.render()
+    assert 'twitcher_mongodb_seconds_sum{command="find"} 0.0015' in text
+    assert 'twitcher_mongodb_failures_total{command="insert"} 1' in text
+
+
+@mock.patch('twitcher.db.pymongo.MongoClient')
+def test_includeme_skips_memory_database(client_mock):
+    registry = _registry()
+    registry.settings['twitcher.database'] = 'memory'
+    db.includeme(mock.Mock(registry=registry))
+    assert client_mock.call_count == 0
+    assert getattr(registry, 'mongodb', None) is None
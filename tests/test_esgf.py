@@ -1,9 +1,21 @@
+import os
+import time
+import shutil
 import pytest
 import unittest
 import mock
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import mkdtemp
 
-from twitcher.esgf import ESGFAccessManager
+from OpenSSL import crypto
+from cryptography.fernet import Fernet
+from pyramid.testing import Registry
+
+from twitcher.datatype import AccessToken
+from twitcher.utils import expires_at
+from twitcher.esgf import ESGFAccessManager, CredentialsCache, CredentialsFetcher, KeyPool, certificate_expires
+from twitcher.esgf import fetch_certificate, get_credentialsfetcher, ESGF_CREDENTIALS
+from twitcher.metrics import Metrics
 
 
 class ESGFTestCase(unittest.TestCase):
@@ -15,3 +27,205 @@ class ESGFTestCase(unittest.TestCase):
 
     def test_logon_with_token(self):
         assert self.mgr.logon(access_token="abcdef") is True
+
+    def test_logon_with_stored_credentials(self):
+        assert self.mgr.logon(access_token="abcdef", credentials="pem") is True
+        assert self.mgr._retrieve_certificate.call_count == 0
+        with open(self.mgr.esgf_credentials) as fh:
+            assert fh.read() == "pem"
+
+
+def _write_credentials(workdir, days=1):
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 1024)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'test'
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(int(days * 86400))
+    cert.sign(key, 'sha256')
+    with open(os.path.join(workdir, ESGF_CREDENTIALS), 'wb') as fh:
+        fh.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    return True
+
+
+class CredentialsCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.access_token = AccessToken(token='abc', expires_at=expires_at(hours=1),
+                                        data={'esgf_access_token': 'def'})
+        self.workdirs = []
+
+    def workdir_factory(self):
+        self.workdirs.append(mkdtemp())
+        return self.workdirs[-1]
+
+    def test_certificate_expires(self):
+        workdir = mkdtemp()
+        _write_credentials(workdir, days=1)
+        expires = certificate_expires(os.path.join(workdir, ESGF_CREDENTIALS))
+        assert abs(expires - time.time() - 86400) < 60
+        assert certificate_expires(os.path.join(workdir, 'missing.pem')) is None
+
+    def test_fetch_is_cached(self):
+        cache = CredentialsCache(margin=300)
+        fetch = mock.Mock(side_effect=lambda workdir, data, keypool, cipher: _write_credentials(workdir))
+        with mock.patch('twitcher.esgf.fetch_certificate', fetch):
+            workdir = cache.fetch(self.access_token, self.workdir_factory)
+            assert cache.fetch(self.access_token, self.workdir_factory) == workdir
+        assert self.workdirs == [workdir]
+
+    def test_fetch_removed_workdir(self):
+        cache = CredentialsCache(margin=300)
+        fetch = mock.Mock(side_effect=lambda workdir, data, keypool, cipher: _write_credentials(workdir))
+        with mock.patch('twitcher.esgf.fetch_certificate', fetch):
+            workdir = cache.fetch(self.access_token, self.workdir_factory)
+            shutil.rmtree(workdir)
+            assert cache.fetch(self.access_token, self.workdir_factory) != workdir
+        assert fetch.call_count == 2
+
+    def test_fetch_expiring_certificate_is_not_cached(self):
+        cache = CredentialsCache(margin=300)
+        fetch = mock.Mock(side_effect=lambda workdir, data, keypool, cipher: _write_credentials(workdir, days=0.001))
+        with mock.patch('twitcher.esgf.fetch_certificate', fetch):
+            cache.fetch(self.access_token, self.workdir_factory)
+            cache.fetch(self.access_token, self.workdir_factory)
+        assert fetch.call_count == 2
+
+    def test_fetch_failed(self):
+        cache = CredentialsCache()
+        with mock.patch('twitcher.esgf.fetch_certificate', return_value=False) as fetch:
+            assert cache.fetch(self.access_token, self.workdir_factory) is None
+            assert cache.fetch(self.access_token, self.workdir_factory) is None
+        assert fetch.call_count == 2
+        assert not any(os.path.exists(workdir) for workdir in self.workdirs)
+
+    def test_fetch_raised(self):
+        cache = CredentialsCache()
+        with mock.patch('twitcher.esgf.fetch_certificate', side_effect=IOError('no space left')):
+            with pytest.raises(IOError):
+                cache.fetch(self.access_token, self.workdir_factory)
+        assert len(self.workdirs) == 1
+        assert not os.path.exists(self.workdirs[0])
+
+    def test_concurrent_fetch_is_shared(self):
+        cache = CredentialsCache()
+
+        def slow_fetch(workdir, data, keypool, cipher):
+            time.sleep(0.2)
+            return _write_credentials(workdir)
+
+        with mock.patch('twitcher.esgf.fetch_certificate', side_effect=slow_fetch) as fetch:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                results = list(executor.map(lambda _: cache.fetch(self.access_token, self.workdir_factory), range(4)))
+        assert fetch.call_count == 1
+        assert len(set(results)) == 1
+
+
+class CredentialsFetcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cipher = Fernet(Fernet.generate_key())
+        self.fetcher = CredentialsFetcher(self.cipher, max_workers=2, timeout=5)
+        self.data = {'esgf_access_token': 'def', 'esgf_slcs_service_url': 'https://localhost:5000'}
+
+    def test_fetch(self):
+        fetch = mock.Mock(side_effect=lambda workdir, data, keypool: _write_credentials(workdir))
+        with mock.patch('twitcher.esgf.fetch_certificate', fetch):
+            result = self.fetcher.fetch(self.data)
+        assert 'BEGIN' not in result['esgf_credentials_pem']
+        assert 'BEGIN CERTIFICATE' in self.cipher.decrypt(result['esgf_credentials_pem'].encode()).decode()
+        assert abs(result['esgf_credentials_expires'] - time.time() - 86400) < 60
+
+    def test_fetch_without_esgf_data(self):
+        with mock.patch('twitcher.esgf.fetch_certificate') as fetch:
+            assert self.fetcher.fetch({}) == {}
+        assert fetch.call_count == 0
+
+    def test_fetch_failed(self):
+        with mock.patch('twitcher.esgf.fetch_certificate', return_value=False):
+            assert self.fetcher.fetch(self.data) == {}
+
+    def test_stored_credentials_are_written(self):
+        workdir = mkdtemp()
+        data = dict(self.data, esgf_credentials_pem=self.cipher.encrypt(b'pem').decode(),
+                    esgf_credentials_expires=time.time() + 3600)
+        with mock.patch.object(ESGFAccessManager, '_retrieve_certificate') as retrieve:
+            assert fetch_certificate(workdir=workdir, data=data, cipher=self.cipher) is True
+        assert retrieve.call_count == 0
+        with open(os.path.join(workdir, ESGF_CREDENTIALS)) as fh:
+            assert fh.read() == 'pem'
+
+    def test_stored_credentials_need_the_key(self):
+        data = dict(self.data, esgf_credentials_pem=self.cipher.encrypt(b'pem').decode(),
+                    esgf_credentials_expires=time.time() + 3600)
+        other = Fernet(Fernet.generate_key())
+        for cipher in (None, other):
+            with mock.patch.object(ESGFAccessManager, '_retrieve_certificate', return_value=True) as retrieve:
+                assert fetch_certificate(workdir=mkdtemp(), data=data, cipher=cipher) is True
+            assert retrieve.call_count == 1
+
+    def test_get_credentialsfetcher(self):
+        registry = Registry()
+        registry.settings = {}
+        assert get_credentialsfetcher(registry) is None
+        registry = Registry()
+        registry.settings = {'twitcher.esgf_credentials_key': Fernet.generate_key().decode()}
+        assert get_credentialsfetcher(registry).cipher is not None
+
+    def test_expiring_stored_credentials_are_not_used(self):
+        data = dict(self.data, esgf_credentials_pem=self.cipher.encrypt(b'pem').decode(),
+                    esgf_credentials_expires=time.time() + 60)
+        with mock.patch.object(ESGFAccessManager, '_retrieve_certificate', return_value=True) as retrieve:
+            assert fetch_certificate(workdir=mkdtemp(), data=data, cipher=self.cipher) is True
+        assert retrieve.call_count == 1
+
+
+class KeyPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.keypool = KeyPool(size=2, metrics=self.metrics)
+
+    def tearDown(self):
+        self.keypool.stop()
+
+    def _wait_filled(self):
+        for _ in range(200):
+            if self.keypool.stats()['depth'] == self.keypool.size:
+                return
+            time.sleep(0.05)
+        raise AssertionError("key pool was not filled")
+
+    def test_get_from_pool(self):
+        self.keypool.ensure_started()
+        self._wait_filled()
+        key_pair = self.keypool.get()
+        assert key_pair.bits() == 2048
+        stats = self.keypool.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 0
+        assert stats['generated'] >= 2
+        assert stats['refill_rate'] > 0
+        self._wait_filled()
+        assert self.keypool.get() is not key_pair
+        self._wait_filled()
+        text = self.metrics.render()
+        assert 'twitcher_keypool_keys 2' in text
+        assert 'twitcher_keypool_requests_total{result="hit"} 2' in text
+        assert 'twitcher_keypool_generate_seconds_count' in text
+
+    def test_get_from_empty_pool(self):
+        with mock.patch('twitcher.esgf.generate_key_pair', return_value='key') as generate:
+            self.keypool.stop()
+            self.keypool._pid = os.getpid()
+            assert self.keypool.get() == 'key'
+        assert generate.call_count == 1
+        assert self.keypool.stats()['misses'] == 1
+        assert 'twitcher_keypool_requests_total{result="miss"} 1' in self.metrics.render()
+
+    def test_retrieve_certificate_uses_pool(self):
+        keypool = mock.Mock()
+        keypool.get.side_effect = RuntimeError('from pool')
+        mgr = ESGFAccessManager(slcs_service_url="https://localhost:5000", base_dir=mkdtemp(), keypool=keypool)
+        with pytest.raises(RuntimeError):
+            mgr._retrieve_certificate('abcdef')
+        assert keypool.get.call_count == 1
@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+from pyramid.testing import Registry
+
+from twitcher.datatype import Service
+from twitcher.exceptions import ServiceBusy
+from twitcher.limits import Bulkhead, BulkheadRegistry, ReleasingAppIter, Slot, get_bulkheads
+
+
+def test_bulkhead_rejects_without_queue():
+    bulkhead = Bulkhead(1)
+    bulkhead.acquire()
+    with pytest.raises(ServiceBusy) as e:
+        bulkhead.acquire()
+    assert e.value.reason == 'busy'
+    bulkhead.release()
+    bulkhead.acquire()
+
+
+def test_bulkhead_queue_timeout():
+    bulkhead = Bulkhead(1, max_queue=1, timeout=0.05)
+    bulkhead.acquire()
+    with pytest.raises(ServiceBusy) as e:
+        bulkhead.acquire()
+    assert e.value.reason == 'timeout'
+    assert bulkhead.waiting == 0
+
+
+def test_bulkhead_waiting_request_gets_released_slot():
+    bulkhead = Bulkhead(1, max_queue=1, timeout=5)
+    bulkhead.acquire()
+    acquired = threading.Event()
+
+    def wait():
+        bulkhead.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    assert not acquired.wait(0.05)
+    bulkhead.release()
+    thread.join()
+    assert acquired.is_set()
+    assert bulkhead.active == 1
+
+
+def test_registry_service_and_request_limits():
+    bulkheads = BulkheadRegistry()
+    service = Service(name='emu', url='http://localhost:5000/wps', max_concurrency=2,
+                      request_concurrency={'Execute': 1})
+    slot = bulkheads.acquire(service, 'execute')
+    with pytest.raises(ServiceBusy):
+        bulkheads.acquire(service, 'execute')
+    # the rejected request did not keep a service slot
+    other = bulkheads.acquire(service, 'getcapabilities')
+    with pytest.raises(ServiceBusy):
+        bulkheads.acquire(service, 'describeprocess')
+    slot.release()
+    slot.release()
+    other.release()
+    bulkheads.acquire(service, 'execute')
+
+
+def test_registry_without_limits():
+    assert BulkheadRegistry().acquire(Service(name='emu', url='http://localhost:5000/wps'), 'execute') is None
+
+
+def test_registry_rebuilt_on_limit_change():
+    bulkheads = BulkheadRegistry()
+    bulkheads.acquire(Service(name='emu', url='http://localhost:5000/wps', max_concurrency=1))
+    with pytest.raises(ServiceBusy):
+        bulkheads.acquire(Service(name='emu', url='http://localhost:5000/wps', max_concurrency=1))
+    assert bulkheads.acquire(Service(name='emu', url='http://localhost:5000/wps', max_concurrency=2)) is not None
+
+
+def test_releasing_app_iter():
+    bulkhead = Bulkhead(1)
+    bulkhead.acquire()
+    app_iter = ReleasingAppIter([b'caps'], Slot([bulkhead]))
+    assert list(app_iter) == [b'caps']
+    app_iter.close()
+    assert bulkhead.active == 0
+
+
+def test_get_bulkheads_from_settings():
+    registry = Registry()
+    registry.settings = {'twitcher.ows_proxy_queue_timeout': '2.5'}
+    assert get_bulkheads(registry).queue_timeout == 2.5
+    assert get_bulkheads(registry) is registry.bulkheads
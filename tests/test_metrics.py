@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from pyramid.testing import DummyRequest, Registry
+
+from twitcher.metrics import Metrics, MetricsRegistry, get_metrics, metrics_view, render
+
+
+def test_counter_and_histogram():
+    metrics = MetricsRegistry()
+    requests = metrics.counter('requests_total', "Requests.", ('service',))
+    requests.labels(service='emu').inc()
+    requests.labels(service='emu').inc(2)
+    seconds = metrics.histogram('seconds', "Latency.", buckets=(0.1, 1))
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+    seconds.observe(5)
+    text = render(metrics.collect())
+    assert 'requests_total{service="emu"} 3' in text
+    assert 'seconds_bucket{le="0.1"} 1' in text
+    assert 'seconds_bucket{le="1.0"} 2' in text
+    assert 'seconds_bucket{le="+Inf"} 3' in text
+    assert 'seconds_sum 5.55' in text
+    assert 'seconds_count 3' in text
+    assert '# TYPE seconds histogram' in text
+
+
+def test_gauge():
+    metrics = MetricsRegistry()
+    depth = metrics.gauge('depth', "Depth.")
+    depth.set(3)
+    depth.set(2)
+    text = render(metrics.collect())
+    assert '# TYPE depth gauge' in text
+    assert 'depth 2' in text
+
+
+def test_label_values_are_escaped():
+    metrics = MetricsRegistry()
+    metrics.counter('errors_total', "Errors.", ('reason',)).labels(reason='a "b"\n').inc()
+    assert 'errors_total{reason="a \\"b\\"\\n"} 1' in render(metrics.collect())
+
+
+def test_disabled():
+    metrics = Metrics(enabled=False)
+    metrics.token_validations.labels(outcome='valid').inc()
+    metrics.security_seconds.labels(service='emu', request='execute').observe(1)
+    assert 'twitcher_token_validations_total{' not in metrics.render()
+
+
+def test_processes_are_added_up():
+    directory = tempfile.mkdtemp()
+    other = Metrics(directory=directory)
+    other.token_validations.labels(outcome='valid').inc(2)
+    other.upstream_seconds.labels(service='emu', request='execute').observe(0.2)
+    # written by another worker process
+    other.write()
+    os.rename(os.path.join(directory, 'twitcher_metrics_{}.json'.format(os.getpid())),
+              os.path.join(directory, 'twitcher_metrics_1.json'))
+    metrics = Metrics(directory=directory)
+    metrics.token_validations.labels(outcome='valid').inc()
+    metrics.upstream_seconds.labels(service='emu', request='execute').observe(2)
+    text = metrics.render()
+    assert 'twitcher_token_validations_total{outcome="valid"} 3' in text
+    assert 'twitcher_upstream_seconds_count{service="emu",request="execute"} 2' in text
+    assert 'twitcher_upstream_seconds_sum{service="emu",request="execute"} 2.2' in text
+
+
+def test_files_of_stopped_processes_are_removed():
+    directory = tempfile.mkdtemp()
+    other = Metrics(directory=directory)
+    other.keypool_keys.set(4)
+    other.write()
+    own = os.path.join(directory, 'twitcher_metrics_{}.json'.format(os.getpid()))
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    stopped = os.path.join(directory, 'twitcher_metrics_{}.json'.format(process.pid))
+    shutil.copy(own, stopped)
+    # not written for a while
+    outdated = os.path.join(directory, 'twitcher_metrics_1.json')
+    shutil.copy(own, outdated)
+    os.utime(outdated, (time.time() - 60, time.time() - 60))
+    running = os.path.join(directory, 'twitcher_metrics_{}.json'.format(os.getppid()))
+    os.rename(own, running)
+    metrics = Metrics(directory=directory, flush_interval=5)
+    metrics.keypool_keys.set(1)
+    assert 'twitcher_keypool_keys 5' in metrics.render()
+    assert os.listdir(directory) == [os.path.basename(running)]
+
+
+def test_metrics_view():
+    request = DummyRequest(environ={'REMOTE_ADDR': '127.0.0.1'})
+    request.registry = Registry()
+    request.registry.settings = {}
+    get_metrics(request.registry).store_seconds.labels(service='emu', store='service').observe(0.001)
+    response = metrics_view(request)
+    assert response.content_type == 'text/plain'
+    assert b'twitcher_store_seconds_count{service="emu",store="service"} 1' in response.body
+
+
+def test_metrics_view_is_restricted():
+    registry = Registry()
+    registry.settings = {}
+    for address, status in [('10.0.0.1', 403), ('::1', 200), ('', 403)]:
+        request = DummyRequest(environ={'REMOTE_ADDR': address}, headers={'X-Forwarded-For': '127.0.0.1'})
+        request.registry = registry
+        assert metrics_view(request).status_code == status
+    registry.settings = {'twitcher.metrics_allow': '10.0.0.0/8'}
+    request = DummyRequest(environ={'REMOTE_ADDR': '10.1.2.3'})
+    request.registry = registry
+    assert metrics_view(request).status_code == 200
+    registry.settings = {'twitcher.metrics_allow': ''}
+    request = DummyRequest(environ={'REMOTE_ADDR': '192.168.1.1'})
+    request.registry = registry
+    assert metrics_view(request).status_code == 200
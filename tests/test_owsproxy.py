@@ -6,14 +6,25 @@ pyramid testing:
 * http://docs.pylonsproject.org/projects/pyramid/en/latest/quick_tutorial/routing.html
 """
 
+import io
 import unittest
+import mock
+
+import requests
 
 from pyramid import testing
 from pyramid.testing import DummyRequest
 
-from twitcher.owsexceptions import OWSAccessFailed
+from twitcher.owsexceptions import OWSAccessFailed, OWSAccessForbidden, OWSServerBusy
 from twitcher import owsproxy
 from twitcher.owsproxy import owsproxy as owsproxy_view
+from twitcher.datatype import Service
+from twitcher.limits import ReleasingAppIter, get_bulkheads
+from twitcher.cache import CapabilitiesCache
+from twitcher.coalesce import get_coalescer
+from twitcher.breaker import CLOSED
+
+from .common import WPS_CAPS_EMU_XML
 
 
 class OWSProxyTests(unittest.TestCase):
@@ -34,3 +45,204 @@ class OWSProxyTests(unittest.TestCase):
                                params={'url': 'http://'})
         response = owsproxy_view(request)
         assert isinstance(response, OWSAccessFailed) is True
+
+
+class SendRequestTests(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.add_route('owsproxy', '/ows/proxy/{service_name}')
+        self.service = Service(name='emu', url='http://localhost:5000/wps', type='wps')
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _send(self, content_type, body, service=None):
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.headers['Content-Type'] = content_type
+        resp.headers['Content-Length'] = str(len(body))
+        resp.raw = io.BytesIO(body)
+        sessions = mock.Mock(timeout=(10, None))
+        sessions.get_session.return_value.request.return_value = resp
+        with mock.patch('twitcher.owsproxy.get_sessionregistry', return_value=sessions):
+            return owsproxy._send_request(DummyRequest(), service or self.service)
+
+    def test_raw_content_is_streamed(self):
+        response = self._send('image/png', b'PNG' * 100000)
+        assert isinstance(response.app_iter, owsproxy.BufferedResponse)
+        assert response.content_length == 300000
+        assert b''.join(response.app_iter) == b'PNG' * 100000
+
+    def test_xml_content_is_rewritten(self):
+        with open(WPS_CAPS_EMU_XML, 'rb') as fp:
+            response = self._send('text/xml', fp.read())
+        assert isinstance(response.app_iter, owsproxy.RewrittenResponse)
+        assert response.content_length is None
+        body = b''.join(response.app_iter)
+        assert b'http://example.com/ows/proxy/emu' in body
+        assert b'http://localhost:8094/wps' not in body
+
+    def test_metrics(self):
+        with open(WPS_CAPS_EMU_XML, 'rb') as fp:
+            body = fp.read()
+        response = self._send('text/xml', body)
+        b''.join(response.app_iter)
+        text = self.config.registry.metrics.render()
+        assert 'twitcher_upstream_responses_total{service="emu",status="200"} 1' in text
+        assert 'twitcher_upstream_received_bytes_total{service="emu"} ' + str(len(body)) in text
+        assert 'twitcher_upstream_seconds_count{service="emu",request=""} 1' in text
+        assert 'twitcher_rewrite_seconds_count{service="emu"} 1' in text
+
+    def test_content_type_not_allowed(self):
+        response = self._send('application/x-msdownload', b'MZ')
+        assert isinstance(response, OWSAccessForbidden)
+
+    def test_concurrency_limit(self):
+        service = Service(name='emu', url='http://localhost:5000/wps', type='wps', max_concurrency=1)
+        response = self._send('image/png', b'PNG', service=service)
+        assert isinstance(response.app_iter, ReleasingAppIter)
+        busy = self._send('image/png', b'PNG', service=service)
+        assert isinstance(busy, OWSServerBusy)
+        assert busy.status_code == 503
+        text = self.config.registry.metrics.render()
+        assert 'twitcher_upstream_rejected_total{service="emu",reason="busy"} 1' in text
+        # the slot is released when the response is closed
+        response.app_iter.close()
+        response = self._send('image/png', b'PNG', service=service)
+        assert b''.join(response.app_iter) == b'PNG'
+
+    def test_concurrency_slot_released_on_error(self):
+        service = Service(name='emu', url='http://localhost:5000/wps', type='wps', max_concurrency=1)
+        response = self._send('application/x-msdownload', b'MZ', service=service)
+        assert isinstance(response, OWSAccessForbidden)
+        assert not isinstance(self._send('image/png', b'PNG', service=service), OWSServerBusy)
+
+    def test_circuit_breaker(self):
+        self.config.registry.settings['twitcher.ows_proxy_breaker_min_requests'] = '1'
+        sessions = mock.Mock(timeout=(10, None))
+        sessions.get_session.return_value.request.side_effect = requests.ConnectionError('refused')
+        with mock.patch('twitcher.owsproxy.get_sessionregistry', return_value=sessions):
+            assert isinstance(owsproxy._send_request(DummyRequest(), self.service), OWSAccessFailed)
+            # fails fast without sending the request
+            response = owsproxy._send_request(DummyRequest(), self.service)
+        assert isinstance(response, OWSServerBusy)
+        assert sessions.get_session.return_value.request.call_count == 1
+        text = self.config.registry.metrics.render()
+        assert 'twitcher_upstream_rejected_total{service="emu",reason="circuit_open"} 1' in text
+
+    def _send_status(self, status, content_type, body):
+        resp = requests.Response()
+        resp.status_code = status
+        resp.headers['Content-Type'] = content_type
+        resp.raw = io.BytesIO(body)
+        sessions = mock.Mock(timeout=(10, None))
+        sessions.get_session.return_value.request.return_value = resp
+        with mock.patch('twitcher.owsproxy.get_sessionregistry', return_value=sessions):
+            return owsproxy._send_request(DummyRequest(), self.service)
+
+    def test_exception_report_is_not_a_failure(self):
+        self.config.registry.settings['twitcher.ows_proxy_breaker_min_requests'] = '1'
+        response = self._send_status(500, 'text/xml', b'<ows:ExceptionReport/>')
+        assert b'ExceptionReport' in b''.join(response.app_iter)
+        response = self._send_status(400, 'application/vnd.ogc.se_xml', b'<ServiceExceptionReport/>')
+        b''.join(response.app_iter)
+        status = self.config.registry.breakers.get('emu').status()
+        assert (status['state'], status['requests'], status['failures']) == (CLOSED, 2, 0)
+        self._send_status(502, 'text/html', b'Bad Gateway')
+        assert self.config.registry.breakers.get('emu').status()['failures'] == 1
+
+    def test_get_retried_on_another_backend(self):
+        self.config.registry.settings['twitcher.ows_proxy_health_interval'] = '0'
+        service = Service(name='emu', url='http://wps1/wps', urls=['http://wps1/wps', 'http://wps2/wps'], type='wps')
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.headers['Content-Type'] = 'image/png'
+        resp.raw = io.BytesIO(b'PNG')
+        sessions = mock.Mock(timeout=(10, None))
+        sessions.get_session.return_value.request.side_effect = [requests.ConnectionError('refused'), resp]
+        with mock.patch('twitcher.owsproxy.get_sessionregistry', return_value=sessions):
+            response = owsproxy._send_request(DummyRequest(), service)
+        urls = [call[1]['url'] for call in sessions.get_session.return_value.request.call_args_list]
+        assert urls == ['http://wps1/wps', 'http://wps2/wps']
+        assert b''.join(response.app_iter) == b'PNG'
+        balancer = self.config.registry.balancers.get(service)
+        assert [endpoint.outstanding for endpoint in balancer.endpoints] == [0, 1]
+        response.app_iter.close()
+        assert [endpoint.outstanding for endpoint in balancer.endpoints] == [0, 0]
+        assert 'twitcher_upstream_retries_total{service="emu"} 1' in self.config.registry.metrics.render()
+
+    def test_retry_without_other_backend(self):
+        service = Service(name='emu', url='http://wps1/wps', urls=['http://wps1/wps', 'http://wps2/wps'], type='wps')
+        lease = mock.Mock()
+        lease.endpoint.url = 'http://wps1/wps'
+        balancers = mock.Mock()
+        # the other backend was taken out of the balancer
+        balancers.get.return_value.choose.side_effect = [lease, None]
+        sessions = mock.Mock(timeout=(10, None))
+        sessions.get_session.return_value.request.side_effect = requests.ConnectionError('refused')
+        with mock.patch('twitcher.owsproxy.get_sessionregistry', return_value=sessions), \
+                mock.patch('twitcher.owsproxy.get_balancers', return_value=balancers):
+            response = owsproxy._send_request(DummyRequest(), service)
+        assert isinstance(response, OWSAccessFailed)
+        assert sessions.get_session.return_value.request.call_count == 1
+        assert lease.release.call_count == 1
+
+    def test_revalidated_response_is_closed(self):
+        service = Service(name='ncwms', url='http://localhost:8080/ncWMS2/wms', type='wms', max_concurrency=1)
+        cache = CapabilitiesCache(ttl=60)
+        request = DummyRequest(params={'service': 'WMS', 'request': 'GetCapabilities'})
+        key = owsproxy._caps_cache_key(request, service, cache)
+        cache.store(key, service, b'<Capabilities/>', content_type='text/xml', etag='"1"')
+        cache._cache.touch(key, ttl=-1)
+        resp = requests.Response()
+        resp.status_code = 304
+        resp.raw = io.BytesIO(b'')
+        sessions = mock.Mock(timeout=(10, None))
+        sessions.get_session.return_value.request.return_value = resp
+        with mock.patch('twitcher.owsproxy.get_sessionregistry', return_value=sessions):
+            response = owsproxy._send_cached_request(request, service, cache, key)
+        assert response.body == b'<Capabilities/>'
+        assert sessions.get_session.return_value.request.call_args[1]['headers']['If-None-Match'] == '"1"'
+        # the concurrency slot and the coalesced request are released
+        assert get_bulkheads(self.config.registry)._get(service)[1].active == 0
+        assert get_coalescer(self.config.registry)._flights == {}
+
+    def test_wps_document_is_revalidated(self):
+        cache = CapabilitiesCache(ttl=60)
+        request = DummyRequest(params={'service': 'WPS', 'request': 'GetCapabilities'})
+        key = owsproxy._caps_cache_key(request, self.service, cache)
+        with open(WPS_CAPS_EMU_XML, 'rb') as fp:
+            body = fp.read()
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.headers.update({'Content-Type': 'text/xml', 'ETag': '"1"',
+                             'Last-Modified': 'Sun, 18 Oct 2026 10:00:00 GMT'})
+        resp.raw = io.BytesIO(body)
+        not_modified = requests.Response()
+        not_modified.status_code = 304
+        not_modified.raw = io.BytesIO(b'')
+        sessions = mock.Mock(timeout=(10, None))
+        sessions.get_session.return_value.request.side_effect = [resp, not_modified]
+        with mock.patch('twitcher.owsproxy.get_sessionregistry', return_value=sessions):
+            response = owsproxy._send_cached_request(request, self.service, cache, key)
+            assert response.headers['ETag'] == '"1"'
+            b''.join(response.app_iter)
+            response.app_iter.close()
+            cache._cache.touch(key, ttl=-1)
+            response = owsproxy._send_cached_request(request, self.service, cache, key)
+        headers = sessions.get_session.return_value.request.call_args[1]['headers']
+        assert headers['If-None-Match'] == '"1"'
+        assert headers['If-Modified-Since'] == 'Sun, 18 Oct 2026 10:00:00 GMT'
+        assert b'http://example.com/ows/proxy/emu' in response.body
+
+    def test_post_not_retried(self):
+        service = Service(name='emu', url='http://wps1/wps', urls=['http://wps1/wps', 'http://wps2/wps'], type='wps')
+        sessions = mock.Mock(timeout=(10, None))
+        sessions.get_session.return_value.request.side_effect = requests.ConnectionError('refused')
+        request = DummyRequest(post={})
+        request.method = 'POST'
+        request.body = b'<Execute/>'
+        with mock.patch('twitcher.owsproxy.get_sessionregistry', return_value=sessions):
+            response = owsproxy._send_request(request, service)
+        assert isinstance(response, OWSAccessFailed)
+        assert sessions.get_session.return_value.request.call_count == 1
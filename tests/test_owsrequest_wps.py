@@ -6,7 +6,7 @@ from pyramid import testing
 from pyramid.testing import DummyRequest
 
 from twitcher.owsrequest import OWSRequest
-from twitcher.owsexceptions import OWSInvalidParameterValue, OWSMissingParameterValue
+from twitcher.owsexceptions import OWSInvalidParameterValue, OWSMissingParameterValue, OWSNoApplicableCode
 
 
 class OWSRequestWpsTestCase(unittest.TestCase):
@@ -135,3 +135,26 @@ class OWSRequestWpsTestCase(unittest.TestCase):
         assert ows_req.request == 'execute'
         assert ows_req.service == 'wps'
         assert ows_req.version == '1.0.0'
+
+    def test_post_execute_request_with_large_inline_data(self):
+        request = DummyRequest(post={})
+        request.body = b"""<?xml version="1.0" encoding="UTF-8"?>
+        <wps:Execute service="WPS" version="1.0.0" xmlns:wps="http://www.opengis.net/wps/1.0.0">
+          <wps:DataInputs><wps:Input><wps:Data><wps:ComplexData>""" + b"x" * 10 * 1024 * 1024
+        ows_req = OWSRequest(request)
+        assert ows_req.request == 'execute'
+        assert ows_req.service == 'wps'
+        assert ows_req.version == '1.0.0'
+
+    def test_post_execute_request_after_long_prolog(self):
+        request = DummyRequest(post={})
+        request.body = b"<!-- comment -->" * 10000 + b"""
+        <wps:Execute service="WPS" version="1.0.0" xmlns:wps="http://www.opengis.net/wps/1.0.0"/>"""
+        ows_req = OWSRequest(request)
+        assert ows_req.request == 'execute'
+
+    def test_post_invalid_xml(self):
+        request = DummyRequest(post={})
+        request.body = b"service=WPS&request=Execute"
+        with pytest.raises(OWSNoApplicableCode):
+            OWSRequest(request)
@@ -8,9 +8,11 @@ from twitcher.datatype import AccessToken
 from twitcher.datatype import Service
 from twitcher.utils import expires_at
 from twitcher.owssecurity import OWSSecurity
+from twitcher.tokengenerator import SignedTokenGenerator
 from twitcher.owsexceptions import OWSAccessForbidden
 from twitcher.store.memory import MemoryTokenStore
 from twitcher.store.memory import MemoryServiceStore
+from twitcher.metrics import Metrics
 
 
 class OWSSecurityTestCase(unittest.TestCase):
@@ -92,3 +94,56 @@ class OWSSecurityTestCase(unittest.TestCase):
         request.registry = Registry()
         request.registry.settings = {'twitcher.ows_prox_protected_path': '/ows'}
         security.check_request(request)
+
+    def test_check_request_metrics(self):
+        metrics = Metrics()
+        security = OWSSecurity(tokenstore=self.tokenstore, servicestore=self.servicestore, metrics=metrics)
+
+        params = dict(request="Execute", service="WPS", version="1.0.0", token="cdefg")
+        request = DummyRequest(params=params, path='/ows/proxy/test_wps')
+        request.registry = Registry()
+        request.registry.settings = {'twitcher.ows_prox_protected_path': '/ows'}
+        security.check_request(request)
+        params['token'] = 'xyz'
+        request = DummyRequest(params=params, path='/ows/proxy/test_wps')
+        request.registry = Registry()
+        request.registry.settings = {'twitcher.ows_prox_protected_path': '/ows'}
+        with pytest.raises(OWSAccessForbidden):
+            security.check_request(request)
+        text = metrics.render()
+        assert 'twitcher_token_validations_total{outcome="valid"} 1' in text
+        assert 'twitcher_token_validations_total{outcome="not_found"} 1' in text
+        assert 'twitcher_security_seconds_count{service="test_wps",request="execute"} 2' in text
+        assert 'twitcher_store_seconds_count{service="test_wps",store="token"} 2' in text
+
+    def test_check_request_signed_token(self):
+        generator = SignedTokenGenerator(keys={'k1': 'secret'})
+        access_token = generator.create_access_token()
+        # the token is not in the token store
+        security = OWSSecurity(tokenstore=self.empty_tokenstore, servicestore=self.servicestore,
+                               tokengenerator=generator)
+
+        params = dict(request="Execute", service="WPS", version="1.0.0", token=access_token.token)
+        request = DummyRequest(params=params, path='/ows/proxy/emu')
+        request.registry = Registry()
+        request.registry.settings = {'twitcher.ows_prox_protected_path': '/ows'}
+        security.check_request(request)
+
+        params['token'] = access_token.token[:-2] + 'xx'
+        request = DummyRequest(params=params, path='/ows/proxy/emu')
+        request.registry = Registry()
+        request.registry.settings = {'twitcher.ows_prox_protected_path': '/ows'}
+        with pytest.raises(OWSAccessForbidden):
+            security.check_request(request)
+
+
+def test_prepare_headers_with_cached_credentials():
+    access_token = AccessToken(token="abc", expires_at=expires_at(hours=1), data={'esgf_access_token': 'def'})
+    credentials = mock.Mock()
+    credentials.fetch.return_value = '/tmp/twitcher_xyz'
+    security = OWSSecurity(tokenstore=MemoryTokenStore(), servicestore=MemoryServiceStore(),
+                           credentials=credentials)
+    request = security.prepare_headers(DummyRequest(), access_token)
+    assert request.headers['X-Requested-Workdir'] == '/tmp/twitcher_xyz'
+    assert request.headers['X-X509-User-Proxy'] == '/tmp/twitcher_xyz/credentials.pem'
+    assert credentials.fetch.call_args[0][0] is access_token
@@ -0,0 +1,99 @@
+import io
+
+from pyramid.request import Request
+from pyramid.testing import DummyRequest
+
+from twitcher.requestbody import BodyStream, peek_body, spool_body, body_stream
+
+
+def _request(body, length=True):
+    environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/ows/proxy/emu', 'wsgi.input': io.BytesIO(body)}
+    if length:
+        environ['CONTENT_LENGTH'] = str(len(body))
+    else:
+        environ['wsgi.input_terminated'] = True
+    return Request(environ)
+
+
+def test_body_stream_peek_and_read():
+    stream = BodyStream(io.BytesIO(b'0123456789trailing'), 10)
+    assert stream.len == 10
+    assert stream.peek(4) == b'0123'
+    assert stream.peek(6) == b'012345'
+    assert stream.len == 10
+    assert stream.read(3) == b'012'
+    assert stream.read(5) == b'34567'
+    assert stream.len == 2
+    assert list(stream) == [b'89']
+    assert stream.read() == b''
+
+
+def test_body_stream_unknown_length():
+    stream = BodyStream(io.BytesIO(b'0123456789'))
+    assert stream.len is None
+    assert stream.peek(20) == b'0123456789'
+    assert stream.read() == b'0123456789'
+
+
+def test_body_stream_spool():
+    stream = BodyStream(io.BytesIO(b'0123456789'), 10)
+    stream.peek(2)
+    spool = stream.spool(max_memory=4)
+    assert spool.read() == b'0123456789'
+    spool.seek(0)
+    assert stream.len == 10
+    assert stream.read() == b'0123456789'
+
+
+def test_peek_body_does_not_consume_wsgi_input():
+    request = _request(b'<Execute/>' + b'x' * 100)
+    assert peek_body(request, 10) == b'<Execute/>'
+    data = body_stream(request)
+    assert isinstance(data, BodyStream)
+    assert data.len == 110
+    assert data.read() == b'<Execute/>' + b'x' * 100
+    assert request.environ.get('webob.is_body_seekable', False) is False
+
+
+def test_body_stream_chunked_input():
+    request = _request(b'<Execute/>', length=False)
+    assert peek_body(request, 4) == b'<Exe'
+    data = body_stream(request)
+    assert data.len is None
+    assert b''.join(data) == b'<Execute/>'
+
+
+def test_empty_input_terminated_body():
+    request = Request({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/ows/proxy/emu', 'wsgi.input': io.BytesIO(b''),
+                       'wsgi.input_terminated': True})
+    assert body_stream(request) is None
+
+
+def test_body_read_by_webob_after_peek():
+    request = _request(b'<Execute/>')
+    peek_body(request, 4)
+    assert request.body == b'<Execute/>'
+    assert body_stream(request) == b'<Execute/>'
+
+
+def test_spool_body():
+    request = _request(b'<Execute/>')
+    peek_body(request, 4)
+    spool = spool_body(request)
+    assert spool.read() == b'<Execute/>'
+    spool.seek(0)
+    assert body_stream(request).read() == b'<Execute/>'
+
+
+def test_empty_body():
+    request = _request(b'')
+    assert peek_body(request, 4) == b''
+    assert body_stream(request) is None
+
+
+def test_dummy_request():
+    request = DummyRequest(post={})
+    request.body = b'<Execute/>'
+    assert peek_body(request, 4) == b'<Exe'
+    assert spool_body(request).read() == b'<Execute/>'
+    assert body_stream(request) == b'<Execute/>'
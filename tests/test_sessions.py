@@ -0,0 +1,48 @@
+import mock
+from pyramid.testing import Registry
+
+from twitcher.sessions import SessionRegistry, get_sessionregistry
+
+
+def test_get_session_is_reused():
+    sessions = SessionRegistry(pool_maxsize=5)
+    session = sessions.get_session('emu')
+    assert sessions.get_session('emu') is session
+    assert sessions.get_session('hummingbird') is not session
+    assert session.get_adapter('http://localhost/wps')._pool_maxsize == 5
+
+
+def test_get_session_rebuilt_on_verify_change():
+    sessions = SessionRegistry()
+    session = sessions.get_session('emu', verify=True)
+    session.close = mock.Mock()
+    other = sessions.get_session('emu', verify=False)
+    assert other is not session
+    assert other.verify is False
+    assert sessions.get_session('emu', verify=False) is other
+    # still used by requests in progress
+    assert session.close.call_count == 0
+
+
+def test_remove_session():
+    sessions = SessionRegistry()
+    session = sessions.get_session('emu')
+    other = sessions.get_session('hummingbird')
+    sessions.remove_session('emu')
+    assert sessions.get_session('emu') is not session
+    assert sessions.get_session('hummingbird') is other
+    sessions.remove_session()
+    assert sessions.get_session('hummingbird') is not other
+
+
+def test_session_ignores_cookies():
+    session = SessionRegistry().get_session('emu')
+    assert session.cookies.get_policy().is_not_allowed('localhost') is True
+
+
+def test_get_sessionregistry_from_settings():
+    registry = Registry()
+    registry.settings = {'twitcher.ows_proxy_connect_timeout': '2.5', 'twitcher.ows_proxy_read_timeout': ''}
+    sessions = get_sessionregistry(registry)
+    assert get_sessionregistry(registry) is sessions
+    assert sessions.timeout == (2.5, None)
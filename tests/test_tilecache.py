@@ -0,0 +1,230 @@
+import io
+import os
+import time
+
+import mock
+import requests
+
+from pyramid import testing
+from pyramid.testing import DummyRequest, Registry
+
+from twitcher import owsproxy
+from twitcher.datatype import Service
+from twitcher.tilecache import TileCache, MappedFileIter, get_tilecache
+
+GETMAP = {'service': 'wms', 'request': 'getmap', 'layers': 'tas', 'bbox': '-90,-180,90,180',
+          'width': '256', 'height': '256', 'format': 'image/png'}
+
+PUBLIC_URL = 'https://localhost/ows/proxy/ncwms'
+
+
+def _store(cache, key, service, chunks, content_type='image/png'):
+    writer = cache.writer(key, service, content_type)
+    for chunk in chunks:
+        if not writer.write(chunk):
+            return False
+    writer.commit()
+    return True
+
+
+def _read(tile):
+    return b''.join(MappedFileIter(tile.fh, tile.offset, block_size=4))
+
+
+class TestTileCache(object):
+    def setup_method(self):
+        self.service = Service(url='http://localhost:8080/ncWMS2/wms', name='ncwms', type='wms')
+        self.now = [1000.0]
+        self.key = TileCache.key(self.service, dict(GETMAP, access_token='abc'), PUBLIC_URL)
+
+    def _cache(self, tmpdir, **kwargs):
+        return TileCache(str(tmpdir), clock=lambda: self.now[0], **kwargs)
+
+    def test_key_ignores_token(self):
+        assert TileCache.key(self.service, GETMAP, PUBLIC_URL) == self.key
+
+    def test_store_and_lookup(self, tmpdir):
+        cache = self._cache(tmpdir)
+        assert cache.lookup(self.key, self.service) is None
+        assert _store(cache, self.key, self.service, [b'PNG', b'DATA'])
+        tile = cache.lookup(self.key, self.service)
+        assert tile.content_type == 'image/png'
+        assert tile.size == 7
+        assert tile.fh.tell() == tile.offset
+        assert _read(tile) == b'PNGDATA'
+        # service was registered again with another url
+        other = Service(url='http://localhost:8081/ncWMS2/wms', name='ncwms', type='wms')
+        assert cache.lookup(self.key, other) is None
+        assert cache.currsize == 0
+
+    def test_expiry_and_service_ttl(self, tmpdir):
+        cache = self._cache(tmpdir, ttl=60)
+        _store(cache, self.key, self.service, [b'PNG'])
+        self.now[0] += 61
+        assert cache.lookup(self.key, self.service) is None
+        assert not os.path.exists(cache.path(self.key))
+        service = Service(url=self.service.url, name='ncwms', type='wms', tile_cache_ttl=600)
+        _store(cache, self.key, service, [b'PNG'])
+        self.now[0] += 61
+        assert cache.lookup(self.key, service) is not None
+        disabled = Service(url=self.service.url, name='ncwms', type='wms', tile_cache_ttl=0)
+        assert cache.writer(self.key, disabled, 'image/png') is None
+
+    def test_too_big(self, tmpdir):
+        cache = self._cache(tmpdir, max_entry_size=4)
+        assert _store(cache, self.key, self.service, [b'PNG', b'DATA']) is False
+        assert cache.lookup(self.key, self.service) is None
+        assert os.listdir(os.path.dirname(cache.path(self.key))) == []
+
+    def test_lru_eviction(self, tmpdir):
+        cache = self._cache(tmpdir, maxsize=400)
+        keys = [TileCache.key(self.service, dict(GETMAP, bbox=str(index)), PUBLIC_URL) for index in range(3)]
+        _store(cache, keys[0], self.service, [b'x' * 100])
+        _store(cache, keys[1], self.service, [b'x' * 100])
+        cache.lookup(keys[0], self.service).fh.close()
+        _store(cache, keys[2], self.service, [b'x' * 100])
+        assert not os.path.exists(cache.path(keys[1]))
+        assert os.path.exists(cache.path(keys[0]))
+        assert os.path.exists(cache.path(keys[2]))
+        assert cache.currsize <= 400
+
+    def test_index_is_filled_by_scan_thread(self, tmpdir):
+        _store(self._cache(tmpdir), self.key, self.service, [b'PNG'])
+        cache = self._cache(tmpdir, scan_interval=60)
+        assert cache.currsize == 0
+        with mock.patch.object(cache, '_rescan', wraps=cache._rescan) as rescan:
+            cache.ensure_started()
+            for _ in range(100):
+                if cache.currsize:
+                    break
+                time.sleep(0.01)
+            cache.stop()
+        assert rescan.call_count == 1
+        assert cache.currsize == os.path.getsize(cache.path(self.key))
+        tile = cache.lookup(self.key, self.service)
+        assert _read(tile) == b'PNG'
+
+    def test_purge(self, tmpdir):
+        cache = self._cache(tmpdir)
+        other = Service(url='http://localhost:8080/thredds/wms', name='thredds', type='wms')
+        other_key = TileCache.key(other, GETMAP, PUBLIC_URL)
+        _store(cache, self.key, self.service, [b'PNG'])
+        _store(cache, other_key, other, [b'PNG'])
+        assert cache.purge('ncwms') == 1
+        assert cache.lookup(self.key, self.service) is None
+        tile = cache.lookup(other_key, other)
+        assert _read(tile) == b'PNG'
+        tile.fh.close()
+        assert cache.purge() == 1
+        assert cache.lookup(other_key, other) is None
+        assert cache.currsize == 0
+
+    def test_limit_counts_tiles_of_other_workers(self, tmpdir):
+        cache = self._cache(tmpdir, maxsize=400, scan_interval=60)
+        other = self._cache(tmpdir, maxsize=400, scan_interval=60)
+        keys = [TileCache.key(self.service, dict(GETMAP, bbox=str(index)), PUBLIC_URL) for index in range(4)]
+        _store(other, keys[0], self.service, [b'x' * 100])
+        _store(other, keys[1], self.service, [b'x' * 100])
+        _store(cache, keys[2], self.service, [b'x' * 100])
+        assert cache.currsize < 400
+        cache._rescan()
+        _store(cache, keys[3], self.service, [b'x' * 100])
+        assert cache.currsize <= 400
+        assert not os.path.exists(cache.path(keys[0]))
+        assert all(os.path.exists(cache.path(key)) for key in keys[2:])
+
+    def test_service_directories(self, tmpdir):
+        cache = self._cache(tmpdir)
+        names = ['a.b', 'a_b', 'a-b', 'a/b', '']
+        directories = [os.path.dirname(os.path.dirname(cache.path((name, PUBLIC_URL, ())))) for name in names]
+        assert len(set(directories)) == len(names)
+        assert all(os.path.dirname(directory) == str(tmpdir) for directory in directories)
+
+
+def test_get_tilecache(tmpdir):
+    registry = Registry()
+    registry.settings = {}
+    assert get_tilecache(registry) is None
+    registry = Registry()
+    registry.settings = {'twitcher.ows_proxy_tile_cache': 'true',
+                         'twitcher.ows_proxy_tile_cache_dir': str(tmpdir),
+                         'twitcher.ows_proxy_tile_cache_ttl': '60'}
+    assert get_tilecache(registry).ttl == 60
+
+
+class TestSendTileRequest(object):
+    def setup_method(self):
+        self.config = testing.setUp()
+        self.config.add_route('owsproxy', '/ows/proxy/{service_name}')
+        self.service = Service(url='http://localhost:8080/ncWMS2/wms', name='ncwms', type='wms')
+
+    def teardown_method(self):
+        testing.tearDown()
+
+    def _send(self, cache, content_type='image/png', body=b'PNG' * 1000, environ=None):
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.headers['Content-Type'] = content_type
+        resp.headers['Content-Length'] = str(len(body))
+        resp.raw = io.BytesIO(body)
+        sessions = mock.Mock(timeout=(10, None))
+        sessions.get_session.return_value.request.return_value = resp
+        request = DummyRequest(params={'service': 'WMS', 'request': 'GetMap', 'layers': 'tas'},
+                               environ=environ or {})
+        key = owsproxy._tile_cache_key(request, self.service, cache)
+        with mock.patch('twitcher.owsproxy.get_sessionregistry', return_value=sessions):
+            response = owsproxy._send_tile_request(request, self.service, cache, key)
+        body = b''.join(response.app_iter)
+        response.app_iter.close()
+        return response, body, sessions.get_session.return_value.request.call_count
+
+    def test_tile_is_served_from_cache(self, tmpdir):
+        cache = TileCache(str(tmpdir))
+        response, body, calls = self._send(cache)
+        assert (body, calls) == (b'PNG' * 1000, 1)
+        response, body, calls = self._send(cache)
+        assert (body, calls) == (b'PNG' * 1000, 0)
+        assert isinstance(response.app_iter, MappedFileIter)
+        assert response.content_type == 'image/png'
+        assert response.content_length == 3000
+        text = self.config.registry.metrics.render()
+        assert 'twitcher_tile_cache_requests_total{service="ncwms",result="hit"} 1' in text
+
+    def test_tile_is_served_with_file_wrapper(self, tmpdir):
+        cache = TileCache(str(tmpdir))
+        self._send(cache)
+
+        class FileWrapper(object):
+            def __init__(self, fh, block_size):
+                self.fh = fh
+
+            def __iter__(self):
+                return iter(lambda: self.fh.read(1024), b'')
+
+            def close(self):
+                self.fh.close()
+        response, body, calls = self._send(cache, environ={'wsgi.file_wrapper': FileWrapper})
+        assert isinstance(response.app_iter, FileWrapper)
+        assert (body, calls) == (b'PNG' * 1000, 0)
+
+    def test_exception_is_not_cached(self, tmpdir):
+        cache = TileCache(str(tmpdir))
+        self._send(cache, content_type='text/xml', body=b'<ServiceExceptionReport/>')
+        response, body, calls = self._send(cache, content_type='text/xml', body=b'<ServiceExceptionReport/>')
+        assert calls == 1
+
+    def test_key(self, tmpdir):
+        cache = TileCache(str(tmpdir))
+        request = DummyRequest(params={'service': 'WMS', 'request': 'GetCapabilities'})
+        assert owsproxy._tile_cache_key(request, self.service, cache) is None
+        request = DummyRequest(params={'service': 'WMS', 'request': 'GetMap'}, headers={'Cookie': 'a=b'})
+        assert owsproxy._tile_cache_key(request, self.service, cache) is None
+        # the image of a delegated request depends on the credentials of the user
+        for name in ('X-X509-User-Proxy', 'X-Requested-Workdir'):
+            request = DummyRequest(params={'service': 'WMS', 'request': 'GetMap'}, headers={name: '/tmp/user'})
+            assert owsproxy._tile_cache_key(request, self.service, cache) is None
+        request = DummyRequest(params={'service': 'WMS', 'request': 'GetMap'})
+        assert owsproxy._tile_cache_key(request, self.service, cache) is not None
+        wps = Service(url='http://localhost:5000/wps', name='emu', type='wps')
+        request = DummyRequest(params={'service': 'WMS', 'request': 'GetMap'})
+        assert owsproxy._tile_cache_key(request, wps, cache) is None
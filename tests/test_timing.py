@@ -0,0 +1,61 @@
+import logging
+
+from pyramid.response import Response
+from pyramid.testing import DummyRequest, Registry
+
+from twitcher.timing import RequestTiming, record_timing, get_timing
+from twitcher.tweens import timing_tween_factory
+
+
+def test_request_timing():
+    timing = RequestTiming()
+    timing.add('parse', 0.001)
+    timing.add('body', 0.5)
+    timing.add('body', 0.25)
+    assert timing.server_timing() == 'parse;dur=1.000, body;dur=750.000'
+    assert timing.server_timing(total=1).endswith(', total;dur=1000.000')
+    assert timing.log_fields() == 'parse=0.001000 body=0.750000'
+
+
+def test_record_timing_without_tween():
+    request = DummyRequest()
+    record_timing(request, 'parse', 1)
+    assert get_timing(request) is None
+
+
+def _tween(settings, handler):
+    registry = Registry()
+    registry.settings = settings
+    return timing_tween_factory(handler, registry)
+
+
+def test_timing_tween_server_timing_header():
+    def handler(request):
+        record_timing(request, 'upstream', 0.002)
+        return Response(b'caps')
+
+    response = _tween({}, handler)(DummyRequest(path='/ows/proxy/emu'))
+    assert response.headers['Server-Timing'].startswith('upstream;dur=2.000, total;dur=')
+
+    response = _tween({}, handler)(DummyRequest(path='/'))
+    assert 'Server-Timing' not in response.headers
+
+
+def test_timing_tween_logs_slow_streamed_requests(caplog):
+    def handler(request):
+        def body():
+            yield b'caps'
+            record_timing(request, 'body', 2)
+        return Response(app_iter=body())
+
+    tween = _tween({'twitcher.timing_header': 'false', 'twitcher.timing_slow_threshold': '0'}, handler)
+    with caplog.at_level(logging.WARNING, logger='twitcher.tweens'):
+        response = tween(DummyRequest(path='/ows/proxy/emu/secret-token'))
+        assert 'Server-Timing' not in response.headers
+        assert list(response.app_iter) == [b'caps']
+        assert not caplog.records
+        response.app_iter.close()
+    message = caplog.records[0].getMessage()
+    assert message.startswith('slow request: method=GET')
+    assert 'body=2.000000' in message
+    assert 'secret-token' not in message
@@ -7,6 +7,8 @@ import unittest
 import mock
 
 from twitcher.tokengenerator import UuidTokenGenerator
+from twitcher.tokengenerator import SignedTokenGenerator, RevocationList
+from twitcher.exceptions import InvalidAccessToken
 
 
 class UuidTokenGeneratorTestCase(unittest.TestCase):
@@ -26,3 +28,79 @@ class UuidTokenGeneratorTestCase(unittest.TestCase):
         access_token = self.generator.create_access_token(valid_in_hours=2)
         assert len(access_token.token) == 32
         assert access_token.expires_in <= 3600 * 2
+
+
+class SignedTokenGeneratorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.revoked = RevocationList()
+        self.generator = SignedTokenGenerator(keys={'k1': 'secret'}, revoked=self.revoked)
+
+    def test_create_and_validate(self):
+        access_token = self.generator.create_access_token(valid_in_hours=2, data={'name': 'test'})
+        assert access_token.token.count('.') == 2
+        validated = self.generator.validate(access_token.token)
+        assert validated.token == access_token.token
+        assert validated.expires_at == access_token.expires_at
+        assert validated.data == {'name': 'test'}
+
+    def test_secret_data_is_not_embedded(self):
+        access_token = self.generator.create_access_token(data={'esgf_access_token': 'abc'})
+        assert 'abc' not in access_token.token
+        assert access_token.data == {'esgf_access_token': 'abc'}
+        # must be fetched from token store
+        assert self.generator.validate(access_token.token) is None
+
+    def test_uuid_token_is_not_validated(self):
+        assert self.generator.validate(UuidTokenGenerator().generate()) is None
+
+    def test_invalid_signature(self):
+        token = self.generator.create_access_token().token
+        other = SignedTokenGenerator(keys={'k1': 'other'})
+        with pytest.raises(InvalidAccessToken):
+            other.validate(token)
+        with pytest.raises(InvalidAccessToken):
+            self.generator.validate(token[:-2] + 'xx')
+        with pytest.raises(InvalidAccessToken):
+            self.generator.validate('a.b.c')
+
+    def test_key_rotation(self):
+        token = self.generator.create_access_token().token
+        rotated = SignedTokenGenerator(keys={'k1': 'secret', 'k2': 'new'}, kid='k2')
+        assert rotated.validate(token).token == token
+        new_token = rotated.create_access_token().token
+        with pytest.raises(InvalidAccessToken):
+            self.generator.validate(new_token)
+
+    def test_revoke(self):
+        token = self.generator.create_access_token().token
+        other = self.generator.create_access_token().token
+        self.generator.revoke(token)
+        with pytest.raises(InvalidAccessToken):
+            self.generator.validate(token)
+        assert self.generator.validate(other) is not None
+        self.generator.revoke_all()
+        with pytest.raises(InvalidAccessToken):
+            self.generator.validate(other)
+
+    def test_token_issued_after_revoke_all(self):
+        with mock.patch('time.time', return_value=1000.2):
+            before = self.generator.create_access_token().token
+        with mock.patch('time.time', return_value=1000.5):
+            self.generator.revoke_all()
+        # in the same second
+        with mock.patch('time.time', return_value=1000.7):
+            after = self.generator.create_access_token().token
+        with pytest.raises(InvalidAccessToken):
+            self.generator.validate(before)
+        assert self.generator.validate(after).token == after
+
+
+def test_revocation_list_refresh():
+    from datetime import datetime, timedelta
+    db = mock.MagicMock()
+    db.revoked_tokens.find.return_value = [{'_id': 'abc', 'expires': datetime.utcnow() + timedelta(hours=1)}]
+    db.counters.find_one.return_value = {'revoked_before': 100}
+    revoked = RevocationList(db=db, refresh_interval=0)
+    assert revoked.is_revoked('abc', 200) is True
+    assert revoked.is_revoked('xyz', 200) is False
+    assert revoked.is_revoked('xyz', 50) is True
@@ -80,3 +80,36 @@ def test_replace_caps_url_wms_130():
     xml = utils.replace_caps_url(xml, "https://localhost/ows/proxy/wms")
     # assert 'http://localhost:8080/ncWMS2/wms' not in xml
     assert b'https://localhost/ows/proxy/wms' in xml
+
+
+def _chunked(xml, size):
+    return (xml[i:i + size] for i in range(0, len(xml), size))
+
+
+@pytest.mark.parametrize('filename,url', [
+    (WPS_CAPS_EMU_XML, "https://localhost/ows/proxy/emu"),
+    (WMS_CAPS_NCWMS2_111_XML, "https://localhost/ows/proxy/wms"),
+    (WMS_CAPS_NCWMS2_130_XML, "https://localhost/ows/proxy/wms"),
+])
+def test_iter_replace_caps_url(filename, url):
+    with open(filename, 'rb') as fp:
+        xml = fp.read()
+    expected = etree.tostring(etree.fromstring(utils.replace_caps_url(xml, url)))
+    for size in (1, 100, 64 * 1024):
+        content = b''.join(utils.iter_replace_caps_url(_chunked(xml, size), url))
+        assert etree.tostring(etree.fromstring(content)) == expected
+
+
+def test_iter_replace_caps_url_wms_keeps_query():
+    xml = b'<WMT_MS_Capabilities><OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" ' \
+          b'xlink:href="http://localhost:8080/wms?REQUEST=GetLegendGraphic&amp;LAYERS=a"/></WMT_MS_Capabilities>'
+    content = b''.join(utils.iter_replace_caps_url(_chunked(xml, 10), "https://localhost/ows/proxy/wms"))
+    assert b'xlink:href="https://localhost/ows/proxy/wms?REQUEST=GetLegendGraphic&amp;LAYERS=a"' in content
+
+
+def test_iter_replace_caps_url_prev_url():
+    xml = b'<ExecuteResponse statusLocation="http://localhost:8094/wps/status.xml">' \
+          b'http://localhost:8094/wps/output.nc</ExecuteResponse>'
+    content = b''.join(utils.iter_replace_caps_url(
+        _chunked(xml, 5), "https://localhost/ows/proxy/emu", "http://localhost:8094/wps"))
+    assert content == xml.replace(b'http://localhost:8094/wps', b'https://localhost/ows/proxy/emu')
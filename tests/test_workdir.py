@@ -0,0 +1,69 @@
+import os
+import time
+import tempfile
+
+from pyramid.testing import DummyRequest, Registry
+
+from twitcher.workdir import WorkdirReaper, create_workdir, touch_workdir, get_workdirreaper
+
+
+def _request(workdir, settings=None):
+    request = DummyRequest()
+    request.registry = Registry()
+    request.registry.settings = dict(settings or {}, **{'twitcher.workdir': workdir, 'twitcher.workdir_reaper': False})
+    request.workdir = workdir
+    request.prefix = 'twitcher_'
+    return request
+
+
+def _create(request, age=0, expires_at=None, size=0):
+    workdir = create_workdir(request, expires_at=expires_at)
+    if size:
+        with open(os.path.join(workdir, 'credentials.pem'), 'wb') as fh:
+            fh.write(b'x' * size)
+    used = time.time() - age
+    os.utime(workdir, (used, used))
+    return workdir
+
+
+def test_reap_expired_and_old_workdirs():
+    base = tempfile.mkdtemp()
+    request = _request(base)
+    fresh = _create(request, expires_at=time.time() + 3600)
+    expired = _create(request, expires_at=time.time() - 1)
+    old = _create(request, age=7200)
+    unmarked = tempfile.mkdtemp(prefix='twitcher_', dir=base)
+    os.utime(unmarked, (0, 0))
+    reaper = WorkdirReaper(base, max_age=3600)
+    assert reaper.reap() == 2
+    assert os.path.isdir(fresh)
+    assert not os.path.exists(expired)
+    assert not os.path.exists(old)
+    assert os.path.isdir(unmarked)
+
+
+def test_reap_quota_removes_least_recently_used():
+    base = tempfile.mkdtemp()
+    request = _request(base)
+    workdirs = [_create(request, age=100 - i, size=1000) for i in range(5)]
+    assert WorkdirReaper(base, max_count=3).reap() == 2
+    assert [os.path.exists(workdir) for workdir in workdirs] == [False, False, True, True, True]
+    assert WorkdirReaper(base, max_bytes=2500).reap() == 1
+    assert [os.path.exists(workdir) for workdir in workdirs] == [False, False, False, True, True]
+
+
+def test_touch_workdir():
+    base = tempfile.mkdtemp()
+    workdir = _create(_request(base), age=7200)
+    assert touch_workdir(workdir) is True
+    assert WorkdirReaper(base, max_age=3600).reap() == 0
+    assert touch_workdir(os.path.join(base, 'missing')) is False
+
+
+def test_get_workdirreaper():
+    registry = Registry()
+    registry.settings = {'twitcher.workdir': '/tmp/twitcher', 'twitcher.workdir_max_count': '10'}
+    reaper = get_workdirreaper(registry)
+    assert get_workdirreaper(registry) is reaper
+    assert reaper.workdir == '/tmp/twitcher'
+    assert reaper.max_count == 10
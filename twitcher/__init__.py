@@ -11,9 +11,11 @@ def main(global_config, **settings):
 
     # include twitcher components
     config.include('twitcher.config')
+    config.include('twitcher.db')
     config.include('twitcher.frontpage')
     config.include('twitcher.rpcinterface')
     config.include('twitcher.owsproxy')
+    config.include('twitcher.metrics')
 
     # tweens/middleware
     # TODO: maybe add tween for exception handling or use unknown_failure view
@@ -1,11 +1,12 @@
 from twitcher.datatype import Service
+from twitcher.balancer import STRATEGIES
 
 import logging
 LOGGER = logging.getLogger("TWITCHER")
 
 
 class ITokenManager(object):
-    def generate_token(self, valid_in_hours=1, data=None):
+    def generate_token(self, valid_in_hours=1, data=None, fetch_credentials=False):
         """
         Generates an access token which is valid for ``valid_in_hours``.
 
@@ -13,6 +14,7 @@ class ITokenManager(object):
 
         * :param valid_in_hours: an int with number of hours the token is valid.
         * :param data: a dict with extra data used with this token.
+        * :param fetch_credentials: if true, the ESGF credentials are fetched now and stored with the token.
 
         Possible keys: ``esgf_access_token``, ``esgf_slcs_service_url`` or ``esgf_credentials``.
         """
@@ -30,12 +32,19 @@ class ITokenManager(object):
         """
         raise NotImplementedError
 
+    def purge_expired_tokens(self):
+        """
+        Removes all expired tokens from tokenstore and returns their number.
+        """
+        raise NotImplementedError
+
 
 class IRegistry(object):
     def register_service(self, url, data, overwrite):
         """
         Adds an OWS service with the given ``url`` to the service store.
 
+        :param url: the service url or a list of backend urls of the service.
         :param data: a dict with additional information like ``name``.
         """
         raise NotImplementedError
@@ -70,21 +79,38 @@ class IRegistry(object):
         """
         raise NotImplementedError
 
+    def list_breakers(self):
+        """
+        Lists the circuit breakers of the services with their state (closed, open, half_open).
+        """
+        raise NotImplementedError
+
+    def purge_tile_cache(self, name=''):
+        """
+        Removes the cached WMS tiles of service ``name`` or of all services when no name is given.
+        Returns the number of removed tiles.
+        """
+        raise NotImplementedError
+
 
 class TokenManager(ITokenManager):
     """
     Implementation of :class:`twitcher.api.ITokenManager`.
     """
 
-    def __init__(self, tokengenerator, tokenstore):
+    def __init__(self, tokengenerator, tokenstore, credentials_fetcher=None):
         self.tokengenerator = tokengenerator
         self.store = tokenstore
+        self.credentials_fetcher = credentials_fetcher
 
-    def generate_token(self, valid_in_hours=1, data=None):
+    def generate_token(self, valid_in_hours=1, data=None, fetch_credentials=False):
         """
         Implementation of :meth:`twitcher.api.ITokenManager.generate_token`.
         """
-        data = data or {}
+        data = dict(data or {})
+        if fetch_credentials and self.credentials_fetcher is not None:
+            # stored with the token, the proxy only writes them to the workdir
+            data.update(self.credentials_fetcher.fetch(data))
         access_token = self.tokengenerator.create_access_token(
             valid_in_hours=valid_in_hours,
             data=data,
@@ -97,6 +123,7 @@ class TokenManager(ITokenManager):
         Implementation of :meth:`twitcher.api.ITokenManager.revoke_token`.
         """
         try:
+            self.tokengenerator.revoke(token)
             self.store.delete_token(token)
         except Exception:
             LOGGER.exception('Failed to remove token.')
@@ -109,6 +136,7 @@ class TokenManager(ITokenManager):
         Implementation of :meth:`twitcher.api.ITokenManager.revoke_all_tokens`.
         """
         try:
+            self.tokengenerator.revoke_all()
             self.store.clear_tokens()
         except Exception:
             LOGGER.exception('Failed to remove tokens.')
@@ -116,13 +144,38 @@ class TokenManager(ITokenManager):
         else:
             return True
 
+    def purge_expired_tokens(self):
+        """
+        Implementation of :meth:`twitcher.api.ITokenManager.purge_expired_tokens`.
+        """
+        try:
+            count = self.store.purge_expired_tokens()
+        except Exception:
+            LOGGER.exception('Failed to purge expired tokens.')
+            return -1
+        else:
+            return count
+
 
 class Registry(IRegistry):
     """
     Implementation of :class:`twitcher.api.IRegistry`.
     """
-    def __init__(self, servicestore):
+    def __init__(self, servicestore, listeners=None, breakers=None, tilecache=None):
         self.store = servicestore
+        self.listeners = listeners or []
+        self.breakers = breakers
+        self.tilecache = tilecache
+
+    def _notify(self, name=None):
+        """
+        Calls the listeners with the name of the changed service (``None`` when all services changed).
+        """
+        for listener in self.listeners:
+            try:
+                listener(name)
+            except Exception:
+                LOGGER.exception('Service change listener failed.')
 
     def register_service(self, url, data=None, overwrite=True):
         """
@@ -131,9 +184,18 @@ class Registry(IRegistry):
         data = data or {}
 
         args = dict(data)
-        args['url'] = url
+        if isinstance(url, (list, tuple)):
+            # several backends of one service
+            args['url'] = url[0]
+            args['urls'] = list(url)
+        else:
+            args['url'] = url
         service = Service(**args)
+        if service.balance not in STRATEGIES:
+            raise ValueError("unknown balance strategy {}, use one of {}.".format(
+                service.balance, ', '.join(STRATEGIES)))
         service = self.store.save_service(service, overwrite=overwrite)
+        self._notify(service.name)
         return service.params
 
     def unregister_service(self, name):
@@ -146,6 +208,7 @@ class Registry(IRegistry):
             LOGGER.exception('unregister failed')
             return False
         else:
+            self._notify(name)
             return True
 
     def get_service_by_name(self, name):
@@ -194,4 +257,21 @@ class Registry(IRegistry):
             LOGGER.error('Clear services failed.')
             return False
         else:
+            self._notify()
             return True
+
+    def list_breakers(self):
+        """
+        Implementation of :meth:`twitcher.api.IRegistry.list_breakers`.
+        """
+        if self.breakers is None:
+            return []
+        return self.breakers.list_status()
+
+    def purge_tile_cache(self, name=''):
+        """
+        Implementation of :meth:`twitcher.api.IRegistry.purge_tile_cache`.
+        """
+        if self.tilecache is None:
+            return 0
+        return self.tilecache.purge(name or None)
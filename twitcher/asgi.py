@@ -0,0 +1,528 @@
+"""
+Asynchronous OWS proxy served as an ASGI application.
+
+The WSGI proxy keeps a worker thread busy for the whole duration of an upstream request,
+so a few slow WPS Execute requests can starve all other traffic.
+:class:`AsyncOWSProxy` serves the same ``{protected_path}/proxy`` routes on an asyncio event loop:
+upstream requests use a pooled :mod:`aiohttp` client, request and response bodies are streamed
+chunk by chunk and the (mostly cached) token and service lookups run in a small thread pool.
+The security checks in the thread pool read the start of a request body from ``wsgi.input``,
+which receives the ASGI messages on the event loop.
+
+Like the WSGI proxy, requests pass the circuit breakers and the concurrency limits of the services,
+expired documents of the capabilities cache are revalidated and the upstream metrics are recorded.
+A request waiting for a concurrency slot waits in the thread pool. Identical requests are not coalesced,
+WMS tiles are not cached, no ``Server-Timing`` header is sent and failed requests are not sent again
+to another backend.
+
+It needs the ``aiohttp`` package and an ASGI server, for example::
+
+    $ pip install aiohttp uvicorn
+    $ TWITCHER_INI_FILE=development.ini uvicorn --factory twitcher.asgi:main
+
+The XML-RPC interface and the frontpage are not served, run the WSGI application for these.
+"""
+
+import os
+import ssl
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from pyramid.config import Configurator
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.interfaces import IRequestExtensions
+from pyramid.request import Request, apply_request_extensions
+from pyramid.settings import asbool
+
+from twitcher.owsexceptions import OWSException, OWSAccessForbidden, OWSAccessFailed, OWSNoApplicableCode, \
+    OWSServerBusy
+from twitcher.exceptions import ServiceBusy
+from twitcher.owsproxy import allowed_content_types, _caps_cache_key, _cached_response, _public_url, needs_url_rewrite
+from twitcher.owsproxy import validator_headers, _conditional_headers, _is_backend_failure
+from twitcher.owssecurity import owssecurity_factory
+from twitcher.sessions import _float_or_none
+from twitcher.store import servicestore_factory
+from twitcher.store.cached import fetch_service_by_name
+from twitcher.cache import get_capscache
+from twitcher.balancer import get_balancers
+from twitcher.breaker import get_breakers
+from twitcher.limits import get_bulkheads, Slot
+from twitcher.metrics import get_metrics, request_labels
+from twitcher.requestbody import BodyStream, body_stream
+from twitcher.utils import _CapsUrlRewriter
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# Headers meaningful only for a single transport-level connection
+HOP_BY_HOP = frozenset(['connection', 'keep-alive', 'public', 'proxy-authenticate', 'transfer-encoding', 'upgrade'])
+
+
+class UpstreamResponse(object):
+    """
+    A streamed response of a service. ``chunks`` is an async iterator of the body.
+    The ``slot`` of the request, with its concurrency slots and backend lease, is released with the response.
+    """
+    def __init__(self, resp, status, headers, chunks):
+        self.resp = resp
+        self.status = status
+        self.headers = headers
+        self.chunks = chunks
+        self.slot = None
+
+    def close(self):
+        self.resp.release()
+        if self.slot is not None:
+            self.slot.release()
+
+
+async def _iter_rewritten(resp, url, prev_url):
+    rewriter = _CapsUrlRewriter(url, prev_url)
+    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+        data = rewriter.feed(chunk)
+        if data:
+            yield data
+    data = rewriter.close()
+    if data:
+        yield data
+
+
+async def _iter_caching(chunks, cache, key, service, status, headers):
+    # passes the chunks through and stores the complete body in the capabilities cache.
+    parts = []
+    size = 0
+    async for chunk in chunks:
+        if parts is not None:
+            size += len(chunk)
+            if size > cache.max_entry_size:
+                parts = None
+            else:
+                parts.append(chunk)
+        yield chunk
+    if parts is not None:
+        cache.store(key, service, b''.join(parts), status=status,
+                    content_type=headers.get('Content-Type'),
+                    etag=headers.get('ETag'),
+                    last_modified=headers.get('Last-Modified'))
+
+
+class ReceiveStream(object):
+    """
+    The body of an ASGI request. :meth:`read_async` is awaited on the event loop, :meth:`read`
+    is the ``wsgi.input`` of the request and may only be called from another thread.
+    """
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self._buffer = b''
+        self._more = True
+
+    async def read_async(self, size=-1):
+        while self._more and (size < 0 or len(self._buffer) < size):
+            message = await self.receive()
+            if message['type'] == 'http.disconnect':
+                self._more = False
+                break
+            self._buffer += message.get('body', b'')
+            self._more = message.get('more_body', False)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def read(self, size=-1):
+        return asyncio.run_coroutine_threadsafe(self.read_async(size), self.loop).result()
+
+
+class AsyncOWSProxy(object):
+    """
+    ASGI application proxying the OWS requests of the registered services.
+    """
+
+    def __init__(self, registry):
+        if aiohttp is None:
+            raise ImportError("The async OWS proxy needs the aiohttp package.")
+        settings = registry.settings
+        self.registry = registry
+        self.protected_path = settings.get('twitcher.ows_proxy_protected_path', '/ows')
+        self.security = None
+        if asbool(settings.get('twitcher.ows_security', True)):
+            self.security = owssecurity_factory(registry)
+        self.servicestore = servicestore_factory(registry)
+        self.capscache = get_capscache(registry)
+        self.breakers = get_breakers(registry)
+        self.bulkheads = get_bulkheads(registry)
+        self.metrics = get_metrics(registry)
+        self.extensions = registry.queryUtility(IRequestExtensions)
+        self.limit = int(settings.get('twitcher.async_proxy_limit', 0))
+        self.limit_per_host = int(settings.get('twitcher.async_proxy_limit_per_host', 0))
+        self.timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=_float_or_none(settings.get('twitcher.ows_proxy_connect_timeout', 10)),
+            sock_read=_float_or_none(settings.get('twitcher.ows_proxy_read_timeout')))
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(settings.get('twitcher.async_proxy_executor_workers', 16)),
+            thread_name_prefix='twitcher-async')
+        self._session = None
+        self._ssl_contexts = {}
+
+    @property
+    def session(self):
+        # the client session is bound to the running event loop, create it on first use.
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                auto_decompress=False,
+                # sessions are shared by all users, never keep cookies set by a backend.
+                cookie_jar=aiohttp.DummyCookieJar())
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self.executor.shutdown(wait=False)
+
+    def _ssl(self, verify):
+        if verify is True:
+            return None
+        if not verify:
+            return False
+        context = self._ssl_contexts.get(verify)
+        if context is None:
+            context = self._ssl_contexts[verify] = ssl.create_default_context(cafile=verify)
+        return context
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            request = self.make_request(scope, ReceiveStream(receive, asyncio.get_running_loop()))
+            response = await self.handle(request)
+            await self._send_response(send, request, response)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def make_request(self, scope, body):
+        """
+        Creates a :class:`pyramid.request.Request` for the ASGI ``scope``. ``body`` is a :class:`ReceiveStream`
+        or the body as bytes.
+        """
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'],
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1] or 80),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            # the end of the body is known without a content length
+            'wsgi.input_terminated': True,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            if name in environ:
+                value = environ[name] + ',' + value
+            environ[name] = value
+        request = Request(environ)
+        if isinstance(body, bytes):
+            request.body = body
+        request.registry = self.registry
+        if self.extensions is not None:
+            apply_request_extensions(request, extensions=self.extensions)
+        return request
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def handle(self, request):
+        """
+        Proxies the request. Returns an :class:`UpstreamResponse` or a :class:`pyramid.response.Response`.
+        """
+        prefix = self.protected_path + '/proxy/'
+        if not request.path_info.startswith(prefix):
+            return HTTPNotFound()
+        self.metrics.ensure_started()
+        service_name, _, extra_path = request.path_info[len(prefix):].partition('/')
+        try:
+            if self.security is not None:
+                await self._run(self.security.check_request, request)
+        except OWSException as err:
+            LOGGER.exception("security check failed.")
+            return err
+        except Exception as err:
+            LOGGER.exception("unknown error")
+            return OWSNoApplicableCode("{}".format(err))
+        try:
+            service = await self._run(fetch_service_by_name, request, self.servicestore, service_name)
+        except Exception as err:
+            return OWSAccessFailed("Could not find service {0} : {1}.".format(service_name, err))
+        if self.capscache is not None and not extra_path:
+            key = _caps_cache_key(request, service, self.capscache)
+            if key is not None:
+                return await self._send_cached_request(request, service, key)
+        return await self.send_request(request, service, extra_path, request_params=request.query_string)
+
+    async def _send_cached_request(self, request, service, key):
+        # fresh documents are served from the cache, expired ones are revalidated, others are fetched and stored.
+        cached, fresh = self.capscache.lookup(key, service)
+        if fresh:
+            LOGGER.debug('Serving %s from capabilities cache.', key[1])
+            return _cached_response(cached)
+        extra_headers = _conditional_headers(cached)
+        response = await self.send_request(request, service, request_params=request.query_string,
+                                           extra_headers=extra_headers)
+        if not isinstance(response, UpstreamResponse):
+            return response
+        if extra_headers and response.status == 304:
+            # releases the connection, the concurrency slot and the backend lease
+            response.close()
+            self.capscache.revalidated(key, service)
+            return _cached_response(cached)
+        if response.status == 200:
+            response.chunks = _iter_caching(
+                response.chunks, self.capscache, key, service, response.status, response.headers)
+        return response
+
+    async def send_request(self, request, service, extra_path=None, request_params=None, extra_headers=None):
+        """
+        Sends the request to the service within its concurrency limits, unless its circuit breaker is open.
+        Mirrors :func:`twitcher.owsproxy._send_request`.
+
+        A service with several backend urls is sent to the backend chosen by its balancer.
+        Failed requests are not sent again to another backend, the body is streamed only once.
+        """
+        breaker = trial = None
+        if self.breakers is not None:
+            breaker = self.breakers.get(service.name)
+            trial = breaker.allow()
+            if not trial:
+                self.metrics.upstream_rejected.labels(service=service.name, reason='circuit_open').inc()
+                return OWSServerBusy("Service {} is unavailable, try again later.".format(service.name))
+        try:
+            # a full bulkhead is waited for in the thread pool
+            slot = await self._run(self.bulkheads.acquire, service, request_labels(request)['request'])
+        except ServiceBusy as e:
+            self.metrics.upstream_rejected.labels(service=service.name, reason=e.reason).inc()
+            LOGGER.warning("Service %s is busy: %s", service.name, e)
+            return OWSServerBusy("Service {} is busy: {}".format(service.name, e))
+        # the concurrency slot and the backend lease of the request
+        held = [slot] if slot is not None else []
+        backend_url = service.url
+        if len(service.urls) > 1:
+            balancers = get_balancers(self.registry)
+            balancers.ensure_started()
+            lease = balancers.get(service).choose()
+            if lease is not None:
+                backend_url = lease.endpoint.url
+                held.append(lease)
+        try:
+            response = await self._send_to_backend(request, service, backend_url, extra_path, request_params,
+                                                   extra_headers, breaker, trial)
+        except BaseException:
+            Slot(held).release()
+            raise
+        if isinstance(response, UpstreamResponse):
+            # the slot is held until the response body is sent
+            response.slot = Slot(held)
+        else:
+            Slot(held).release()
+        return response
+
+    async def _send_to_backend(self, request, service, backend_url, extra_path=None, request_params=None,
+                               extra_headers=None, breaker=None, trial=None):
+        url = backend_url
+        if extra_path:
+            url += '/' + extra_path
+        if request_params:
+            url += '?' + request_params
+        LOGGER.debug('url = %s', url)
+
+        # forward request to target (without Host Header)
+        h = dict(request.headers)
+        h.pop("Host", None)
+        h.pop("Accept-Encoding", None)
+        # the body is sent with its length or chunked by aiohttp
+        h.pop("Transfer-Encoding", None)
+        if extra_headers:
+            h.update(extra_headers)
+        # may read the start of the body, which waits for the event loop
+        data = await self._run(body_stream, request)
+        if data is not None:
+            # unknown for chunked request bodies
+            sent = len(data) if isinstance(data, bytes) else data.len
+            if sent:
+                self.metrics.upstream_sent_bytes.labels(service=service.name).inc(sent)
+        if isinstance(data, BodyStream):
+            data = self._iter_body(data)
+        start = time.perf_counter()
+        try:
+            resp = await self.session.request(
+                request.method.upper(), url, data=data, headers=h,
+                ssl=self._ssl(service.verify), skip_auto_headers=('Accept-Encoding',))
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            self._record(request, service, 'error', time.perf_counter() - start, True, breaker, trial)
+            return OWSAccessFailed("Request failed: {}".format(e or type(e).__name__))
+        elapsed = time.perf_counter() - start
+
+        ct = resp.headers.get('Content-Type')
+        error_body = None
+        if resp.status >= 400 and (resp.status >= 500 or service['type'].lower() == 'wps'):
+            # error documents are small, the body is kept for the client
+            error_body = await resp.read()
+        failed = _is_backend_failure(resp.status, ct, lambda: error_body)
+        self._record(request, service, resp.status, elapsed, failed, breaker, trial)
+
+        service_type = service['type']
+        if service_type and (service_type.lower() != 'wps'):
+            headers = {k: v for k, v in resp.headers.items() if k.lower() not in HOP_BY_HOP}
+            chunks = resp.content.iter_chunked(CHUNK_SIZE) if error_body is None else _iter_bytes(error_body)
+            return UpstreamResponse(resp, resp.status, headers, chunks)
+
+        if error_body is not None:
+            if b'ExceptionReport' not in error_body:
+                resp.release()
+                return OWSAccessFailed("Response is not ok: {}".format(resp.reason))
+
+        # check for allowed content types
+        if ct is not None:
+            if not ct.split(";")[0] in allowed_content_types:
+                resp.release()
+                msg = "Content type is not allowed: {}.".format(ct)
+                LOGGER.error(msg)
+                return OWSAccessForbidden(msg)
+        else:
+            LOGGER.warning("Could not get content type from response")
+
+        headers = {}
+        if ct:
+            headers['Content-Type'] = ct
+        for name in validator_headers:
+            if name in resp.headers:
+                headers[name] = resp.headers[name]
+        if error_body is not None:
+            chunks = _iter_bytes(error_body)
+        elif needs_url_rewrite(ct):
+            # replace urls in xml content
+            public_url = _public_url(request, service)
+            chunks = _iter_rewritten(resp, public_url, backend_url)
+        else:
+            # raw content is passed through as it arrives
+            if 'Content-Length' in resp.headers:
+                headers['Content-Length'] = resp.headers['Content-Length']
+            chunks = resp.content.iter_chunked(CHUNK_SIZE)
+        return UpstreamResponse(resp, resp.status, headers, chunks)
+
+    def _record(self, request, service, status, elapsed, failed, breaker, trial):
+        labels = dict(request_labels(request), service=service.name)
+        self.metrics.upstream_seconds.labels(**labels).observe(elapsed)
+        self.metrics.upstream_responses.labels(service=service.name, status=status).inc()
+        if breaker is not None:
+            breaker.record(failed, elapsed, trial=trial)
+
+    async def _iter_body(self, stream):
+        """
+        Yields the request body: the start read by the security checks, then the ASGI messages.
+        """
+        data = stream.read_buffered()
+        if data:
+            yield data
+        if isinstance(stream.stream, ReceiveStream):
+            while True:
+                chunk = await stream.stream.read_async(CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+        else:
+            # spooled by the security checks
+            while True:
+                chunk = await self._run(stream.read, CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def _send_response(self, send, request, response):
+        if isinstance(response, UpstreamResponse):
+            await self._send_upstream_response(send, response)
+            return
+        # webob responses, e.g. OWS exceptions or cached documents
+        captured = []
+
+        def start_response(status, headerlist, exc_info=None):
+            captured[:] = [status, headerlist]
+
+        body = b''.join(response(request.environ, start_response))
+        status, headerlist = captured
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headerlist],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _send_upstream_response(self, send, response):
+        headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in response.headers.items()]
+        try:
+            await send({'type': 'http.response.start', 'status': response.status, 'headers': headers})
+            async for chunk in response.chunks:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            # the response has started, the client notices the truncated body.
+            LOGGER.warning("Streaming response failed: %s", err)
+        finally:
+            response.close()
+
+
+async def _iter_bytes(data):
+    yield data
+
+
+def make_asgi_app(settings):
+    """
+    Creates the :class:`AsyncOWSProxy` application configured with ``settings``.
+    """
+    config = Configurator(settings=settings)
+    config.include('twitcher.config')
+    config.include('twitcher.db')
+    # used to build the public url of the services
+    protected_path = settings.get('twitcher.ows_proxy_protected_path', '/ows')
+    config.add_route('owsproxy', protected_path + '/proxy/{service_name}')
+    config.commit()
+    return AsyncOWSProxy(config.registry)
+
+
+def main():
+    """
+    ASGI application factory, configured with the ``[app:main]`` section of the
+    paste ini file given by the ``TWITCHER_INI_FILE`` environment variable.
+    """
+    from pyramid.paster import get_appsettings, setup_logging
+    config_uri = os.environ.get('TWITCHER_INI_FILE', 'development.ini')
+    setup_logging(config_uri)
+    return make_asgi_app(get_appsettings(config_uri))
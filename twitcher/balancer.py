@@ -0,0 +1,247 @@
+"""
+Load balancing of services with several backend urls.
+
+A service registered with several ``urls`` has a :class:`Balancer` choosing the backend of each request
+with the ``balance`` strategy of the service:
+
+* ``round_robin``: the backends in turn.
+* ``least_outstanding``: the backend with the fewest requests in progress.
+* ``weighted``: smooth weighted round robin with the ``weights`` of the service.
+
+A background thread checks the backends every ``twitcher.ows_proxy_health_interval`` seconds with
+a GetCapabilities request. A backend failing ``twitcher.ows_proxy_health_failures`` checks in a row
+is taken out of rotation until a check succeeds again. When no backend is healthy all of them are used.
+An interval of 0 disables the health checks. The balancer of a changed or unregistered service is dropped
+and the thread stops when no balancer is left.
+"""
+
+import os
+import threading
+
+import requests
+
+import logging
+LOGGER = logging.getLogger("TWITCHER")
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+WEIGHTED = 'weighted'
+
+STRATEGIES = (ROUND_ROBIN, LEAST_OUTSTANDING, WEIGHTED)
+
+
+class Endpoint(object):
+    """
+    A backend url of a service.
+    """
+
+    def __init__(self, url, weight=1):
+        self.url = url
+        self.weight = weight
+        # requests in progress
+        self.outstanding = 0
+        self.healthy = True
+        # failed health checks in a row
+        self.failures = 0
+        # weight of the smooth weighted round robin
+        self.current_weight = 0
+
+
+class Lease(object):
+    """
+    A request in progress on ``endpoint``. :meth:`release` may be called more than once.
+    """
+
+    def __init__(self, balancer, endpoint):
+        self.balancer = balancer
+        self.endpoint = endpoint
+        self._released = False
+
+    def release(self):
+        with self.balancer._lock:
+            if not self._released:
+                self._released = True
+                self.endpoint.outstanding -= 1
+
+
+class Balancer(object):
+    """
+    Chooses the backend of a request with the ``round_robin``, ``least_outstanding`` or ``weighted`` strategy.
+    """
+
+    def __init__(self, endpoints, strategy=ROUND_ROBIN):
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _candidates(self, exclude):
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.url not in exclude]
+        return [endpoint for endpoint in candidates if endpoint.healthy] or candidates
+
+    def _weighted(self, candidates):
+        total = 0
+        best = None
+        for endpoint in candidates:
+            endpoint.current_weight += endpoint.weight
+            total += endpoint.weight
+            if best is None or endpoint.current_weight > best.current_weight:
+                best = endpoint
+        best.current_weight -= total
+        return best
+
+    def choose(self, exclude=()):
+        """
+        Returns the :class:`Lease` of the backend chosen for a request or ``None`` when all backends
+        are in ``exclude``. The lease is released when the request is done.
+        """
+        with self._lock:
+            candidates = self._candidates(exclude)
+            if not candidates:
+                return None
+            if self.strategy == WEIGHTED:
+                endpoint = self._weighted(candidates)
+            else:
+                start = self._next % len(candidates)
+                self._next += 1
+                # ties of least_outstanding are taken in turn
+                rotated = candidates[start:] + candidates[:start]
+                if self.strategy == LEAST_OUTSTANDING:
+                    endpoint = min(rotated, key=lambda endpoint: endpoint.outstanding)
+                else:
+                    endpoint = rotated[0]
+            endpoint.outstanding += 1
+            return Lease(self, endpoint)
+
+
+class BalancerRegistry(object):
+    """
+    Balancers of the services with several backend urls keyed by service name.
+    The balancer of a service is rebuilt when its urls, strategy or weights change.
+    """
+
+    def __init__(self, health_interval=10, health_timeout=5, health_failures=2):
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.health_failures = health_failures
+        self._balancers = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stopped = threading.Event()
+
+    def get(self, service):
+        """
+        Returns the :class:`Balancer` of ``service``.
+        """
+        key = (tuple(service.urls), service.balance, tuple(service.weights))
+        entry = self._balancers.get(service.name)
+        if entry is None or entry[0] != key:
+            with self._lock:
+                entry = self._balancers.get(service.name)
+                if entry is None or entry[0] != key:
+                    endpoints = [Endpoint(url, weight) for url, weight in zip(service.urls, service.weights)]
+                    entry = self._balancers[service.name] = (key, Balancer(endpoints, service.balance), service)
+        return entry[1]
+
+    def remove(self, name=None):
+        """
+        Drops the balancer of service ``name``, or of all services when no name is given.
+        Leases of requests in progress are still released to the dropped balancer.
+        """
+        with self._lock:
+            if name is None:
+                self._balancers.clear()
+            else:
+                self._balancers.pop(name, None)
+            if not self._balancers and self._pid is not None:
+                # started again by the next service with several urls
+                self._stopped.set()
+                self._stopped = threading.Event()
+                self._pid = None
+
+    def ensure_started(self):
+        """
+        Starts the health check thread of this process, unless health checks are disabled.
+        """
+        if self.health_interval <= 0:
+            return
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._stopped.clear()
+                    thread = threading.Thread(target=self.run, args=(self._stopped,), name='twitcher-health-checks')
+                    thread.daemon = True
+                    thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self, stopped=None):
+        stopped = stopped or self._stopped
+        session = requests.Session()
+        while not stopped.wait(self.health_interval):
+            try:
+                self.check_all(session)
+            except Exception:
+                LOGGER.exception("Health checks failed.")
+
+    def check_all(self, session):
+        for _, balancer, service in list(self._balancers.values()):
+            for endpoint in balancer.endpoints:
+                self.record(service, endpoint, self.check(session, service, endpoint))
+
+    def check(self, session, service, endpoint):
+        """
+        Returns true when the backend answers a GetCapabilities request without a server error.
+        """
+        params = {'service': service.type.upper(), 'request': 'GetCapabilities'}
+        try:
+            resp = session.get(endpoint.url, params=params, timeout=self.health_timeout, stream=True,
+                               verify=service.verify)
+        except Exception as e:
+            LOGGER.debug("Health check of %s failed: %s", endpoint.url, e)
+            return False
+        # the document is not needed
+        resp.close()
+        return resp.status_code < 500
+
+    def record(self, service, endpoint, healthy):
+        if healthy:
+            endpoint.failures = 0
+            if not endpoint.healthy:
+                LOGGER.info("Backend %s of service %s is healthy again.", endpoint.url, service.name)
+                endpoint.healthy = True
+        else:
+            endpoint.failures += 1
+            if endpoint.healthy and endpoint.failures >= self.health_failures:
+                LOGGER.warning("Backend %s of service %s is taken out of rotation.", endpoint.url, service.name)
+                endpoint.healthy = False
+
+
+def balancers_factory(registry):
+    """
+    Creates a :class:`BalancerRegistry` configured with the ``twitcher.ows_proxy_health_*`` settings.
+    """
+    settings = registry.settings or {}
+    return BalancerRegistry(
+        health_interval=float(settings.get('twitcher.ows_proxy_health_interval', 10)),
+        health_timeout=float(settings.get('twitcher.ows_proxy_health_timeout', 5)),
+        health_failures=int(settings.get('twitcher.ows_proxy_health_failures', 2)),
+    )
+
+
+_lock = threading.Lock()
+
+
+def get_balancers(registry):
+    """
+    Returns the :class:`BalancerRegistry` shared by this process.
+    """
+    try:
+        return registry.balancers
+    except AttributeError:
+        with _lock:
+            if not hasattr(registry, 'balancers'):
+                registry.balancers = balancers_factory(registry)
+        return registry.balancers
@@ -0,0 +1,200 @@
+"""
+Circuit breakers of the registered services.
+
+The breaker of a service counts the failed requests, i.e. connection errors, timeouts, 5xx responses
+which are not OWS exception reports and responses slower than ``slow_threshold`` seconds, in a rolling
+window of ``window`` seconds. Exception reports and 4xx responses are answers to bad client requests.
+When at least ``min_requests`` requests have been sent in the window and the error rate reaches
+``error_rate`` the breaker opens: requests to the service fail at once instead of waiting for
+a connect timeout. After ``open_seconds`` the breaker is half-open and lets a single trial request
+through. The breaker closes when the trial succeeds and opens again when it fails. Only the outcome of
+the trial request counts, the ``trial`` returned by :meth:`CircuitBreaker.allow` is passed to
+:meth:`CircuitBreaker.record`.
+
+The state of the breakers is per process and is shown by the ``list_breakers`` XML-RPC method.
+"""
+
+import time
+import threading
+from collections import deque
+
+from pyramid.settings import asbool
+
+from twitcher.sessions import _float_or_none
+
+import logging
+LOGGER = logging.getLogger("TWITCHER")
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class Trial(object):
+    """
+    The trial request of a half-open breaker.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker of one service.
+    """
+
+    def __init__(self, name, window=30, min_requests=10, error_rate=0.5, slow_threshold=None, open_seconds=30,
+                 clock=time.monotonic):
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_threshold = slow_threshold
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self.state = CLOSED
+        self.opened_at = None
+        self.trial_started = None
+        self._trial = None
+        # per second buckets of [second, requests, failures]
+        self._buckets = deque()
+        self._lock = threading.Lock()
+
+    def _counts(self, now):
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            self._buckets.popleft()
+        requests = sum(bucket[1] for bucket in self._buckets)
+        failures = sum(bucket[2] for bucket in self._buckets)
+        return requests, failures
+
+    def _open(self, now):
+        LOGGER.warning("Circuit breaker of service %s is open.", self.name)
+        self.state = OPEN
+        self.opened_at = now
+        self.trial_started = self._trial = None
+
+    def allow(self):
+        """
+        Returns false when the request may not be sent to the service, else true or, when the breaker
+        is half-open, the trial to be passed to :meth:`record`.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = self.clock()
+            if self.state == OPEN:
+                if now - self.opened_at < self.open_seconds:
+                    return False
+                self.state = HALF_OPEN
+            # a lost trial request, e.g. rejected by a concurrency limit, is replaced after open_seconds
+            if self.trial_started is not None and now - self.trial_started < self.open_seconds:
+                return False
+            self.trial_started = now
+            self._trial = Trial()
+            return self._trial
+
+    def record(self, failed, elapsed=0.0, trial=None):
+        """
+        Records the outcome of a request which took ``elapsed`` seconds. In the half-open state only
+        the outcome of the current ``trial`` counts.
+        """
+        if self.slow_threshold is not None and elapsed > self.slow_threshold:
+            failed = True
+        with self._lock:
+            now = self.clock()
+            if self.state != CLOSED:
+                if trial is None or trial is not self._trial:
+                    # a request sent before the breaker opened or a replaced trial
+                    return
+                if failed:
+                    self._open(now)
+                else:
+                    LOGGER.info("Circuit breaker of service %s is closed.", self.name)
+                    self.state = CLOSED
+                    self.opened_at = self.trial_started = self._trial = None
+                    self._buckets.clear()
+                return
+            second = int(now)
+            if not self._buckets or self._buckets[-1][0] != second:
+                self._buckets.append([second, 0, 0])
+            bucket = self._buckets[-1]
+            bucket[1] += 1
+            if failed:
+                bucket[2] += 1
+            requests, failures = self._counts(now)
+            if requests >= self.min_requests and failures >= self.error_rate * requests:
+                self._open(now)
+
+    def status(self):
+        """
+        Returns the state of the breaker and the counts of the current window.
+        """
+        with self._lock:
+            now = self.clock()
+            requests, failures = self._counts(now)
+            retry_in = 0.0
+            if self.state == OPEN:
+                retry_in = max(self.open_seconds - (now - self.opened_at), 0.0)
+            return {'name': self.name, 'state': self.state, 'requests': requests, 'failures': failures,
+                    'retry_in': retry_in}
+
+
+class BreakerRegistry(object):
+    """
+    Circuit breakers of the registered services keyed by service name.
+    """
+
+    def __init__(self, **options):
+        # options of every CircuitBreaker
+        self.options = options
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Returns the breaker of the service ``name``.
+        """
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(name)
+                if breaker is None:
+                    breaker = self._breakers[name] = CircuitBreaker(name, **self.options)
+        return breaker
+
+    def list_status(self):
+        """
+        Returns the status of all breakers sorted by service name.
+        """
+        return [breaker.status() for _, breaker in sorted(list(self._breakers.items()))]
+
+
+def breakers_factory(registry):
+    """
+    Creates a :class:`BreakerRegistry` configured with the ``twitcher.ows_proxy_breaker_*`` settings
+    or returns ``None`` when the breakers are disabled.
+    """
+    settings = registry.settings or {}
+    if not asbool(settings.get('twitcher.ows_proxy_breaker', True)):
+        return None
+    return BreakerRegistry(
+        window=float(settings.get('twitcher.ows_proxy_breaker_window', 30)),
+        min_requests=int(settings.get('twitcher.ows_proxy_breaker_min_requests', 10)),
+        error_rate=float(settings.get('twitcher.ows_proxy_breaker_error_rate', 0.5)),
+        slow_threshold=_float_or_none(settings.get('twitcher.ows_proxy_breaker_slow_threshold')),
+        open_seconds=float(settings.get('twitcher.ows_proxy_breaker_open_seconds', 30)),
+    )
+
+
+_lock = threading.Lock()
+
+
+def get_breakers(registry):
+    """
+    Returns the :class:`BreakerRegistry` shared by this process or ``None`` when it is disabled.
+    """
+    try:
+        return registry.breakers
+    except AttributeError:
+        with _lock:
+            if not hasattr(registry, 'breakers'):
+                registry.breakers = breakers_factory(registry)
+        return registry.breakers
@@ -0,0 +1,214 @@
+"""
+In-process caches used on the request path of the OWS proxy.
+
+:class:`LRUCache` is a thread-safe least-recently-used mapping with per-entry expiry and a size limit.
+:class:`CapabilitiesCache` keeps the already rewritten GetCapabilities and DescribeProcess documents.
+"""
+
+import time
+import threading
+from collections import OrderedDict, namedtuple
+
+from pyramid.settings import asbool
+
+import logging
+LOGGER = logging.getLogger("TWITCHER")
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU cache.
+
+    Every entry has a size (1 by default) and an optional expiry time (a :func:`time.monotonic` value).
+    Least recently used entries are evicted when the sum of the sizes exceeds ``maxsize``.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.currsize = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None, stale=False):
+        """
+        Returns the value stored for ``key`` or ``default``.
+        Expired entries are only returned when ``stale`` is true.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, size, expires = entry
+            if not stale and expires is not None and expires <= time.monotonic():
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, size=1):
+        """
+        Stores ``value`` for ``key``. The entry expires after ``ttl`` seconds when given.
+        Values bigger than ``maxsize`` are not stored.
+        """
+        if size > self.maxsize:
+            self.pop(key)
+            return False
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.currsize -= old[1]
+            self._data[key] = (value, size, expires)
+            self.currsize += size
+            while self.currsize > self.maxsize:
+                _, (_, evicted_size, _) = self._data.popitem(last=False)
+                self.currsize -= evicted_size
+        return True
+
+    def touch(self, key, ttl=None):
+        """
+        Renews the expiry time of ``key``.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires = None if ttl is None else time.monotonic() + ttl
+                self._data[key] = (entry[0], entry[1], expires)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            self.currsize -= entry[1]
+            return entry[0]
+
+    def pop_matching(self, predicate):
+        """
+        Removes all entries for which ``predicate(key)`` is true and returns their number.
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self.currsize -= self._data.pop(key)[1]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.currsize = 0
+
+
+CachedResponse = namedtuple(
+    'CachedResponse', ['body', 'status', 'content_type', 'etag', 'last_modified', 'service_url'])
+
+
+class CapabilitiesCache(object):
+    """
+    Caches the rewritten responses of public OWS requests (GetCapabilities, DescribeProcess)
+    per service.
+
+    Entries are bounded by ``maxsize`` bytes in total and by ``max_entry_size`` per document.
+    Expired entries with an ``ETag`` or ``Last-Modified`` header are revalidated against the service.
+    The documents of a changed service are removed with the service cache of the process, which also
+    learns about the changes of other processes from MongoDB. Without a service cache, the documents
+    of services changed by other processes are served until they expire.
+    """
+
+    def __init__(self, ttl=300, maxsize=64 * 1024 * 1024, max_entry_size=8 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entry_size = max_entry_size
+        self._cache = LRUCache(maxsize=maxsize)
+
+    @staticmethod
+    def key(service, ows_params, public_url):
+        """
+        Returns the cache key for the service and the (lower-case) OWS request parameters.
+        """
+        params = dict(ows_params)
+        request_type = params.pop('request', None)
+        version = params.pop('version', None)
+        identifier = params.pop('identifier', None)
+        for name in ('token', 'access_token'):
+            params.pop(name, None)
+        return (service.name, request_type, version, identifier, public_url, tuple(sorted(params.items())))
+
+    def get_ttl(self, service):
+        """
+        Time-to-live of the service documents. The service can overwrite the configured default.
+        """
+        ttl = service.cache_ttl
+        return self.ttl if ttl < 0 else ttl
+
+    def lookup(self, key, service):
+        """
+        Returns a tuple ``(cached response, fresh)`` or ``(None, False)`` when nothing is cached.
+        Responses of a service registered with another url are ignored.
+        """
+        cached = self._cache.get(key, stale=True)
+        if cached is None or cached.service_url != service.url:
+            return None, False
+        return cached, self._cache.get(key) is not None
+
+    def store(self, key, service, body, status=200, content_type=None, etag=None, last_modified=None):
+        ttl = self.get_ttl(service)
+        if ttl <= 0 or len(body) > self.max_entry_size:
+            return False
+        cached = CachedResponse(body, status, content_type, etag, last_modified, service.url)
+        return self._cache.set(key, cached, ttl=ttl, size=len(body))
+
+    def revalidated(self, key, service):
+        """
+        The service confirmed that the cached document is unchanged.
+        """
+        self._cache.touch(key, ttl=self.get_ttl(service))
+
+    def invalidate(self, name=None):
+        """
+        Removes the cached documents of service ``name``, or of all services when no name is given.
+        """
+        if name is None:
+            self._cache.clear()
+        else:
+            count = self._cache.pop_matching(lambda key: key[0] == name)
+            LOGGER.debug("Removed %d cached documents of service %s.", count, name)
+
+    @property
+    def currsize(self):
+        return self._cache.currsize
+
+
+def capscache_factory(registry):
+    """
+    Creates a :class:`CapabilitiesCache` configured with the ``twitcher.ows_proxy_caps_cache_*`` settings.
+    Returns ``None`` when the cache is disabled.
+    """
+    settings = registry.settings or {}
+    if not asbool(settings.get('twitcher.ows_proxy_caps_cache', True)):
+        return None
+    return CapabilitiesCache(
+        ttl=int(settings.get('twitcher.ows_proxy_caps_cache_ttl', 300)),
+        maxsize=int(settings.get('twitcher.ows_proxy_caps_cache_max_size', 64 * 1024 * 1024)),
+        max_entry_size=int(settings.get('twitcher.ows_proxy_caps_cache_max_entry_size', 8 * 1024 * 1024)),
+    )
+
+
+_lock = threading.Lock()
+
+
+def get_capscache(registry):
+    """
+    Returns the :class:`CapabilitiesCache` shared by this process or ``None`` when it is disabled.
+    """
+    try:
+        return registry.capscache
+    except AttributeError:
+        with _lock:
+            if not hasattr(registry, 'capscache'):
+                registry.capscache = capscache_factory(registry)
+        return registry.capscache
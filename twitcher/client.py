@@ -61,8 +61,10 @@ class TwitcherService(object):
     # tokens
 
     @xmlrpc_error_handler
-    def generate_token(self, valid_in_hours=1, data=None):
+    def generate_token(self, valid_in_hours=1, data=None, fetch_credentials=False):
         data = data or {}
+        if fetch_credentials:
+            return self.server.generate_token(valid_in_hours, data, True)
         return self.server.generate_token(valid_in_hours, data)
 
     @xmlrpc_error_handler
@@ -73,6 +75,10 @@ class TwitcherService(object):
     def revoke_all_tokens(self):
         return self.server.revoke_all_tokens()
 
+    @xmlrpc_error_handler
+    def purge_expired_tokens(self):
+        return self.server.purge_expired_tokens()
+
     # service registry
 
     @xmlrpc_error_handler
@@ -99,3 +105,11 @@ class TwitcherService(object):
     @xmlrpc_error_handler
     def get_service_by_name(self, name):
         return self.server.get_service_by_name(name)
+
+    @xmlrpc_error_handler
+    def list_breakers(self):
+        return self.server.list_breakers()
+
+    @xmlrpc_error_handler
+    def purge_tile_cache(self, name=''):
+        return self.server.purge_tile_cache(name)
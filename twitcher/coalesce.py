@@ -0,0 +1,249 @@
+"""
+Coalescing of identical concurrent requests to a service (single flight).
+
+The first of several identical GET requests (the leader) is sent to the service. Requests arriving
+while it is in flight wait for its response and get its status, headers and body instead of sending
+their own request. The body is passed to the leader's client as it arrives and kept in a shared buffer
+read by the other clients. When the leader's client goes away the body is still read for the others.
+
+Only responses which are not OWS exceptions are shared, the other requests are then sent on their own.
+At most ``max_size`` bytes of a body are buffered. When a body gets larger the buffer is dropped,
+no further requests join it and the requests reading it fail.
+"""
+
+import threading
+
+from twitcher.owsexceptions import OWSException
+from pyramid.response import Response
+from pyramid.settings import asbool
+
+import logging
+LOGGER = logging.getLogger("TWITCHER")
+
+
+class Flight(object):
+    """
+    A request in flight and the buffered response shared with the identical requests.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        # the leader's response is known
+        self.ready = False
+        # the leader's response is shared
+        self.shared = False
+        self.status = None
+        self.headerlist = None
+        self.chunks = []
+        # bytes in chunks
+        self.size = 0
+        self.done = False
+        self.failed = False
+        # the body got too large to be buffered
+        self.overflowed = False
+        self.followers = 0
+
+    def add(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.cond.notify_all()
+
+    def drop(self):
+        """
+        Drops the buffered body.
+        """
+        with self.cond:
+            self.chunks = []
+            self.size = 0
+
+
+class TeeAppIter(object):
+    """
+    Passes the body of the leader's response to its client and to the buffer of the flight.
+    """
+
+    def __init__(self, app_iter, coalescer, key, flight):
+        self.app_iter = app_iter
+        self.coalescer = coalescer
+        self.key = key
+        self.flight = flight
+        self._iterator = None
+        self._complete = False
+
+    def __iter__(self):
+        self._iterator = iter(self.app_iter)
+        return self._tee()
+
+    def _tee(self):
+        for chunk in self._iterator:
+            self._add(chunk)
+            yield chunk
+        self._complete = True
+        # the buffer is released at once when no request joined
+        self.coalescer._land(self.key, self.flight)
+
+    def _add(self, chunk):
+        flight = self.flight
+        if flight.overflowed:
+            return
+        flight.add(chunk)
+        if flight.size > self.coalescer.max_size:
+            self.coalescer._overflow(self.key, flight)
+
+    def close(self):
+        # no request joins from now on
+        self.coalescer._detach(self.key, self.flight)
+        try:
+            if not self._complete and self.flight.followers and not self.flight.overflowed:
+                # the leader's client went away, the body is read for the others
+                for chunk in self._iterator or iter(self.app_iter):
+                    self._add(chunk)
+                self._complete = True
+        except Exception:
+            LOGGER.exception("Could not read the response of a coalesced request.")
+        finally:
+            if not self.flight.done:
+                self.coalescer._land(self.key, self.flight, failed=not self._complete)
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+
+
+class FollowerAppIter(object):
+    """
+    Reads the body of a shared response from the buffer of the flight.
+    """
+
+    def __init__(self, flight, timeout):
+        self.flight = flight
+        self.timeout = timeout
+
+    def __iter__(self):
+        flight = self.flight
+        index = 0
+        while True:
+            with flight.cond:
+                if not flight.cond.wait_for(lambda: index < len(flight.chunks) or flight.done, self.timeout):
+                    raise IOError("no data from the coalesced request for {} seconds".format(self.timeout))
+                chunks = flight.chunks[index:]
+                done = flight.done
+                failed = flight.failed
+            index += len(chunks)
+            for chunk in chunks:
+                yield chunk
+            if done:
+                if failed:
+                    raise IOError("the coalesced request failed or its body was too large to be shared")
+                return
+
+
+class Coalescer(object):
+    """
+    Identical requests in flight keyed by the request key. Followers wait ``timeout`` seconds for data.
+    """
+
+    def __init__(self, timeout=30, max_size=16 * 1024 * 1024):
+        self.timeout = timeout
+        self.max_size = max_size
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def send(self, key, send):
+        """
+        Returns the response of ``send()`` or, when an identical request is in flight, its shared response.
+        The second value is true for a shared response.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            else:
+                flight.followers += 1
+        if leader:
+            return self._lead(key, flight, send), False
+        response = self._follow(flight)
+        if response is None:
+            return send(), False
+        return response, True
+
+    def _lead(self, key, flight, send):
+        try:
+            response = send()
+        except Exception:
+            self._land(key, flight, failed=True, ready=True)
+            raise
+        if isinstance(response, OWSException):
+            self._land(key, flight, failed=True, ready=True)
+            return response
+        with flight.cond:
+            flight.status = response.status
+            flight.headerlist = list(response.headerlist)
+            flight.shared = flight.ready = True
+            flight.cond.notify_all()
+        response.app_iter = TeeAppIter(response.app_iter, self, key, flight)
+        return response
+
+    def _follow(self, flight):
+        with flight.cond:
+            if not flight.cond.wait_for(lambda: flight.ready, self.timeout) or not flight.shared \
+                    or flight.overflowed:
+                return None
+            status, headerlist = flight.status, list(flight.headerlist)
+        return Response(status=status, headerlist=headerlist, app_iter=FollowerAppIter(flight, self.timeout))
+
+    def _detach(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def _land(self, key, flight, failed=False, ready=False):
+        self._detach(key, flight)
+        with flight.cond:
+            flight.done = True
+            flight.failed = failed
+            if ready:
+                flight.ready = True
+            flight.cond.notify_all()
+        if not flight.followers:
+            flight.drop()
+
+    def _overflow(self, key, flight):
+        """
+        Stops buffering a body larger than ``max_size``, the requests reading it fail.
+        """
+        self._detach(key, flight)
+        with flight.cond:
+            flight.overflowed = True
+        flight.drop()
+        self._land(key, flight, failed=True)
+
+
+def coalescer_factory(registry):
+    """
+    Creates a :class:`Coalescer` configured with the ``twitcher.ows_proxy_coalesce_*`` settings
+    or returns ``None`` when coalescing is disabled.
+    """
+    settings = registry.settings or {}
+    if not asbool(settings.get('twitcher.ows_proxy_coalesce', True)):
+        return None
+    return Coalescer(
+        timeout=float(settings.get('twitcher.ows_proxy_coalesce_timeout', 30)),
+        max_size=int(settings.get('twitcher.ows_proxy_coalesce_max_size', 16 * 1024 * 1024)),
+    )
+
+
+_lock = threading.Lock()
+
+
+def get_coalescer(registry):
+    """
+    Returns the :class:`Coalescer` shared by this process or ``None`` when it is disabled.
+    """
+    try:
+        return registry.coalescer
+    except AttributeError:
+        with _lock:
+            if not hasattr(registry, 'coalescer'):
+                registry.coalescer = coalescer_factory(registry)
+        return registry.coalescer
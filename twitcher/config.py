@@ -1,17 +1,16 @@
 import os
-import tempfile
 
 from pyramid.settings import asbool
 
+from twitcher.workdir import base_workdir, workdir_prefix
+
 
 import logging
 LOGGER = logging.getLogger("TWITCHER")
 
 
 def _workdir(request):
-    settings = request.registry.settings
-    workdir = settings.get('twitcher.workdir')
-    workdir = workdir or tempfile.gettempdir()
+    workdir = base_workdir(request.registry.settings)
     if not os.path.exists(workdir):
         os.makedirs(workdir)
     LOGGER.debug('using workdir %s', workdir)
@@ -19,10 +18,7 @@ def _workdir(request):
 
 
 def _prefix(request):
-    settings = request.registry.settings
-    prefix = settings.get('twitcher.prefix')
-    prefix = prefix or 'twitcher_'
-    return prefix
+    return workdir_prefix(request.registry.settings)
 
 
 def includeme(config):
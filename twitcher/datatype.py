@@ -22,6 +22,27 @@ class Service(dict):
         """Service URL."""
         return self['url']
 
+    @property
+    def urls(self):
+        """Backend URLs of the service without duplicates, the first one is ``url``."""
+        urls = [self.url]
+        for url in self.get('urls') or []:
+            if url not in urls:
+                urls.append(url)
+        return urls
+
+    @property
+    def balance(self):
+        """Load balancing strategy of the backend URLs: round_robin, least_outstanding or weighted."""
+        return self.get('balance', 'round_robin')
+
+    @property
+    def weights(self):
+        """Weights of the backend URLs used by the weighted strategy, missing weights are 1."""
+        weights = [int(weight) for weight in self.get('weights') or []]
+        urls = self.urls
+        return (weights + [1] * len(urls))[:len(urls)]
+
     @property
     def name(self):
         """Service name."""
@@ -66,6 +87,36 @@ class Service(dict):
             verify = value
         return verify
 
+    @property
+    def cache_ttl(self):
+        """Time-to-live in seconds of cached capabilities, -1 uses the configured default and 0 disables caching."""
+        return int(self.get('cache_ttl', -1))
+
+    @property
+    def tile_cache_ttl(self):
+        """Time-to-live in seconds of cached WMS tiles, -1 uses the configured default and 0 disables caching."""
+        return int(self.get('tile_cache_ttl', -1))
+
+    @property
+    def max_concurrency(self):
+        """Maximum number of concurrent requests to the service, 0 is unlimited."""
+        return int(self.get('max_concurrency', 0))
+
+    @property
+    def request_concurrency(self):
+        """Maximum number of concurrent requests by OWS request type, e.g. ``{'execute': 2}``."""
+        return {key.lower(): int(value) for key, value in (self.get('request_concurrency') or {}).items()}
+
+    @property
+    def max_queue(self):
+        """Number of requests waiting for a free slot when a concurrency limit is reached."""
+        return int(self.get('max_queue', 0))
+
+    @property
+    def queue_timeout(self):
+        """Seconds a request waits for a free slot, -1 uses the configured default."""
+        return float(self.get('queue_timeout', -1))
+
     @property
     def params(self):
         return {
@@ -75,7 +126,16 @@ class Service(dict):
             'purl': self.purl,
             'public': self.public,
             'auth': self.auth,
-            'verify': self.verify}
+            'verify': self.verify,
+            'cache_ttl': self.cache_ttl,
+            'tile_cache_ttl': self.tile_cache_ttl,
+            'max_concurrency': self.max_concurrency,
+            'request_concurrency': self.request_concurrency,
+            'max_queue': self.max_queue,
+            'queue_timeout': self.queue_timeout,
+            'urls': self.urls,
+            'balance': self.balance,
+            'weights': self.weights}
 
     def __str__(self):
         return self.name
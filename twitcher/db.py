@@ -1,25 +1,113 @@
 # MongoDB
 # http://docs.pylonsproject.org/projects/pyramid-cookbook/en/latest/database/mongodb.html
-# maybe use event to register mongodb
+#
+# A single ``MongoClient`` is shared by all requests of a worker process.
+# The client maintains its own connection pool and is thread-safe,
+# so the store factories only need to hand out collection wrappers.
+
+import threading
 
 import pymongo
+from pymongo import monitoring
 
+from twitcher.metrics import get_metrics
 
-def mongodb(registry):
-    settings = registry.settings
-    client = pymongo.MongoClient(settings['mongodb.host'], int(settings['mongodb.port']))
-    db = client[settings['mongodb.db_name']]
+import logging
+LOGGER = logging.getLogger("TWITCHER")
+
+_lock = threading.Lock()
+
+
+def _client_options(settings):
+    """
+    Returns the ``MongoClient`` keyword arguments configured with the ``mongodb.*`` settings.
+    """
+    options = {
+        'maxPoolSize': int(settings.get('mongodb.max_pool_size', 100)),
+        'minPoolSize': int(settings.get('mongodb.min_pool_size', 0)),
+        'connectTimeoutMS': int(settings.get('mongodb.connect_timeout_ms', 5000)),
+        'serverSelectionTimeoutMS': int(settings.get('mongodb.server_selection_timeout_ms', 5000)),
+        # do not connect before the first operation (safe when worker processes are forked)
+        'connect': False,
+    }
+    if settings.get('mongodb.socket_timeout_ms'):
+        options['socketTimeoutMS'] = int(settings['mongodb.socket_timeout_ms'])
+    if settings.get('mongodb.wait_queue_timeout_ms'):
+        options['waitQueueTimeoutMS'] = int(settings['mongodb.wait_queue_timeout_ms'])
+    return options
+
+
+def create_indexes(db):
+    """
+    Creates the indexes used by the stores. Called once when the database is bootstrapped.
+    """
     db.services.create_index("name", unique=True)
     # db.services.create_index("url", unique=True)
+    db.tokens.create_index("token", unique=True)
+    # mongodb removes expired tokens in the background, expires_at is stored as a date
+    db.tokens.create_index("expires_at", expireAfterSeconds=0)
+    # revoked signed tokens are removed when they expire
+    db.revoked_tokens.create_index("expires", expireAfterSeconds=0)
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Records the duration of the MongoDB commands in the twitcher metrics.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.mongodb_seconds.labels(command=event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.metrics.mongodb_seconds.labels(command=event.command_name).observe(event.duration_micros / 1e6)
+        self.metrics.mongodb_failures.labels(command=event.command_name).inc()
+
+
+def _connect(registry):
+    settings = registry.settings
+    options = _client_options(settings)
+    metrics = get_metrics(registry)
+    if metrics.enabled:
+        options['event_listeners'] = [CommandMetrics(metrics)]
+    client = pymongo.MongoClient(
+        settings['mongodb.host'], int(settings['mongodb.port']),
+        **options)
+    db = client[settings['mongodb.db_name']]
+    LOGGER.debug("Created mongodb client for %s:%s", settings['mongodb.host'], settings['mongodb.port'])
     return db
 
 
-# def includeme(config):
-#     config.registry.db = mongodb(config.registry)
-#
-#     def _add_db(request):
-#         db = request.registry.db
-#         # if db_url.username and db_url.password:
-#         #     db.authenticate(db_url.username, db_url.password)
-#         return db
-#     config.add_request_method(_add_db, 'db', reify=True)
+def mongodb(registry):
+    """
+    Returns the mongodb database shared by this process.
+
+    The client is created once and stored on the registry. It is usually created at application
+    startup by ``config.include('twitcher.db')``, otherwise on first use.
+    """
+    db = getattr(registry, 'mongodb', None)
+    if db is None:
+        with _lock:
+            db = getattr(registry, 'mongodb', None)
+            if db is None:
+                db = _connect(registry)
+                try:
+                    create_indexes(db)
+                except pymongo.errors.PyMongoError:
+                    LOGGER.exception("Could not create mongodb indexes.")
+                registry.mongodb = db
+    return db
+
+
+def includeme(config):
+    settings = config.registry.settings
+    # the memory stores need no database
+    if settings.get('twitcher.database') == 'memory':
+        return
+    if 'mongodb.host' in settings:
+        mongodb(config.registry)
@@ -12,13 +12,24 @@ This module uses code from esgf-slcs-client-example_ and esgf-pyclient_.
 """
 
 import os
+import time
 import shutil
+import calendar
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from OpenSSL import crypto
+from cryptography.fernet import Fernet, InvalidToken
 import base64
 import requests
 from requests_oauthlib import OAuth2Session
+from pyramid.settings import asbool
 
+from twitcher.cache import LRUCache
+from twitcher.metrics import get_metrics
 from twitcher.utils import is_valid_url
+from twitcher.workdir import touch_workdir
 
 import logging
 logger = logging.getLogger(__name__)
@@ -42,13 +53,16 @@ HTTP.SSL.CAPATH={esgf_certs_dir}
 """
 
 
-def fetch_certificate(workdir='.', data={}):
+def fetch_certificate(workdir='.', data={}, keypool=None, cipher=None):
     try:
         url = data.get('esgf_slcs_service_url')
         access_token = data.get('esgf_access_token')
         test_credentials = data.get('esgf_credentials')
-        mgr = ESGFAccessManager(url, base_dir=workdir)
-        mgr.logon(access_token, test_credentials)
+        credentials = None
+        if (data.get('esgf_credentials_expires') or 0) > time.time() + CREDENTIALS_MIN_VALIDITY:
+            credentials = decrypt_credentials(cipher, data.get('esgf_credentials_pem'))
+        mgr = ESGFAccessManager(url, base_dir=workdir, keypool=keypool)
+        mgr.logon(access_token, test_credentials, credentials=credentials)
         logger.debug('Prepared twitcher workdir %s', workdir)
     except Exception:
         logger.exception("Could not fetch certificate.")
@@ -56,9 +70,373 @@ def fetch_certificate(workdir='.', data={}):
     return True
 
 
+def decrypt_credentials(cipher, encrypted):
+    """
+    Returns the credentials stored encrypted with an access token or ``None`` when they can not be decrypted
+    with ``cipher``.
+    """
+    if cipher is None or not encrypted:
+        return None
+    try:
+        return cipher.decrypt(encrypted.encode('ascii')).decode('ascii')
+    except (InvalidToken, ValueError):
+        logger.warning("Could not decrypt the stored credentials, fetching new ones.")
+        return None
+
+
+KEY_BITS = 2048
+
+# credentials stored with an access token are used while they are valid for at least this many seconds
+CREDENTIALS_MIN_VALIDITY = 300
+
+
+def generate_key_pair():
+    key_pair = crypto.PKey()
+    key_pair.generate_key(crypto.TYPE_RSA, KEY_BITS)
+    return key_pair
+
+
+class KeyPool(object):
+    """
+    Bounded pool of pre-generated RSA key pairs for certificate requests.
+
+    A background thread, started on first use in each worker process, keeps the pool filled.
+    A key pair is generated on the request thread when the pool is empty.
+    The depth, hits, misses and key generations of the pool are added to ``metrics``.
+    """
+
+    def __init__(self, size=8, metrics=None):
+        self.size = size
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.generate_seconds = 0.0
+        self._keys = deque()
+        self._pid = None
+        self._stopped = False
+        self._cond = threading.Condition()
+
+    def ensure_started(self):
+        if self._pid != os.getpid():
+            with self._cond:
+                if self._pid != os.getpid():
+                    # keys inherited from the parent process must not be used twice
+                    self._keys.clear()
+                    self._set_depth()
+                    self._pid = os.getpid()
+                    self._stopped = False
+                    thread = threading.Thread(target=self.run, name='twitcher-keypool')
+                    thread.daemon = True
+                    thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def get(self):
+        """
+        Returns a key pair which has not been used before.
+        """
+        self.ensure_started()
+        with self._cond:
+            if self._keys:
+                self.hits += 1
+                key_pair = self._keys.popleft()
+                self._set_depth()
+                self._cond.notify()
+            else:
+                self.misses += 1
+                key_pair = None
+        if self.metrics is not None:
+            self.metrics.keypool_requests.labels(result='miss' if key_pair is None else 'hit').inc()
+        if key_pair is not None:
+            return key_pair
+        logger.debug("Key pool is empty, generate key pair.")
+        return generate_key_pair()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while len(self._keys) >= self.size and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            start = time.monotonic()
+            key_pair = generate_key_pair()
+            elapsed = time.monotonic() - start
+            with self._cond:
+                self._keys.append(key_pair)
+                self._set_depth()
+                self.generated += 1
+                self.generate_seconds += elapsed
+            if self.metrics is not None:
+                self.metrics.keypool_generate_seconds.observe(elapsed)
+
+    def _set_depth(self):
+        # called with the lock held
+        if self.metrics is not None:
+            self.metrics.keypool_keys.set(len(self._keys))
+
+    def stats(self):
+        """
+        Returns the metrics of the pool. ``refill_rate`` is the number of key pairs generated per second
+        by the background thread.
+        """
+        with self._cond:
+            return {
+                'size': self.size,
+                'depth': len(self._keys),
+                'hits': self.hits,
+                'misses': self.misses,
+                'generated': self.generated,
+                'refill_rate': self.generated / self.generate_seconds if self.generate_seconds else 0.0,
+            }
+
+
+def certificate_expires(credentials):
+    """
+    Returns the expiry time (seconds since epoch) of the certificate in the ``credentials`` file
+    or ``None`` when it can not be read.
+    """
+    try:
+        with open(credentials, 'rb') as fh:
+            cert = crypto.load_certificate(crypto.FILETYPE_PEM, fh.read())
+        not_after = cert.get_notAfter().decode('ascii')
+        return calendar.timegm(time.strptime(not_after, '%Y%m%d%H%M%SZ'))
+    except Exception:
+        logger.exception("Could not read expiry of certificate %s.", credentials)
+        return None
+
+
+class CredentialsCache(object):
+    """
+    Caches the workdir with the ESGF credentials of an access token until ``margin`` seconds before
+    the certificate expires.
+
+    Fetching a certificate takes a key generation and a round trip to the SLCS service,
+    concurrent requests with the same access token wait for a single fetch.
+    Workdirs of expired credentials are not removed, requests which use them may still be running.
+    """
+
+    def __init__(self, margin=300, maxsize=1000, keypool=None, cipher=None):
+        self.margin = margin
+        self.keypool = keypool
+        self.cipher = cipher
+        self._cache = LRUCache(maxsize=maxsize)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(access_token):
+        data = access_token.data
+        return (access_token.token, data.get('esgf_access_token'), data.get('esgf_credentials'))
+
+    def fetch(self, access_token, workdir_factory):
+        """
+        Returns the workdir with the credentials of ``access_token`` or ``None`` when they could not be fetched.
+        A new workdir is created with ``workdir_factory`` when nothing is cached.
+        """
+        key = self.key(access_token)
+        workdir = self._get(key)
+        if workdir is not None:
+            return workdir
+        with self._lock:
+            workdir = self._get(key)
+            if workdir is not None:
+                return workdir
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return future.result()
+        try:
+            workdir = self._fetch(key, access_token, workdir_factory)
+            future.set_result(workdir)
+        except Exception as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+        return workdir
+
+    def _get(self, key):
+        workdir = self._cache.get(key)
+        if workdir is not None and not touch_workdir(workdir):
+            # removed by the workdir reaper
+            self._cache.pop(key)
+            workdir = None
+        return workdir
+
+    def _fetch(self, key, access_token, workdir_factory):
+        workdir = workdir_factory()
+        fetched = False
+        try:
+            fetched = fetch_certificate(workdir=workdir, data=access_token.data, keypool=self.keypool,
+                                        cipher=self.cipher)
+        finally:
+            if not fetched:
+                shutil.rmtree(workdir, ignore_errors=True)
+        if not fetched:
+            return None
+        expires = certificate_expires(os.path.join(workdir, ESGF_CREDENTIALS))
+        if expires is not None:
+            if access_token.expires_at:
+                expires = min(expires - self.margin, access_token.expires_at)
+            else:
+                expires -= self.margin
+            ttl = expires - time.time()
+            if ttl > 0:
+                self._cache.set(key, workdir, ttl=ttl)
+        return workdir
+
+    def clear(self):
+        self._cache.clear()
+
+
+class CredentialsFetcher(object):
+    """
+    Fetches the ESGF credentials of new access tokens in a pool of ``max_workers`` threads,
+    so that the proxied requests only write the stored credentials to their workdir.
+
+    The caller waits for the fetch, at most ``timeout`` seconds: the token is returned with its credentials.
+    The pool bounds the number of concurrent certificate requests. The credentials, with the private key,
+    are encrypted with ``cipher`` before they are stored.
+    """
+
+    def __init__(self, cipher, keypool=None, max_workers=4, timeout=30):
+        self.cipher = cipher
+        self.keypool = keypool
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='twitcher-esgf')
+
+    def fetch(self, data):
+        """
+        Returns the token data to be stored with the credentials: the encrypted ``esgf_credentials_pem`` and
+        ``esgf_credentials_expires``. Returns an empty dict when the credentials could not be fetched.
+        """
+        if not (data.get('esgf_access_token') or data.get('esgf_credentials')):
+            return {}
+        future = self.executor.submit(self._fetch, data)
+        try:
+            return future.result(timeout=self.timeout)
+        except Exception:
+            logger.exception("Could not fetch credentials for access token.")
+            return {}
+
+    def _fetch(self, data):
+        workdir = tempfile.mkdtemp(prefix='twitcher_esgf_')
+        try:
+            if not fetch_certificate(workdir=workdir, data=data, keypool=self.keypool):
+                return {}
+            credentials = os.path.join(workdir, ESGF_CREDENTIALS)
+            with open(credentials) as fh:
+                pem = fh.read()
+            expires = certificate_expires(credentials)
+            if expires is None:
+                return {}
+            encrypted = self.cipher.encrypt(pem.encode('ascii')).decode('ascii')
+            return {'esgf_credentials_pem': encrypted, 'esgf_credentials_expires': expires}
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+_lock = threading.Lock()
+_keypool_lock = threading.Lock()
+_fetcher_lock = threading.Lock()
+
+
+def get_credentialscache(registry):
+    """
+    Returns the :class:`CredentialsCache` shared by this process or ``None`` when it is disabled
+    with the ``twitcher.esgf_credentials_cache`` setting.
+    """
+    try:
+        return registry.credentialscache
+    except AttributeError:
+        pass
+    settings = registry.settings or {}
+    with _lock:
+        if not hasattr(registry, 'credentialscache'):
+            cache = None
+            if asbool(settings.get('twitcher.esgf_credentials_cache', True)):
+                cache = CredentialsCache(
+                    margin=int(settings.get('twitcher.esgf_credentials_cache_margin', 300)),
+                    maxsize=int(settings.get('twitcher.esgf_credentials_cache_max_size', 1000)),
+                    keypool=get_keypool(registry),
+                    cipher=credentials_cipher_factory(registry))
+            registry.credentialscache = cache
+    return registry.credentialscache
+
+
+def get_keypool(registry):
+    """
+    Returns the :class:`KeyPool` shared by this process or ``None`` when it is disabled
+    with the ``twitcher.esgf_keypool`` setting.
+    """
+    try:
+        return registry.keypool
+    except AttributeError:
+        pass
+    settings = registry.settings or {}
+    with _keypool_lock:
+        if not hasattr(registry, 'keypool'):
+            keypool = None
+            if asbool(settings.get('twitcher.esgf_keypool', True)):
+                keypool = KeyPool(size=int(settings.get('twitcher.esgf_keypool_size', 8)),
+                                  metrics=get_metrics(registry))
+            registry.keypool = keypool
+    return registry.keypool
+
+
+def credentials_cipher_factory(registry):
+    """
+    Creates the :class:`cryptography.fernet.Fernet` cipher of the credentials stored with access tokens
+    from the ``twitcher.esgf_credentials_key`` setting. Returns ``None`` when no key is set.
+    """
+    settings = registry.settings or {}
+    key = settings.get('twitcher.esgf_credentials_key')
+    if not key:
+        return None
+    return Fernet(key)
+
+
+def get_credentialsfetcher(registry):
+    """
+    Returns the :class:`CredentialsFetcher` shared by this process or ``None`` when credentials can not be
+    stored, because the ``twitcher.esgf_credentials_key`` setting is missing.
+    """
+    try:
+        return registry.credentialsfetcher
+    except AttributeError:
+        pass
+    settings = registry.settings or {}
+    with _fetcher_lock:
+        if not hasattr(registry, 'credentialsfetcher'):
+            fetcher = None
+            cipher = credentials_cipher_factory(registry)
+            if cipher is None:
+                logger.warning("ESGF credentials are not stored with access tokens, "
+                               "twitcher.esgf_credentials_key is not set.")
+            else:
+                fetcher = CredentialsFetcher(
+                    cipher,
+                    keypool=get_keypool(registry),
+                    max_workers=int(settings.get('twitcher.esgf_fetch_workers', 4)),
+                    timeout=float(settings.get('twitcher.esgf_fetch_timeout', 30)))
+            registry.credentialsfetcher = fetcher
+    return registry.credentialsfetcher
+
+
 class ESGFAccessManager(object):
-    def __init__(self, slcs_service_url, base_dir=None):
+    def __init__(self, slcs_service_url, base_dir=None, keypool=None):
         self.certificate_url = "{}/oauth/certificate/".format(slcs_service_url)
+        self.keypool = keypool
         self.base_dir = base_dir or '.'
         self.esgf_credentials = os.path.join(self.base_dir, ESGF_CREDENTIALS)
         self.esgf_certs_dir = os.path.join(self.base_dir, ESGF_CERTS_DIR)
@@ -67,8 +445,11 @@ class ESGFAccessManager(object):
 
         os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 
-    def logon(self, access_token, cert_url=None, timeout=1):
-        if access_token:
+    def logon(self, access_token, cert_url=None, timeout=1, credentials=None):
+        if credentials:
+            # fetched when the access token was generated
+            self._write_credentials(credentials)
+        elif access_token:
             self._retrieve_certificate(access_token, timeout=timeout)
         elif cert_url:
             self._download_certificate(cert_url)
@@ -82,6 +463,11 @@ class ESGFAccessManager(object):
             logger.warn("Could not update permission of credentials.")
         return True
 
+    def _write_credentials(self, credentials):
+        with open(self.esgf_credentials, 'w') as fh:
+            fh.write(credentials)
+        return True
+
     def _download_certificate(self, url):
         if is_valid_url(url):
             logger.debug('Download cert from %s', url)
@@ -100,9 +486,11 @@ class ESGFAccessManager(object):
         """
         logger.debug("Retrieve certificate with token.")
 
-        # Generate a new key pair
-        key_pair = crypto.PKey()
-        key_pair.generate_key(crypto.TYPE_RSA, 2048)
+        # Take a new key pair from the pool or generate it
+        if self.keypool is not None:
+            key_pair = self.keypool.get()
+        else:
+            key_pair = generate_key_pair()
         private_key = crypto.dump_privatekey(crypto.FILETYPE_PEM, key_pair).decode("utf-8")
 
         # Generate a certificate request using that key-pair
@@ -11,6 +11,14 @@ class AccessTokenNotFound(Exception):
     pass
 
 
+class InvalidAccessToken(Exception):
+    """
+    Error indicating that a self-contained access token has an invalid signature, is malformed
+    or has been revoked.
+    """
+    pass
+
+
 class ServiceNotFound(Exception):
     """
     Error indicating that an OWS service could not be read from the
@@ -25,3 +33,14 @@ class ServiceRegistrationError(Exception):
     storage backend by an instance of :class:`twitcher.store.ServiceStore`.
     """
     pass
+
+
+class ServiceBusy(Exception):
+    """
+    Error indicating that the concurrency limit of an OWS service is reached
+    and the request could not wait for a free slot.
+    """
+    def __init__(self, message, reason='busy'):
+        super(ServiceBusy, self).__init__(message)
+        # busy: no room in the wait queue, timeout: waited too long
+        self.reason = reason
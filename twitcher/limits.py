@@ -0,0 +1,182 @@
+"""
+Concurrency limits (bulkheads) of the requests sent to the registered services.
+
+A service can limit its concurrent requests with ``max_concurrency`` and the concurrent requests
+of an OWS request type with ``request_concurrency`` (e.g. ``{'execute': 2}``). When a limit is reached,
+up to ``max_queue`` requests wait at most ``queue_timeout`` seconds for a free slot, further requests
+are rejected at once. A slow service then only blocks its own slots and not every worker thread.
+
+A slot is held until the response body has been sent to the client.
+"""
+
+import time
+import threading
+
+from twitcher.exceptions import ServiceBusy
+
+import logging
+LOGGER = logging.getLogger("TWITCHER")
+
+
+class Bulkhead(object):
+    """
+    Allows ``limit`` concurrent holders, ``max_queue`` callers wait up to ``timeout`` seconds for a slot.
+    """
+
+    def __init__(self, limit, max_queue=0, timeout=10):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Takes a slot, raises :class:`twitcher.exceptions.ServiceBusy` when none is free in time.
+        """
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return
+            if self.waiting >= self.max_queue:
+                raise ServiceBusy("{} requests in progress".format(self.active), reason='busy')
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.timeout
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise ServiceBusy("no free slot after {} seconds".format(self.timeout), reason='timeout')
+                    self._cond.wait(remaining)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class Slot(object):
+    """
+    The slots held by one request. :meth:`release` may be called more than once.
+    """
+
+    def __init__(self, bulkheads):
+        self._bulkheads = bulkheads
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            bulkheads, self._bulkheads = self._bulkheads, []
+        for bulkhead in bulkheads:
+            bulkhead.release()
+
+
+class ReleasingAppIter(object):
+    """
+    Passes the chunks of a response through and releases the slot of the request when it is closed.
+    """
+
+    def __init__(self, app_iter, slot):
+        self.app_iter = app_iter
+        self.slot = slot
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.slot.release()
+
+
+class BulkheadRegistry(object):
+    """
+    Bulkheads of the registered services keyed by service name.
+    The bulkheads of a service are rebuilt when its limits change.
+    """
+
+    def __init__(self, queue_timeout=10):
+        # used by services with queue_timeout = -1
+        self.queue_timeout = queue_timeout
+        self._bulkheads = {}
+        self._lock = threading.Lock()
+
+    def _limits(self, service):
+        queue_timeout = service.queue_timeout
+        if queue_timeout < 0:
+            queue_timeout = self.queue_timeout
+        return (service.max_concurrency, tuple(sorted(service.request_concurrency.items())),
+                service.max_queue, queue_timeout)
+
+    def _create(self, limits):
+        max_concurrency, request_concurrency, max_queue, queue_timeout = limits
+        service_bulkhead = None
+        if max_concurrency > 0:
+            service_bulkhead = Bulkhead(max_concurrency, max_queue, queue_timeout)
+        request_bulkheads = {request_type: Bulkhead(limit, max_queue, queue_timeout)
+                             for request_type, limit in request_concurrency if limit > 0}
+        return limits, service_bulkhead, request_bulkheads
+
+    def _get(self, service):
+        limits = self._limits(service)
+        entry = self._bulkheads.get(service.name)
+        if entry is None or entry[0] != limits:
+            with self._lock:
+                entry = self._bulkheads.get(service.name)
+                if entry is None or entry[0] != limits:
+                    if entry is not None:
+                        LOGGER.debug("Rebuild concurrency limits of service %s.", service.name)
+                    entry = self._bulkheads[service.name] = self._create(limits)
+        return entry
+
+    def acquire(self, service, request_type=None):
+        """
+        Returns the :class:`Slot` of a request of ``request_type`` to ``service`` or ``None``
+        when no limit applies. Raises :class:`twitcher.exceptions.ServiceBusy` when a limit is reached.
+        """
+        _, service_bulkhead, request_bulkheads = self._get(service)
+        request_bulkhead = request_bulkheads.get((request_type or '').lower())
+        if service_bulkhead is None and request_bulkhead is None:
+            return None
+        bulkheads = []
+        # the request type slot is taken first, so that no service slot is held while waiting for it
+        for bulkhead in (request_bulkhead, service_bulkhead):
+            if bulkhead is None:
+                continue
+            try:
+                bulkhead.acquire()
+            except ServiceBusy:
+                Slot(bulkheads).release()
+                raise
+            bulkheads.append(bulkhead)
+        return Slot(bulkheads)
+
+
+def bulkheads_factory(registry):
+    """
+    Creates a :class:`BulkheadRegistry` configured with the ``twitcher.ows_proxy_queue_timeout`` setting.
+    """
+    settings = registry.settings or {}
+    return BulkheadRegistry(queue_timeout=float(settings.get('twitcher.ows_proxy_queue_timeout', 10)))
+
+
+_lock = threading.Lock()
+
+
+def get_bulkheads(registry):
+    """
+    Returns the :class:`BulkheadRegistry` shared by this process.
+    """
+    try:
+        return registry.bulkheads
+    except AttributeError:
+        with _lock:
+            if not hasattr(registry, 'bulkheads'):
+                registry.bulkheads = bulkheads_factory(registry)
+        return registry.bulkheads
@@ -0,0 +1,455 @@
+"""
+In-process metrics of the OWS proxy served in the Prometheus text format by ``/metrics``.
+
+Counters, gauges and histograms are kept by a :class:`MetricsRegistry` in every worker process. An update takes
+the lock of one metric for a dict lookup and an addition, so the metrics can be updated by all
+waitress threads on the request path.
+
+Worker processes do not share memory. With the ``twitcher.metrics_dir`` setting every process writes
+its values to ``twitcher_metrics_<pid>.json`` in this directory every ``twitcher.metrics_flush_interval``
+seconds and ``/metrics`` adds up the files of all processes (gauges too). The files of stopped processes,
+and files not written for three flush intervals, are removed, so their values drop out of the sums.
+
+``/metrics`` only answers clients in the networks of the ``twitcher.metrics_allow`` setting, the local host
+by default.
+"""
+
+import os
+import re
+import json
+import glob
+import time
+import atexit
+import ipaddress
+import threading
+
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.response import Response
+from pyramid.settings import asbool, aslist
+
+import logging
+LOGGER = logging.getLogger("TWITCHER")
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# upper bounds in seconds, the store lookups and rewrites take a few milliseconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+SNAPSHOT_PATTERN = 'twitcher_metrics_{}.json'
+SNAPSHOT_RE = re.compile(r'twitcher_metrics_(\d+)\.json$')
+
+# flush intervals after which the file of a process is removed
+STALE_INTERVALS = 3
+
+
+class _Child(object):
+    """
+    A metric with bound label values.
+    """
+
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount=1):
+        self.metric._inc(self.key, amount)
+
+    def set(self, value):
+        self.metric._set(self.key, value)
+
+    def observe(self, value):
+        self.metric._observe(self.key, value)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), enabled=True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.enabled = enabled
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        return _Child(self, tuple(str(labels.get(name, '')) for name in self.labelnames))
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[list(key), self._copy(value)] for key, value in self._values.items()]
+        return {'type': self.type, 'help': self.documentation, 'labelnames': list(self.labelnames),
+                'samples': samples}
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1):
+        self._inc((), amount)
+
+    def _inc(self, key, amount):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value):
+        self._set((), value)
+
+    def _set(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Counts observations in buckets with the upper bounds ``buckets`` and a last ``+Inf`` bucket.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, enabled=True):
+        super(Histogram, self).__init__(name, documentation, labelnames, enabled=enabled)
+        self.buckets = tuple(float(bound) for bound in buckets)
+
+    def observe(self, value):
+        self._observe((), value)
+
+    def _observe(self, key, value):
+        if not self.enabled:
+            return
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            entry['buckets'][index] += 1
+            entry['sum'] += value
+
+    def snapshot(self):
+        snapshot = super(Histogram, self).snapshot()
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+    def _copy(self, value):
+        return {'buckets': list(value['buckets']), 'sum': value['sum']}
+
+
+def merge_snapshots(snapshots):
+    """
+    Adds up the snapshots of several processes. Histograms with different buckets are skipped.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.get(name)
+            if target is None:
+                target = merged[name] = dict(metric, samples={})
+            elif target['type'] != metric['type'] or target.get('buckets') != metric.get('buckets'):
+                LOGGER.warning("Skipping incompatible values of metric %s.", name)
+                continue
+            samples = target['samples']
+            for key, value in metric['samples']:
+                key = tuple(key)
+                if metric['type'] == 'histogram':
+                    entry = samples.setdefault(key, {'buckets': [0] * len(value['buckets']), 'sum': 0.0})
+                    entry['buckets'] = [a + b for a, b in zip(entry['buckets'], value['buckets'])]
+                    entry['sum'] += value['sum']
+                else:
+                    samples[key] = samples.get(key, 0) + value
+    return merged
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(labelnames, key)]
+    if extra:
+        pairs.append('{}="{}"'.format(*extra))
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(metrics):
+    """
+    Returns the merged ``metrics`` in the Prometheus text exposition format.
+    """
+    lines = []
+    for name in sorted(metrics):
+        metric = metrics[name]
+        labelnames = metric['labelnames']
+        lines.append('# HELP {} {}'.format(name, metric['help']))
+        lines.append('# TYPE {} {}'.format(name, metric['type']))
+        for key in sorted(metric['samples']):
+            value = metric['samples'][key]
+            if metric['type'] == 'histogram':
+                count = 0
+                for bound, bucket in zip(metric['buckets'] + [float('inf')], value['buckets']):
+                    count += bucket
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(labelnames, key, ('le', _format_value(bound))), count))
+                labels = _format_labels(labelnames, key)
+                lines.append('{}_sum{} {}'.format(name, labels, _format_value(value['sum'])))
+                lines.append('{}_count{} {}'.format(name, labels, count))
+            else:
+                lines.append('{}{} {}'.format(name, _format_labels(labelnames, key), _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRegistry(object):
+    """
+    The metrics of one process. The values are written to ``directory`` when it is given.
+    """
+
+    def __init__(self, enabled=True, directory=None, flush_interval=5):
+        self.enabled = enabled
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._pid = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames, enabled=self.enabled))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames, enabled=self.enabled))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets=buckets, enabled=self.enabled))
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def ensure_started(self):
+        """
+        Starts the thread writing the values of this process, when a ``directory`` is configured.
+        """
+        if self.directory and self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._stopped.clear()
+                    thread = threading.Thread(target=self.run, name='twitcher-metrics')
+                    thread.daemon = True
+                    thread.start()
+                    atexit.register(self.write)
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.write()
+            except Exception:
+                LOGGER.exception("Could not write metrics.")
+
+    def _path(self, pid=None):
+        return os.path.join(self.directory, SNAPSHOT_PATTERN.format(pid or os.getpid()))
+
+    def write(self):
+        """
+        Writes the values of this process to its file in ``directory``.
+        """
+        path = self._path()
+        tmp = '{}.tmp'.format(path)
+        with open(tmp, 'w') as fh:
+            json.dump(self.snapshot(), fh)
+        os.replace(tmp, path)
+
+    def _is_stale(self, path):
+        """
+        Returns true when the file of another process is outdated or the process is not running.
+        """
+        try:
+            if os.path.getmtime(path) < time.time() - STALE_INTERVALS * self.flush_interval:
+                return True
+        except OSError:
+            return True
+        match = SNAPSHOT_RE.search(path)
+        if match is None:
+            return False
+        try:
+            os.kill(int(match.group(1)), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            # e.g. running as another user
+            pass
+        return False
+
+    def collect(self):
+        """
+        Returns the values of this process, added up with those of the other running processes
+        writing to ``directory``.
+        """
+        snapshots = [self.snapshot()]
+        if self.directory:
+            own = self._path()
+            for path in glob.glob(os.path.join(self.directory, SNAPSHOT_PATTERN.format('*'))):
+                if path == own:
+                    continue
+                if self._is_stale(path):
+                    LOGGER.debug("Removing metrics file %s of a stopped process.", path)
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    with open(path) as fh:
+                        snapshots.append(json.load(fh))
+                except (OSError, ValueError):
+                    LOGGER.warning("Could not read metrics file %s.", path)
+        return merge_snapshots(snapshots)
+
+    def render(self):
+        return render(self.collect())
+
+
+class Metrics(MetricsRegistry):
+    """
+    The metrics of the security tween, the store lookups and the OWS proxy.
+    """
+
+    def __init__(self, enabled=True, directory=None, flush_interval=5):
+        super(Metrics, self).__init__(enabled=enabled, directory=directory, flush_interval=flush_interval)
+        self.security_seconds = self.histogram(
+            'twitcher_security_seconds', "Time spent in the OWS security checks.", ('service', 'request'))
+        self.store_seconds = self.histogram(
+            'twitcher_store_seconds', "Time spent in service and token lookups.", ('service', 'store'))
+        self.upstream_seconds = self.histogram(
+            'twitcher_upstream_seconds', "Time until the response headers of the service are received.",
+            ('service', 'request'))
+        self.upstream_responses = self.counter(
+            'twitcher_upstream_responses_total', "Responses of the services by status code.", ('service', 'status'))
+        self.upstream_sent_bytes = self.counter(
+            'twitcher_upstream_sent_bytes_total', "Request body bytes sent to the services.", ('service',))
+        self.upstream_received_bytes = self.counter(
+            'twitcher_upstream_received_bytes_total', "Response body bytes received from the services.",
+            ('service',))
+        self.upstream_retries = self.counter(
+            'twitcher_upstream_retries_total', "Requests sent again to another backend of a service.", ('service',))
+        self.coalesced_requests = self.counter(
+            'twitcher_coalesced_requests_total', "Requests answered with the response of an identical request.",
+            ('service',))
+        self.tile_cache_requests = self.counter(
+            'twitcher_tile_cache_requests_total', "WMS tile requests by tile cache result (hit, miss).",
+            ('service', 'result'))
+        self.upstream_rejected = self.counter(
+            'twitcher_upstream_rejected_total', "Requests rejected by the concurrency limits of the services.",
+            ('service', 'reason'))
+        self.rewrite_seconds = self.histogram(
+            'twitcher_rewrite_seconds', "Time spent replacing the service urls of a response.", ('service',))
+        self.token_validations = self.counter(
+            'twitcher_token_validations_total', "Access token validations by outcome.", ('outcome',))
+        self.mongodb_seconds = self.histogram(
+            'twitcher_mongodb_seconds', "Duration of MongoDB commands.", ('command',))
+        self.mongodb_failures = self.counter(
+            'twitcher_mongodb_failures_total', "Failed MongoDB commands.", ('command',))
+        self.keypool_keys = self.gauge(
+            'twitcher_keypool_keys', "Pre-generated key pairs in the ESGF key pools.")
+        self.keypool_requests = self.counter(
+            'twitcher_keypool_requests_total', "Key pairs taken from the ESGF key pools by result (hit, miss).",
+            ('result',))
+        self.keypool_generate_seconds = self.histogram(
+            'twitcher_keypool_generate_seconds', "Time spent generating key pairs to refill the ESGF key pools.")
+
+
+def request_labels(request):
+    """
+    Returns the service and OWS request type labels of a proxied request, which are set by the security checks.
+    """
+    environ = request.environ
+    return {'service': environ.get('twitcher.service_name', ''), 'request': environ.get('twitcher.ows_request', '')}
+
+
+_lock = threading.Lock()
+
+
+def get_metrics(registry):
+    """
+    Returns the :class:`Metrics` of this process. The metrics are not updated when they are disabled
+    with the ``twitcher.metrics`` setting.
+    """
+    try:
+        return registry.metrics
+    except AttributeError:
+        pass
+    settings = registry.settings or {}
+    with _lock:
+        if not hasattr(registry, 'metrics'):
+            registry.metrics = Metrics(
+                enabled=asbool(settings.get('twitcher.metrics', True)),
+                directory=settings.get('twitcher.metrics_dir') or None,
+                flush_interval=float(settings.get('twitcher.metrics_flush_interval', 5)))
+    return registry.metrics
+
+
+def allowed_networks(settings):
+    """
+    Returns the networks of the clients which may read the metrics, an empty list allows every client.
+    """
+    return [ipaddress.ip_network(network, strict=False)
+            for network in aslist(settings.get('twitcher.metrics_allow', '127.0.0.1 ::1'))]
+
+
+def is_allowed(request):
+    networks = allowed_networks(request.registry.settings or {})
+    if not networks:
+        return True
+    try:
+        # not the X-Forwarded-For header, it is set by the client
+        address = ipaddress.ip_address(request.environ.get('REMOTE_ADDR') or '')
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+
+def metrics_view(request):
+    if not is_allowed(request):
+        LOGGER.warning("Metrics denied to client %s.", request.environ.get('REMOTE_ADDR'))
+        return HTTPForbidden()
+    metrics = get_metrics(request.registry)
+    metrics.ensure_started()
+    response = Response(metrics.render().encode('utf-8'))
+    response.headers['Content-Type'] = CONTENT_TYPE
+    return response
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if asbool(settings.get('twitcher.metrics', True)):
+        LOGGER.debug('Twitcher /metrics enabled.')
+        config.add_route('metrics', '/metrics')
+        config.add_view(metrics_view, route_name='metrics')
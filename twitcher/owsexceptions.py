@@ -102,3 +102,14 @@ class OWSInvalidParameterValue(OWSException):
     code = "InvalidParameterValue"
     locator = ""
     explanation = "Parameter value is invalid"
+
+
+class OWSServerBusy(OWSException):
+    """ServerBusy OWS Exception, sent with status 503"""
+    code = "ServerBusy"
+    locator = ""
+    explanation = "The service is busy, try again later"
+
+    def __init__(self, detail=None, value=None, **kw):
+        super(OWSServerBusy, self).__init__(detail, value, **kw)
+        self.status = '503 Service Unavailable'
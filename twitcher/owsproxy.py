@@ -4,16 +4,29 @@ The owsproxy is based on `papyrus_ogcproxy <https://github.com/elemoine/papyrus_
 See also: https://github.com/nive/outpost/blob/master/outpost/proxy.py
 """
 
+import time
 from urllib import parse as urlparse
 
-import requests
-
 from pyramid.response import Response
 from pyramid.settings import asbool
 
-from twitcher.owsexceptions import OWSAccessForbidden, OWSAccessFailed
-from twitcher.utils import replace_caps_url
+from twitcher.owsexceptions import OWSException, OWSAccessForbidden, OWSAccessFailed, OWSServerBusy
+from twitcher.exceptions import ServiceBusy
+from twitcher.owsrequest import public_request_types
+from twitcher.utils import iter_replace_caps_url
+from twitcher.requestbody import body_stream
 from twitcher.store import servicestore_factory
+from twitcher.store.cached import fetch_service_by_name
+from twitcher.sessions import get_sessionregistry
+from twitcher.cache import get_capscache
+from twitcher.metrics import get_metrics, request_labels
+from twitcher.timing import get_timing
+from twitcher.limits import get_bulkheads, ReleasingAppIter
+from twitcher.breaker import get_breakers
+from twitcher.balancer import get_balancers
+from twitcher.limits import Slot
+from twitcher.coalesce import get_coalescer, FollowerAppIter
+from twitcher.tilecache import get_tilecache, MappedFileIter, TILE_REQUEST_TYPES, BLOCK_SIZE
 
 import logging
 LOGGER = logging.getLogger(__name__)
@@ -39,6 +52,27 @@ allowed_content_types = (
     "application/json;charset=ISO-8859-1",
 )
 
+# requests without a body sent with these methods are sent to another backend when one fails
+retried_methods = ('GET', 'HEAD')
+retried_status_codes = (502, 503, 504)
+
+# read-only OWS request types whose identical requests are coalesced
+coalesced_request_types = {'wps': ('getcapabilities', 'describeprocess'),
+                           'wms': ('getcapabilities', 'getmap', 'getlegendgraphic')}
+
+# request headers changing the response of a service, identical requests differing in them are not coalesced
+coalesce_key_headers = ('Authorization', 'Cookie', 'Range', 'If-None-Match', 'If-Modified-Since',
+                        'X-Requested-Workdir', 'X-X509-User-Proxy')
+
+# content types of OWS exception reports
+ows_exception_content_types = ('application/vnd.ogc.se_xml', 'application/vnd.ogc.se+xml')
+
+# response headers passed to the client and used to revalidate cached documents
+validator_headers = ('ETag', 'Last-Modified', 'Cache-Control')
+
+# Content types of documents with service urls
+rewritten_content_types = ('text/xml', 'application/xml', 'text/xml;charset=ISO-8859-1')
+
 # TODO: configure allowed hosts
 allowed_hosts = (
     # list allowed hosts here (no port limiting)
@@ -46,53 +80,361 @@ allowed_hosts = (
 )
 
 
+def needs_url_rewrite(content_type):
+    """
+    Returns true when the service urls in a response with this ``Content-Type`` are replaced.
+    Other responses are streamed unchanged.
+    """
+    return content_type in rewritten_content_types
+
+
 # requests.models.Reponse defaults its chunk size to 128 bytes, which is very slow
 class BufferedResponse():
-    def __init__(self, resp):
+    def __init__(self, resp, received=None, timing=None):
         self.resp = resp
+        # counter of the received bytes
+        self.received = received
+        # timing of the request, see twitcher.timing
+        self.timing = timing
+        # time spent waiting for the body
+        self.waiting = 0.0
+
+    def _measured(self):
+        return self.received is not None or self.timing is not None
 
     def __iter__(self):
-        return self.resp.iter_content(64 * 1024)
+        if not self._measured():
+            return self.resp.iter_content(64 * 1024)
+        return self._iter_measured()
+
+    def _iter_measured(self):
+        size = 0
+        chunks = self.resp.iter_content(64 * 1024)
+        try:
+            while True:
+                start = time.perf_counter()
+                chunk = next(chunks, None)
+                self.waiting += time.perf_counter() - start
+                if chunk is None:
+                    break
+                size += len(chunk)
+                yield chunk
+        finally:
+            if self.received is not None:
+                self.received.inc(size)
+            if self.timing is not None:
+                self.timing.add('body', self.waiting)
 
+    def close(self):
+        self.resp.close()
 
-def _send_request(request, service, extra_path=None, request_params=None):
 
+class RewrittenResponse(BufferedResponse):
+    """
+    Streams a capabilities document with the service urls replaced by the public url.
+    """
+    def __init__(self, resp, url, prev_url=None, received=None, timing=None, rewrite_seconds=None):
+        super(RewrittenResponse, self).__init__(resp, received=received, timing=timing)
+        self.url = url
+        self.prev_url = prev_url
+        # histogram of the time spent rewriting
+        self.rewrite_seconds = rewrite_seconds
+
+    def _measured(self):
+        return self.rewrite_seconds is not None or super(RewrittenResponse, self)._measured()
+
+    def __iter__(self):
+        rewritten = iter_replace_caps_url(super(RewrittenResponse, self).__iter__(), self.url, self.prev_url)
+        if not self._measured():
+            return rewritten
+        return self._iter_timed(rewritten)
+
+    def _iter_timed(self, rewritten):
+        spent = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                chunk = next(rewritten, None)
+                spent += time.perf_counter() - start
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            # the time spent waiting for the service is not rewrite time
+            spent -= self.waiting
+            if self.rewrite_seconds is not None:
+                self.rewrite_seconds.observe(spent)
+            if self.timing is not None:
+                self.timing.add('rewrite', spent)
+
+
+class CachingAppIter(object):
+    """
+    Passes the chunks of a response through and stores the complete body in the capabilities cache.
+    """
+    def __init__(self, app_iter, cache, key, service, response):
+        self.app_iter = app_iter
+        self.cache = cache
+        self.key = key
+        self.service = service
+        self.response = response
+
+    def __iter__(self):
+        chunks = []
+        size = 0
+        for chunk in self.app_iter:
+            if chunks is not None:
+                size += len(chunk)
+                if size > self.cache.max_entry_size:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            self.cache.store(self.key, self.service, b''.join(chunks),
+                             status=self.response.status_code,
+                             content_type=self.response.headers.get('Content-Type'),
+                             etag=self.response.headers.get('ETag'),
+                             last_modified=self.response.headers.get('Last-Modified'))
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
+class TileCachingAppIter(object):
+    """
+    Passes the chunks of a response through and writes them to the tile cache.
+    The tile is stored when the complete image has been sent.
+    """
+    def __init__(self, app_iter, writer):
+        self.app_iter = app_iter
+        self.writer = writer
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            if self.writer is not None and not self.writer.write(chunk):
+                self.writer = None
+            yield chunk
+        if self.writer is not None:
+            self.writer.commit()
+            self.writer = None
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            # the client went away before the image was sent
+            if self.writer is not None:
+                self.writer.abort()
+                self.writer = None
+
+
+def _public_url(request, service):
+    # ... if public URL is not configured use proxy url.
+    if service.has_purl():
+        return service.get('purl')
+    return request.route_url('owsproxy', service_name=service['name'])
+
+
+def _coalesce_key(request, service, extra_path=None, extra_headers=None):
+    """
+    Returns the key of identical GET requests or ``None`` when the request is not coalesced.
+    """
+    if request.method != 'GET' or request.content_length or 'Transfer-Encoding' in request.headers:
+        return None
+    params = []
+    for key, value in request.params.items():
+        key = key.lower()
+        if key in ('token', 'access_token'):
+            continue
+        if key in ('service', 'request'):
+            value = value.lower()
+        params.append((key, value))
+    ows_params = dict(params)
+    # e.g. WPS Execute requests are sent on their own
+    if ows_params.get('request') not in coalesced_request_types.get(ows_params.get('service'), ()):
+        return None
+    headers = tuple(request.headers.get(name) for name in coalesce_key_headers)
+    # the service urls in the documents are replaced by the public url
+    return (service.name, _public_url(request, service), extra_path, tuple(sorted(params)), headers,
+            tuple(sorted((extra_headers or {}).items())))
+
+
+def _send_coalesced(request, service, extra_path=None, request_params=None, extra_headers=None):
+    """
+    Sends the request to the service. Identical GET requests in flight share one request.
+    """
+    coalescer = get_coalescer(request.registry)
+    key = None
+    if coalescer is not None:
+        key = _coalesce_key(request, service, extra_path, extra_headers)
+    if key is None:
+        return _send_request(request, service, extra_path, request_params, extra_headers)
+    response, coalesced = coalescer.send(
+        key, lambda: _send_request(request, service, extra_path, request_params, extra_headers))
+    if coalesced:
+        get_metrics(request.registry).coalesced_requests.labels(service=service.name).inc()
+    return response
+
+
+def _send_request(request, service, extra_path=None, request_params=None, extra_headers=None):
+    """
+    Sends the request to the service within its concurrency limits, unless its circuit breaker is open.
+    """
+    breaker = trial = None
+    breakers = get_breakers(request.registry)
+    if breakers is not None:
+        breaker = breakers.get(service.name)
+        trial = breaker.allow()
+        if not trial:
+            get_metrics(request.registry).upstream_rejected.labels(service=service.name, reason='circuit_open').inc()
+            return OWSServerBusy("Service {} is unavailable, try again later.".format(service.name))
+    try:
+        slot = get_bulkheads(request.registry).acquire(service, request_labels(request)['request'])
+    except ServiceBusy as e:
+        get_metrics(request.registry).upstream_rejected.labels(service=service.name, reason=e.reason).inc()
+        LOGGER.warning("Service %s is busy: %s", service.name, e)
+        return OWSServerBusy("Service {} is busy: {}".format(service.name, e))
+    # the concurrency slot and the backend lease of the request
+    held = [slot] if slot is not None else []
+    try:
+        response = _forward_request(request, service, extra_path, request_params, extra_headers, breaker, held,
+                                    trial)
+    except Exception:
+        Slot(held).release()
+        raise
+    if not held:
+        return response
+    if isinstance(response, OWSException):
+        Slot(held).release()
+    else:
+        # the slot is held until the response body is sent
+        response.app_iter = ReleasingAppIter(response.app_iter, Slot(held))
+    return response
+
+
+def _service_url(url, extra_path=None, request_params=None):
     # TODO: fix way to build url
-    url = service['url']
     if extra_path:
         url += '/' + extra_path
     if request_params:
         url += '?' + request_params
     LOGGER.debug('url = %s', url)
+    return url
+
+
+def _is_backend_failure(status, content_type, read_body):
+    """
+    Returns true when a response shows a failure of the service, not an error in the request of the client:
+    a 5xx response without an OWS exception report. ``read_body`` returns the body of an XML response.
+    """
+    if status < 500:
+        return False
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in ows_exception_content_types:
+        return False
+    if 'xml' not in content_type:
+        return True
+    try:
+        return b'ExceptionReport' not in read_body()
+    except Exception:
+        return True
+
+
+def _forward_request(request, service, extra_path=None, request_params=None, extra_headers=None, breaker=None,
+                     held=None, trial=None):
 
     # forward request to target (without Host Header)
     h = dict(request.headers)
     h.pop("Host", h)
+    # the body is sent with a length or chunked by requests
+    h.pop("Transfer-Encoding", None)
     h['Accept-Encoding'] = None
+    if extra_headers:
+        h.update(extra_headers)
+    # reuse pooled keep-alive connections to the service
+    sessions = get_sessionregistry(request.registry)
+    session = sessions.get_session(service.name, verify=service.verify)
+    # the body is streamed from wsgi.input
+    data = body_stream(request)
+    metrics = get_metrics(request.registry)
+    if data is not None:
+        # unknown for chunked request bodies
+        sent = len(data) if isinstance(data, bytes) else data.len
+        if sent:
+            metrics.upstream_sent_bytes.labels(service=service.name).inc(sent)
+    balancer = None
+    retries = 0
+    if len(service.urls) > 1:
+        balancers = get_balancers(request.registry)
+        balancers.ensure_started()
+        balancer = balancers.get(service)
+        if data is None and request.method.upper() in retried_methods:
+            retries = len(service.urls) - 1
+    tried = []
+    timing = get_timing(request)
+    lease = balancer.choose() if balancer is not None else None
+    while True:
+        backend_url = service.url
+        current = lease
+        if current is not None:
+            backend_url = current.endpoint.url
+            held.append(current)
+        url = _service_url(backend_url, extra_path, request_params)
+        error = resp = None
+        start = time.perf_counter()
+        try:
+            resp = session.request(method=request.method.upper(), url=url, data=data, headers=h,
+                                   stream=True, verify=service.verify, timeout=sessions.timeout)
+        except Exception as e:
+            error = e
+        elapsed = time.perf_counter() - start
+        metrics.upstream_seconds.labels(**dict(request_labels(request), service=service.name)).observe(elapsed)
+        if timing is not None:
+            timing.add('upstream', elapsed)
+        if len(tried) >= retries or (resp is not None and resp.status_code not in retried_status_codes):
+            break
+        tried.append(backend_url)
+        lease = balancer.choose(exclude=tried)
+        if lease is None:
+            # all backends were tried
+            break
+        LOGGER.warning("Request to backend %s of service %s failed, trying another backend.",
+                       backend_url, service.name)
+        if resp is not None:
+            resp.close()
+        if current is not None:
+            held.remove(current)
+            current.release()
+        metrics.upstream_retries.labels(service=service.name).inc()
+    if error is not None:
+        metrics.upstream_responses.labels(service=service.name, status='error').inc()
+        if breaker is not None:
+            breaker.record(True, elapsed, trial=trial)
+        return OWSAccessFailed("Request failed: {}".format(error))
+    metrics.upstream_responses.labels(service=service.name, status=resp.status_code).inc()
+    if breaker is not None:
+        # error documents are small, the body is kept for the client
+        failed = _is_backend_failure(resp.status_code, resp.headers.get('Content-Type'), lambda: resp.content)
+        breaker.record(failed, elapsed, trial=trial)
+    received = None
+    if metrics.enabled:
+        received = metrics.upstream_received_bytes.labels(service=service.name)
     #
     service_type = service['type']
     if service_type and (service_type.lower() != 'wps'):
-        try:
-            resp_iter = requests.request(method=request.method.upper(), url=url, data=request.body, headers=h,
-                                         stream=True, verify=service.verify)
-        except Exception as e:
-            return OWSAccessFailed("Request failed: {}".format(e))
-
         # Headers meaningful only for a single transport-level connection
         HopbyHop = ['Connection', 'Keep-Alive', 'Public', 'Proxy-Authenticate', 'Transfer-Encoding', 'Upgrade']
-        return Response(app_iter=BufferedResponse(resp_iter),
-                        headers={k: v for k, v in list(resp_iter.headers.items()) if k not in HopbyHop})
+        return Response(app_iter=BufferedResponse(resp, received=received, timing=timing), status=resp.status_code,
+                        headers={k: v for k, v in list(resp.headers.items()) if k not in HopbyHop})
     else:
-        try:
-            resp = requests.request(method=request.method.upper(), url=url, data=request.body, headers=h,
-                                    verify=service.verify)
-        except Exception as e:
-            return OWSAccessFailed("Request failed: {}".format(e))
-
         if resp.ok is False:
             if 'ExceptionReport' in resp.text:
                 pass
             else:
+                resp.close()
                 return OWSAccessFailed("Response is not ok: {}".format(resp.reason))
 
         # check for allowed content types
@@ -101,6 +443,7 @@ def _send_request(request, service, extra_path=None, request_params=None):
         if "Content-Type" in resp.headers:
             ct = resp.headers["Content-Type"]
             if not ct.split(";")[0] in allowed_content_types:
+                resp.close()
                 msg = "Content type is not allowed: {}.".format(ct)
                 LOGGER.error(msg)
                 return OWSAccessForbidden(msg)
@@ -108,42 +451,182 @@ def _send_request(request, service, extra_path=None, request_params=None):
             # return OWSAccessFailed("Could not get content type from response.")
             LOGGER.warn("Could not get content type from response")
 
-        try:
-            if ct in ['text/xml', 'application/xml', 'text/xml;charset=ISO-8859-1']:
-                # replace urls in xml content
-                # ... if public URL is not configured use proxy url.
-                if service.has_purl():
-                    public_url = service.get('purl')
-                else:
-                    public_url = request.route_url('owsproxy', service_name=service['name'])
-                # TODO: where do i need to replace urls?
-                content = replace_caps_url(resp.content, public_url, service.get('url'))
-            else:
-                # raw content
-                content = resp.content
-        except Exception:
-            return OWSAccessFailed("Could not decode content.")
-
         headers = {}
         if ct:
             headers["Content-Type"] = ct
-        return Response(content, status=resp.status_code, headers=headers)
+        for name in validator_headers:
+            if name in resp.headers:
+                headers[name] = resp.headers[name]
+
+        if needs_url_rewrite(ct):
+            # replace urls in xml content
+            public_url = _public_url(request, service)
+            # TODO: where do i need to replace urls?
+            # the rewritten document is streamed to the client chunk by chunk.
+            rewrite_seconds = None
+            if metrics.enabled:
+                rewrite_seconds = metrics.rewrite_seconds.labels(service=service.name)
+            return Response(app_iter=RewrittenResponse(resp, public_url, backend_url, received=received,
+                                                       timing=timing, rewrite_seconds=rewrite_seconds),
+                            status=resp.status_code, headers=headers)
+
+        # raw content is passed through as it arrives
+        if 'Content-Length' in resp.headers:
+            headers['Content-Length'] = resp.headers['Content-Length']
+        return Response(app_iter=BufferedResponse(resp, received=received, timing=timing), status=resp.status_code,
+                        headers=headers)
 
 
 def owsproxy(request):
     """
     TODO: use ows exceptions
     """
+    get_metrics(request.registry).ensure_started()
     try:
         service_name = request.matchdict.get('service_name')
         extra_path = request.matchdict.get('extra_path')
         store = servicestore_factory(request.registry)
-        service = store.fetch_by_name(service_name)
+        service = fetch_service_by_name(request, store, service_name)
     except Exception as err:
         # TODO: Store impl should raise appropriate exception like not authorized
         return OWSAccessFailed("Could not find service {0} : {1}.".format(service_name, err))
     else:
-        return _send_request(request, service, extra_path, request_params=request.query_string)
+        cache = get_capscache(request.registry)
+        if cache is not None and not extra_path:
+            key = _caps_cache_key(request, service, cache)
+            if key is not None:
+                return _send_cached_request(request, service, cache, key)
+        tilecache = get_tilecache(request.registry)
+        if tilecache is not None and not extra_path:
+            key = _tile_cache_key(request, service, tilecache)
+            if key is not None:
+                tilecache.ensure_started()
+                return _send_tile_request(request, service, tilecache, key)
+        return _send_coalesced(request, service, extra_path, request_params=request.query_string)
+
+
+def _caps_cache_key(request, service, cache):
+    """
+    Returns the cache key of a public GET request or ``None`` when the response can not be cached.
+    """
+    if request.method != 'GET':
+        return None
+    params = {key.lower(): value for key, value in request.params.items()}
+    service_type = params.get('service', '').lower()
+    request_type = params.get('request', '').lower()
+    if request_type not in public_request_types.get(service_type, ()):
+        return None
+    params['service'] = service_type
+    params['request'] = request_type
+    return cache.key(service, params, _public_url(request, service))
+
+
+def _cached_response(cached):
+    headers = {}
+    if cached.content_type:
+        headers['Content-Type'] = cached.content_type
+    if cached.etag:
+        headers['ETag'] = cached.etag
+    if cached.last_modified:
+        headers['Last-Modified'] = cached.last_modified
+    return Response(cached.body, status=cached.status, headers=headers, conditional_response=True)
+
+
+def _conditional_headers(cached):
+    """
+    Returns the request headers revalidating an expired document of the capabilities cache.
+    """
+    headers = {}
+    if cached is not None:
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+    return headers
+
+
+def _send_cached_request(request, service, cache, key):
+    """
+    Answers public requests from the capabilities cache. Expired documents are revalidated.
+    """
+    cached, fresh = cache.lookup(key, service)
+    if fresh:
+        LOGGER.debug('Serving %s from capabilities cache.', key[1])
+        return _cached_response(cached)
+    extra_headers = _conditional_headers(cached)
+    response = _send_coalesced(request, service, request_params=request.query_string, extra_headers=extra_headers)
+    if isinstance(response, OWSException):
+        return response
+    if extra_headers and response.status_code == 304:
+        # releases the connection, the concurrency slot, the backend lease and the coalesced request
+        if hasattr(response.app_iter, 'close'):
+            response.app_iter.close()
+        cache.revalidated(key, service)
+        return _cached_response(cached)
+    # the document of a coalesced request is stored by the first request
+    if response.status_code == 200 and not isinstance(response.app_iter, FollowerAppIter):
+        response.app_iter = CachingAppIter(response.app_iter, cache, key, service, response)
+    return response
+
+
+def _tile_cache_key(request, service, tilecache):
+    """
+    Returns the tile cache key of a WMS GetMap or GetLegendGraphic request or ``None`` when the image
+    can not be cached.
+    """
+    if request.method != 'GET' or service.type.lower() != 'wms':
+        return None
+    # responses which may depend on the client, e.g. on its credentials, are not shared
+    if any(name in request.headers for name in coalesce_key_headers):
+        return None
+    params = {key.lower(): value for key, value in request.params.items()}
+    request_type = params.get('request', '').lower()
+    if request_type not in TILE_REQUEST_TYPES:
+        return None
+    params['service'] = params.get('service', '').lower()
+    params['request'] = request_type
+    return tilecache.key(service, params, _public_url(request, service))
+
+
+def _tile_response(request, tile):
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        app_iter = file_wrapper(tile.fh, BLOCK_SIZE)
+    else:
+        app_iter = MappedFileIter(tile.fh, tile.offset)
+    headers = {'Content-Length': str(tile.size)}
+    if tile.content_type:
+        headers['Content-Type'] = tile.content_type
+    return Response(app_iter=app_iter, status=200, headers=headers)
+
+
+def _storable_tile(response):
+    # OWS exceptions are returned with status 200 by some services
+    if response.status_code != 200 or not response.headers.get('Content-Type', '').startswith('image/'):
+        return False
+    cache_control = response.headers.get('Cache-Control', '').lower()
+    return 'no-store' not in cache_control and 'private' not in cache_control
+
+
+def _send_tile_request(request, service, tilecache, key):
+    """
+    Answers WMS GetMap and GetLegendGraphic requests from the tile cache.
+    """
+    metrics = get_metrics(request.registry)
+    tile = tilecache.lookup(key, service)
+    if tile is not None:
+        metrics.tile_cache_requests.labels(service=service.name, result='hit').inc()
+        return _tile_response(request, tile)
+    metrics.tile_cache_requests.labels(service=service.name, result='miss').inc()
+    response = _send_coalesced(request, service, request_params=request.query_string)
+    if isinstance(response, OWSException):
+        return response
+    # the tile of a coalesced request is stored by the first request
+    if _storable_tile(response) and not isinstance(response.app_iter, FollowerAppIter):
+        writer = tilecache.writer(key, service, response.headers['Content-Type'])
+        if writer is not None:
+            response.app_iter = TileCachingAppIter(response.app_iter, writer)
+    return response
 
 
 def owsproxy_delegate(request):
@@ -162,8 +645,10 @@ def owsproxy_delegate(request):
     # forward request to target (without Host Header)
     # h = dict(request.headers)
     # h.pop("Host", h)
-    resp = requests.request(method=request.method.upper(), url=url, data=request.body,
-                            headers=request.headers, verify=False)
+    sessions = get_sessionregistry(request.registry)
+    session = sessions.get_session('__delegate__', verify=False)
+    resp = session.request(method=request.method.upper(), url=url, data=body_stream(request),
+                           headers=request.headers, verify=False, timeout=sessions.timeout)
     return Response(resp.content, status=resp.status_code, headers=resp.headers)
 
 
@@ -173,6 +658,9 @@ def includeme(config):
     if asbool(settings.get('twitcher.ows_proxy', True)):
         LOGGER.debug('Twitcher {}/proxy enabled.'.format(protected_path))
 
+        # pooled http sessions to the services
+        config.include('twitcher.sessions')
+
         config.add_route('owsproxy', protected_path + '/proxy/{service_name}')
         # TODO: maybe configure extra path
         config.add_route('owsproxy_extra', protected_path + '/proxy/{service_name}/{extra_path:.*}')
@@ -187,7 +675,7 @@ def includeme(config):
             # include twitcher config
             config.include('twitcher.config')
             # include mongodb
-            # config.include('twitcher.db')
+            config.include('twitcher.db')
             config.add_view(owsproxy, route_name='owsproxy')
             config.add_view(owsproxy, route_name='owsproxy_secured')
             config.add_view(owsproxy, route_name='owsproxy_extra')
@@ -11,7 +11,7 @@ from pyramid.httpexceptions import HTTPBadRequest
 from twitcher.owsexceptions import (OWSNoApplicableCode,
                                     OWSInvalidParameterValue,
                                     OWSMissingParameterValue)
-from twitcher.utils import lxml_strip_ns
+from twitcher.requestbody import peek_body, spool_body
 
 import logging
 logger = logging.getLogger(__name__)
@@ -28,6 +28,10 @@ public_request_types = {'wps': ('getcapabilities', 'describeprocess'),
                         'wms': ('getcapabilities', )}
 allowed_versions = {'wps': ('1.0.0',), 'wms': ('1.1.1', '1.3.0',)}
 
+# only the start of POST bodies is read to find the root element.
+SNIFF_CHUNK_SIZE = 4 * 1024
+SNIFF_MAX_SIZE = 64 * 1024
+
 
 class OWSRequest(object):
     """
@@ -132,22 +136,53 @@ class Get(OWSParser):
             return version
 
 
+def sniff_root_element(xml, complete=True):
+    """
+    Returns the root element of the XML document ``xml`` (bytes) without parsing its content.
+
+    WPS Execute requests can be very large, but only the root tag and its attributes are needed.
+    The document is fed in small slices to a pull parser which stops at the start of the root element.
+    Returns ``None`` when ``xml`` is only the start of an incomplete document and the root element
+    has not started yet.
+    """
+    view = memoryview(xml)
+    parser = lxml.etree.XMLPullParser(events=('start',))
+    for offset in range(0, len(view), SNIFF_CHUNK_SIZE):
+        parser.feed(view[offset:offset + SNIFF_CHUNK_SIZE].tobytes())
+        for _, element in parser.read_events():
+            return element
+    if not complete:
+        return None
+    # raises a syntax error
+    return parser.close()
+
+
 class Post(OWSParser):
 
     def __init__(self, request):
         super(Post, self).__init__(request)
 
         try:
-            xml = self.request.body
-            self.document = lxml.etree.fromstring(xml)
-            lxml_strip_ns(self.document)
+            # the body is not consumed, it is forwarded to the service
+            prefix = peek_body(self.request, SNIFF_MAX_SIZE)
+            root = sniff_root_element(prefix, complete=len(prefix) < SNIFF_MAX_SIZE)
+            if root is None:
+                # the root element does not start within the prefix
+                body = spool_body(self.request)
+                try:
+                    root = lxml.etree.parse(body).getroot()
+                finally:
+                    body.seek(0)
         except Exception as e:
             raise OWSNoApplicableCode("{}".format(e))
+        # root tag without namespace
+        self.tag = lxml.etree.QName(root).localname
+        self.attrib = dict(root.attrib)
 
     def _get_service(self):
         """Check mandatory service name parameter in POST request."""
-        if "service" in self.document.attrib:
-            value = self.document.attrib["service"].lower()
+        if "service" in self.attrib:
+            value = self.attrib["service"].lower()
             if value in allowed_service_types:
                 self.params["service"] = value
             else:
@@ -158,7 +193,7 @@ class Post(OWSParser):
 
     def _get_request_type(self):
         """Find requested request type in POST request."""
-        value = self.document.tag.lower()
+        value = self.tag.lower()
         if value in allowed_request_types[self.params['service']]:
             self.params["request"] = value
         else:
@@ -167,8 +202,8 @@ class Post(OWSParser):
 
     def _get_version(self):
         """Find requested version in POST request."""
-        if "version" in self.document.attrib:
-            value = self.document.attrib["version"].lower()
+        if "version" in self.attrib:
+            value = self.attrib["version"].lower()
             if value in allowed_versions[self.params['service']]:
                 self.params["version"] = value
             else:
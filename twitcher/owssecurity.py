@@ -1,22 +1,34 @@
-import tempfile
+import time
 
 from twitcher.exceptions import AccessTokenNotFound
+from twitcher.exceptions import InvalidAccessToken
 from twitcher.exceptions import ServiceNotFound
 from twitcher.owsexceptions import OWSAccessForbidden, OWSInvalidParameterValue
 from twitcher.utils import path_elements
 from twitcher.store import tokenstore_factory
 from twitcher.store import servicestore_factory
+from twitcher.tokengenerator import tokengenerator_factory
+from twitcher.store.cached import fetch_service_by_name
 from twitcher.utils import parse_service_name
 from twitcher.owsrequest import OWSRequest
-from twitcher.esgf import fetch_certificate, ESGF_CREDENTIALS
+from twitcher.esgf import fetch_certificate, get_credentialscache, get_keypool, credentials_cipher_factory
+from twitcher.esgf import ESGF_CREDENTIALS
 from twitcher.datatype import Service
+from twitcher.workdir import create_workdir
+from twitcher.metrics import get_metrics, request_labels
+from twitcher.timing import record_timing
 
 import logging
 LOGGER = logging.getLogger("TWITCHER")
 
 
 def owssecurity_factory(registry):
-    return OWSSecurity(tokenstore_factory(registry), servicestore_factory(registry))
+    return OWSSecurity(tokenstore_factory(registry), servicestore_factory(registry),
+                       tokengenerator=tokengenerator_factory(registry),
+                       credentials=get_credentialscache(registry),
+                       keypool=get_keypool(registry),
+                       cipher=credentials_cipher_factory(registry),
+                       metrics=get_metrics(registry))
 
 
 def verify_cert(request):
@@ -26,9 +38,15 @@ def verify_cert(request):
 
 class OWSSecurity(object):
 
-    def __init__(self, tokenstore, servicestore):
+    def __init__(self, tokenstore, servicestore, tokengenerator=None, credentials=None, keypool=None,
+                 cipher=None, metrics=None):
         self.tokenstore = tokenstore
         self.servicestore = servicestore
+        self.tokengenerator = tokengenerator
+        self.credentials = credentials
+        self.keypool = keypool
+        self.cipher = cipher
+        self.metrics = metrics
 
     def get_token_param(self, request):
         token = None
@@ -46,13 +64,30 @@ class OWSSecurity(object):
 
     def prepare_headers(self, request, access_token):
         if "esgf_access_token" in access_token.data or "esgf_credentials" in access_token.data:
-            workdir = tempfile.mkdtemp(prefix=request.prefix, dir=request.workdir)
-            if fetch_certificate(workdir=workdir, data=access_token.data):
+            start = time.perf_counter()
+            workdir = self.fetch_credentials(request, access_token)
+            record_timing(request, 'esgf', time.perf_counter() - start)
+            if workdir:
                 request.headers['X-Requested-Workdir'] = workdir
                 request.headers['X-X509-User-Proxy'] = workdir + '/' + ESGF_CREDENTIALS
                 LOGGER.debug("Prepared request headers.")
         return request
 
+    def fetch_credentials(self, request, access_token):
+        """
+        Returns a workdir with the ESGF credentials of the access token or ``None`` when they could not be fetched.
+        The workdir is reused while the certificate is valid.
+        """
+        def workdir_factory():
+            return create_workdir(request, expires_at=access_token.expires_at or None)
+
+        if self.credentials is not None:
+            return self.credentials.fetch(access_token, workdir_factory)
+        workdir = workdir_factory()
+        if fetch_certificate(workdir=workdir, data=access_token.data, keypool=self.keypool, cipher=self.cipher):
+            return workdir
+        return None
+
     def verify_access(self, request, service):
         # TODO: public service access handling is confusing.
         try:
@@ -64,36 +99,84 @@ class OWSSecurity(object):
             if not service.public:
                 raise
 
+    def _count_token(self, outcome):
+        if self.metrics is not None:
+            self.metrics.token_validations.labels(outcome=outcome).inc()
+
     def _verify_access_token(self, request):
         try:
             # try to get access_token ... if no access restrictions then don't complain.
             token = self.get_token_param(request)
-            access_token = self.tokenstore.fetch_by_token(token)
+            start = time.perf_counter()
+            try:
+                access_token = self.fetch_access_token(token, request_labels(request)['service'])
+            finally:
+                record_timing(request, 'token_lookup', time.perf_counter() - start)
             if access_token.is_expired():
+                self._count_token('expired')
                 raise OWSAccessForbidden("Access token is expired.")
+            self._count_token('valid')
             # update request with data from access token
             # request.environ.update(access_token.data)
             # TODO: is this realy the way we want to do this?
             request = self.prepare_headers(request, access_token)
         except AccessTokenNotFound:
+            self._count_token('not_found')
             raise OWSAccessForbidden("Access token is required to access this service.")
+        except InvalidAccessToken as err:
+            self._count_token('invalid')
+            raise OWSAccessForbidden("Access token is invalid: {}".format(err))
+
+    def fetch_access_token(self, token, service_name=''):
+        """
+        Returns the access token. Signed tokens are validated without accessing the token store.
+        ``service_name`` labels the duration of the token store lookup.
+        """
+        access_token = None
+        if self.tokengenerator is not None:
+            access_token = self.tokengenerator.validate(token)
+        if access_token is None:
+            start = time.perf_counter()
+            try:
+                access_token = self.tokenstore.fetch_by_token(token)
+            finally:
+                if self.metrics is not None:
+                    self.metrics.store_seconds.labels(service=service_name, store='token').observe(
+                        time.perf_counter() - start)
+        return access_token
 
     def check_request(self, request):
         protected_path = request.registry.settings.get('twitcher.ows_proxy_protected_path ', '/ows')
         if request.path.startswith(protected_path):
-            # TODO: refactor this code
+            start = time.perf_counter()
             try:
-                service_name = parse_service_name(request.path, protected_path)
-                service = self.servicestore.fetch_by_name(service_name)
-                if service.public is True:
-                    LOGGER.warn('public access for service %s', service_name)
-            except ServiceNotFound:
-                # TODO: why not raising an exception?
-                service = Service(url='unregistered', public=False, auth='token')
-                LOGGER.warn("Service not registered.")
+                self._check_ows_request(request, protected_path)
+            finally:
+                if self.metrics is not None:
+                    self.metrics.security_seconds.labels(**request_labels(request)).observe(
+                        time.perf_counter() - start)
+
+    def _check_ows_request(self, request, protected_path):
+        # TODO: refactor this code
+        try:
+            service_name = parse_service_name(request.path, protected_path)
+            service = fetch_service_by_name(request, self.servicestore, service_name)
+            # used as metrics label, unregistered names are not
+            request.environ['twitcher.service_name'] = service.name
+            if service.public is True:
+                LOGGER.warn('public access for service %s', service_name)
+        except ServiceNotFound:
+            # TODO: why not raising an exception?
+            service = Service(url='unregistered', public=False, auth='token')
+            LOGGER.warn("Service not registered.")
+        start = time.perf_counter()
+        try:
             ows_request = OWSRequest(request)
-            if not ows_request.service_allowed():
-                raise OWSInvalidParameterValue(
-                    "service %s not supported" % ows_request.service, value="service")
-            if not ows_request.public_access():
-                self.verify_access(request, service)
+        finally:
+            record_timing(request, 'parse', time.perf_counter() - start)
+        if not ows_request.service_allowed():
+            raise OWSInvalidParameterValue(
+                "service %s not supported" % ows_request.service, value="service")
+        request.environ['twitcher.ows_request'] = ows_request.request
+        if not ows_request.public_access():
+            self.verify_access(request, service)
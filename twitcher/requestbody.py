@@ -0,0 +1,178 @@
+"""
+Streaming of request bodies.
+
+The OWS proxy forwards POST bodies from ``wsgi.input`` to the service without reading them into memory.
+The security checks only need the start of the body: :func:`peek_body` reads a prefix, which is
+replayed by :class:`BodyStream` when the body is forwarded with :func:`body_stream`.
+The body is spooled to a temporary file only when it must be read completely, see :func:`spool_body`.
+
+Bodies which are already in memory (read by webob) are used as they are.
+"""
+
+import io
+import tempfile
+
+import logging
+LOGGER = logging.getLogger("TWITCHER")
+
+CHUNK_SIZE = 64 * 1024
+
+# bodies spooled by spool_body are kept in memory up to this size
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+
+class BodyStream(object):
+    """
+    File-like object reading a peeked prefix and then the rest of ``stream``.
+
+    ``length`` is the number of bytes left in ``stream`` or ``None`` when it is read until EOF.
+    The ``len`` attribute is used by :mod:`requests` to send a ``Content-Length`` header,
+    streams of unknown length are sent with chunked transfer encoding.
+    """
+
+    def __init__(self, stream, length=None):
+        self.stream = stream
+        self.remaining = length
+        self._prefix = b''
+        self._pos = 0
+
+    @property
+    def len(self):
+        if self.remaining is None:
+            return None
+        return len(self._prefix) - self._pos + self.remaining
+
+    def _read_stream(self, size=-1):
+        if self.remaining is not None:
+            size = self.remaining if size < 0 else min(size, self.remaining)
+            if size == 0:
+                return b''
+        data = self.stream.read(size)
+        if self.remaining is not None:
+            # a truncated body ends early
+            self.remaining = self.remaining - len(data) if data else 0
+        return data
+
+    def peek(self, size):
+        """
+        Returns the next ``size`` bytes, or fewer at the end of the body, without consuming them.
+        """
+        available = len(self._prefix) - self._pos
+        if available < size:
+            chunks = [self._prefix[self._pos:]]
+            while available < size:
+                data = self._read_stream(size - available)
+                if not data:
+                    break
+                chunks.append(data)
+                available += len(data)
+            self._prefix = b''.join(chunks)
+            self._pos = 0
+        return self._prefix[self._pos:self._pos + size]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._prefix[self._pos:] + self._read_stream()
+            self._prefix, self._pos = b'', 0
+            return data
+        if self._pos < len(self._prefix):
+            data = self._prefix[self._pos:self._pos + size]
+            self._pos += len(data)
+            if self._pos == len(self._prefix):
+                self._prefix, self._pos = b'', 0
+                if len(data) < size:
+                    # short reads are taken as the end of the body by webob
+                    data += self._read_stream(size - len(data))
+            return data
+        return self._read_stream(size)
+
+    def read_buffered(self):
+        """
+        Returns the peeked bytes which are kept in memory and consumes them. The rest of the body
+        is read from :attr:`stream`.
+        """
+        data = self._prefix[self._pos:]
+        self._prefix, self._pos = b'', 0
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def spool(self, max_memory=SPOOL_MAX_MEMORY):
+        """
+        Copies the rest of the body to a temporary file, which is read from now on.
+        Returns the file positioned at the start of the body.
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        for chunk in self:
+            spool.write(chunk)
+        self.remaining = spool.tell()
+        spool.seek(0)
+        self.stream = spool
+        return spool
+
+
+def _in_memory(request):
+    # dummy requests have no wsgi.input, webob marks bodies it has read as seekable
+    environ = request.environ
+    return 'wsgi.input' not in environ or environ.get('webob.is_body_seekable', False)
+
+
+def _get_stream(request):
+    """
+    Returns the :class:`BodyStream` which replaces ``wsgi.input`` or ``None`` when there is no body.
+    """
+    environ = request.environ
+    stream = environ['wsgi.input']
+    if not isinstance(stream, BodyStream):
+        if not request.is_body_readable:
+            return None
+        stream = environ['wsgi.input'] = BodyStream(stream, request.content_length)
+    return stream
+
+
+def peek_body(request, size):
+    """
+    Returns the first ``size`` bytes of the request body without consuming it.
+    """
+    if _in_memory(request):
+        return getattr(request, 'body', b'')[:size]
+    stream = _get_stream(request)
+    if stream is None:
+        return b''
+    return stream.peek(size)
+
+
+def spool_body(request):
+    """
+    Returns a file with the complete request body, positioned at the start.
+    Rewind the file after reading it, it is forwarded to the service.
+    """
+    if _in_memory(request):
+        return io.BytesIO(getattr(request, 'body', b''))
+    stream = _get_stream(request)
+    if stream is None:
+        return io.BytesIO()
+    LOGGER.debug("Spooling request body.")
+    return stream.spool()
+
+
+def body_stream(request):
+    """
+    Returns the request body to be passed as ``data`` to :mod:`requests`: a file-like :class:`BodyStream`,
+    the body itself when it is already in memory, or ``None`` when there is no body.
+    """
+    if _in_memory(request):
+        return getattr(request, 'body', None) or None
+    stream = _get_stream(request)
+    if stream is None or stream.len == 0:
+        return None
+    if stream.len is None and not stream.peek(1):
+        # servers setting wsgi.input_terminated make the body of GET requests readable,
+        # an empty body would be sent chunked
+        return None
+    return stream
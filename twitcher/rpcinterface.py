@@ -7,25 +7,49 @@ from twitcher.api import IRegistry, Registry
 from twitcher.tokengenerator import tokengenerator_factory
 from twitcher.store import tokenstore_factory
 from twitcher.store import servicestore_factory
+from twitcher.cache import get_capscache
+from twitcher.esgf import get_credentialsfetcher
+from twitcher.breaker import get_breakers
+from twitcher.tilecache import get_tilecache
+from twitcher.sessions import get_sessionregistry
+from twitcher.balancer import get_balancers
 
 import logging
 LOGGER = logging.getLogger("TWITCHER")
 
 
+def service_listeners(registry):
+    """
+    Returns the callbacks invalidating the in-process caches when a service is changed.
+    """
+    listeners = [get_sessionregistry(registry).remove_session, get_balancers(registry).remove]
+    capscache = get_capscache(registry)
+    if capscache is not None:
+        listeners.append(capscache.invalidate)
+    tilecache = get_tilecache(registry)
+    if tilecache is not None:
+        listeners.append(tilecache.purge)
+    return listeners
+
+
 @view_defaults(permission='view', require_csrf=False)
 class RPCInterface(ITokenManager, IRegistry):
     def __init__(self, request):
         self.request = request
         self.tokenmgr = TokenManager(
             tokengenerator_factory(request.registry),
-            tokenstore_factory(request.registry))
-        self.srvreg = Registry(servicestore_factory(request.registry))
+            tokenstore_factory(request.registry),
+            credentials_fetcher=get_credentialsfetcher(request.registry))
+        self.srvreg = Registry(servicestore_factory(request.registry),
+                               listeners=service_listeners(request.registry),
+                               breakers=get_breakers(request.registry),
+                               tilecache=get_tilecache(request.registry))
 
-    def generate_token(self, valid_in_hours=1, environ=None):
+    def generate_token(self, valid_in_hours=1, environ=None, fetch_credentials=False):
         """
         Implementation of :meth:`twitcher.api.ITokenManager.generate_token`.
         """
-        return self.tokenmgr.generate_token(valid_in_hours, environ)
+        return self.tokenmgr.generate_token(valid_in_hours, environ, fetch_credentials)
 
     def revoke_token(self, token):
         """
@@ -39,6 +63,12 @@ class RPCInterface(ITokenManager, IRegistry):
         """
         return self.tokenmgr.revoke_all_tokens()
 
+    def purge_expired_tokens(self):
+        """
+        Implementation of :meth:`twitcher.api.ITokenManager.purge_expired_tokens`.
+        """
+        return self.tokenmgr.purge_expired_tokens()
+
     def register_service(self, url, data=None, overwrite=True):
         """
         Implementation of :meth:`twitcher.api.IRegistry.register_service`.
@@ -75,6 +105,18 @@ class RPCInterface(ITokenManager, IRegistry):
         """
         return self.srvreg.clear_services()
 
+    def list_breakers(self):
+        """
+        Implementation of :meth:`twitcher.api.IRegistry.list_breakers`.
+        """
+        return self.srvreg.list_breakers()
+
+    def purge_tile_cache(self, name=''):
+        """
+        Implementation of :meth:`twitcher.api.IRegistry.purge_tile_cache`.
+        """
+        return self.srvreg.purge_tile_cache(name)
+
 
 def includeme(config):
     """ The callable makes it possible to include rpcinterface
@@ -101,16 +143,20 @@ def includeme(config):
         # pyramid xml-rpc
         # http://docs.pylonsproject.org/projects/pyramid-rpc/en/latest/xmlrpc.html
         config.include('pyramid_rpc.xmlrpc')
-        # config.include('twitcher.db')
+        config.include('twitcher.db')
         config.add_xmlrpc_endpoint('api', '/RPC2')
 
         # register xmlrpc methods
         config.add_xmlrpc_method(RPCInterface, attr='generate_token', endpoint='api', method='generate_token')
         config.add_xmlrpc_method(RPCInterface, attr='revoke_token', endpoint='api', method='revoke_token')
         config.add_xmlrpc_method(RPCInterface, attr='revoke_all_tokens', endpoint='api', method='revoke_all_tokens')
+        config.add_xmlrpc_method(RPCInterface, attr='purge_expired_tokens', endpoint='api',
+                                 method='purge_expired_tokens')
         config.add_xmlrpc_method(RPCInterface, attr='register_service', endpoint='api', method='register_service')
         config.add_xmlrpc_method(RPCInterface, attr='unregister_service', endpoint='api', method='unregister_service')
         config.add_xmlrpc_method(RPCInterface, attr='get_service_by_name', endpoint='api', method='get_service_by_name')
         config.add_xmlrpc_method(RPCInterface, attr='get_service_by_url', endpoint='api', method='get_service_by_url')
         config.add_xmlrpc_method(RPCInterface, attr='clear_services', endpoint='api', method='clear_services')
         config.add_xmlrpc_method(RPCInterface, attr='list_services', endpoint='api', method='list_services')
+        config.add_xmlrpc_method(RPCInterface, attr='list_breakers', endpoint='api', method='list_breakers')
+        config.add_xmlrpc_method(RPCInterface, attr='purge_tile_cache', endpoint='api', method='purge_tile_cache')
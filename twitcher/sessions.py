@@ -0,0 +1,138 @@
+"""
+Keep-alive HTTP sessions used by the OWS proxy to talk to the registered services.
+
+Each registered service gets its own :class:`requests.Session` with a pooled transport adapter,
+so that connections to the backend are reused between requests.
+The session of a service is rebuilt when its ``verify`` setting changes and dropped when the service
+is registered again or unregistered. Replaced sessions are not closed, requests in other threads
+may still use them: they are closed when they are garbage collected.
+"""
+
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import logging
+LOGGER = logging.getLogger("TWITCHER")
+
+
+def _float_or_none(value):
+    if value in (None, ''):
+        return None
+    return float(value)
+
+
+class SessionRegistry(object):
+    """
+    Registry of pooled HTTP sessions keyed by service name.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, retries=0, backoff_factor=0,
+                 connect_timeout=None, read_timeout=None):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        """Timeout tuple ``(connect, read)`` passed to every upstream request."""
+        return (self.connect_timeout, self.read_timeout)
+
+    def _create_session(self, verify):
+        # connection errors are retried, read errors not: a WPS Execute must not be sent twice.
+        retry = Retry(
+            total=self.retries,
+            read=False,
+            backoff_factor=self.backoff_factor,
+            allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+            raise_on_status=False)
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.verify = verify
+        # sessions are shared by all users, never keep cookies set by a backend.
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        return session
+
+    def get_session(self, name, verify=True):
+        """
+        Returns the session for the service ``name``.
+        A new session is created when there is none or when ``verify`` has changed.
+        """
+        entry = self._sessions.get(name)
+        if entry is None or entry[0] != verify:
+            with self._lock:
+                entry = self._sessions.get(name)
+                if entry is None or entry[0] != verify:
+                    if entry is not None:
+                        LOGGER.debug("Rebuild http session for service %s.", name)
+                    entry = (verify, self._create_session(verify))
+                    self._sessions[name] = entry
+        return entry[1]
+
+    def remove_session(self, name=None):
+        """
+        Removes the session of service ``name``, or of all services when no name is given.
+        The sessions are not closed, they may still be used by requests in progress.
+        """
+        with self._lock:
+            if name:
+                self._sessions.pop(name, None)
+            else:
+                self._sessions = {}
+
+    def close(self):
+        """
+        Closes all sessions.
+        """
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for _, session in sessions.values():
+            session.close()
+
+
+def sessionregistry_factory(registry):
+    """
+    Creates a :class:`SessionRegistry` configured with the ``twitcher.ows_proxy_*`` settings.
+    """
+    settings = registry.settings
+    return SessionRegistry(
+        pool_connections=int(settings.get('twitcher.ows_proxy_pool_connections', 10)),
+        pool_maxsize=int(settings.get('twitcher.ows_proxy_pool_maxsize', 10)),
+        retries=int(settings.get('twitcher.ows_proxy_retries', 0)),
+        backoff_factor=float(settings.get('twitcher.ows_proxy_retry_backoff', 0)),
+        connect_timeout=_float_or_none(settings.get('twitcher.ows_proxy_connect_timeout', 10)),
+        read_timeout=_float_or_none(settings.get('twitcher.ows_proxy_read_timeout')),
+    )
+
+
+_lock = threading.Lock()
+
+
+def get_sessionregistry(registry):
+    """
+    Returns the :class:`SessionRegistry` shared by this process.
+    """
+    sessions = getattr(registry, 'sessions', None)
+    if sessions is None:
+        with _lock:
+            sessions = getattr(registry, 'sessions', None)
+            if sessions is None:
+                sessions = registry.sessions = sessionregistry_factory(registry)
+    return sessions
+
+
+def includeme(config):
+    get_sessionregistry(config.registry)
@@ -2,6 +2,8 @@
 Factories to create storage backends.
 """
 
+import threading
+
 # Interfaces
 from twitcher.store.base import AccessTokenStore
 
@@ -9,6 +11,26 @@ from twitcher.store.base import AccessTokenStore
 from twitcher.db import mongodb as _mongodb
 from twitcher.store.mongodb import MongodbTokenStore
 from twitcher.store.memory import MemoryTokenStore
+from twitcher.store.cached import CachedTokenStore, get_tokencache
+
+_lock = threading.Lock()
+
+
+def _database(registry):
+    settings = registry.settings or {}
+    return settings.get('twitcher.database') or 'mongodb'
+
+
+def _memory_store(registry, name, store_class):
+    # memory stores are shared by all components of an application, e.g. for benchmarks.
+    store = getattr(registry, name, None)
+    if store is None:
+        with _lock:
+            store = getattr(registry, name, None)
+            if store is None:
+                store = store_class()
+                setattr(registry, name, store)
+    return store
 
 
 def tokenstore_factory(registry, database=None):
@@ -16,33 +38,47 @@ def tokenstore_factory(registry, database=None):
     Creates a token store with the interface of :class:`twitcher.store.AccessTokenStore`.
     By default the mongodb implementation will be used.
 
+    The mongodb store is wrapped by a :class:`twitcher.store.cached.CachedTokenStore`
+    unless the token cache is disabled.
+
     :param database: A string with the store implementation name: "mongodb" or "memory".
+        Defaults to the ``twitcher.database`` setting.
     :return: An instance of :class:`twitcher.store.AccessTokenStore`.
     """
-    database = database or 'mongodb'
+    database = database or _database(registry)
     if database == 'mongodb':
         db = _mongodb(registry)
         store = MongodbTokenStore(db.tokens)
+        cache = get_tokencache(registry)
+        if cache is not None:
+            store = CachedTokenStore(store, cache)
     else:
-        store = MemoryTokenStore()
+        store = _memory_store(registry, 'memory_tokenstore', MemoryTokenStore)
     return store
 
 
 from twitcher.store.mongodb import MongodbServiceStore
 from twitcher.store.memory import MemoryServiceStore
+from twitcher.store.cached import CachedServiceStore, get_servicecache
 
 
 def servicestore_factory(registry, database=None):
     """
     Creates a service store with the interface of :class:`twitcher.store.ServiceStore`.
     By default the mongodb implementation will be used.
+    It is wrapped by a :class:`twitcher.store.cached.CachedServiceStore` unless the service cache is disabled.
 
+    :param database: A string with the store implementation name: "mongodb" or "memory".
+        Defaults to the ``twitcher.database`` setting.
     :return: An instance of :class:`twitcher.store.ServiceStore`.
     """
-    database = database or 'mongodb'
+    database = database or _database(registry)
     if database == 'mongodb':
         db = _mongodb(registry)
         store = MongodbServiceStore(collection=db.services)
+        cache = get_servicecache(registry, db)
+        if cache is not None:
+            store = CachedServiceStore(store, cache)
     else:
-        store = MemoryServiceStore()
+        store = _memory_store(registry, 'memory_servicestore', MemoryServiceStore)
     return store
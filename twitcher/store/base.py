@@ -43,6 +43,14 @@ class AccessTokenStore(object):
         """
         raise NotImplementedError
 
+    def purge_expired_tokens(self):
+        """
+        Removes all expired tokens from database.
+
+        :return: The number of removed tokens.
+        """
+        raise NotImplementedError
+
 
 class ServiceStore(object):
     """
@@ -0,0 +1,367 @@
+"""
+Read-through caches in front of a :class:`twitcher.store.ServiceStore` and
+a :class:`twitcher.store.AccessTokenStore`.
+
+Services are looked up on every proxied request but change rarely. The cache of a worker process is
+invalidated when a service is changed through this process, by MongoDB change streams when the
+database is a replica set, or else by polling a version counter which is incremented on every change.
+The ``listeners`` of the service cache, e.g. the capabilities cache, are invalidated with it.
+
+Access tokens are cached until they expire, but at most ``max_age`` seconds, which bounds the delay until
+a token revoked by another worker process is rejected. Unknown tokens are cached for a short time.
+"""
+
+import os
+import time
+import threading
+
+import pymongo.errors
+from pyramid.settings import asbool
+
+from twitcher.cache import LRUCache, get_capscache
+from twitcher.balancer import get_balancers
+from twitcher.datatype import Service, AccessToken
+from twitcher.exceptions import ServiceNotFound, AccessTokenNotFound
+from twitcher.metrics import get_metrics
+from twitcher.timing import record_timing
+from twitcher.store.base import ServiceStore, AccessTokenStore
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+_NOT_FOUND = object()
+
+
+class ServiceCache(object):
+    """
+    Process-level cache of services by name. Unknown names are cached for ``negative_ttl`` seconds
+    in a separate small LRU cache, so that requests for random names never evict registered services.
+    ``listeners`` are called with the name of the invalidated service (``None`` for all services).
+    """
+
+    def __init__(self, ttl=60, maxsize=1024, negative_ttl=5, negative_maxsize=256):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.watcher = None
+        self.listeners = []
+        self._cache = LRUCache(maxsize=maxsize)
+        self._unknown = LRUCache(maxsize=negative_maxsize)
+
+    def get(self, name):
+        if self.watcher is not None:
+            self.watcher.ensure_started()
+        service = self._cache.get(name)
+        if service is None:
+            service = self._unknown.get(name)
+        return service
+
+    def set(self, name, service):
+        if service is _NOT_FOUND:
+            if self.negative_ttl > 0:
+                self._unknown.set(name, service, ttl=self.negative_ttl)
+        else:
+            self._cache.set(name, service, ttl=self.ttl)
+
+    def invalidate(self, name=None):
+        """
+        Removes service ``name`` or all services from the cache.
+        """
+        if name is None:
+            self._cache.clear()
+            self._unknown.clear()
+        else:
+            self._cache.pop(name)
+            self._unknown.pop(name)
+        for listener in self.listeners:
+            listener(name)
+
+    def changed(self, name=None):
+        """
+        A service was changed by this process. Invalidates the cache and notifies the other processes.
+        """
+        self.invalidate(name)
+        if self.watcher is not None:
+            self.watcher.notify()
+
+
+class MongodbServiceWatcher(object):
+    """
+    Invalidates a :class:`ServiceCache` when the services collection is changed by another process.
+
+    Uses a change stream when available, otherwise polls the version counter of the services.
+    The watcher thread is started on first use in each worker process.
+    """
+
+    def __init__(self, db, cache, poll_interval=5, change_streams=True):
+        self.db = db
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self.change_streams = change_streams
+        self._pid = None
+        self._version = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._stopped.clear()
+                    thread = threading.Thread(target=self.run, name='twitcher-service-watcher')
+                    thread.daemon = True
+                    thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def notify(self):
+        """
+        Increments the version counter of the services.
+        """
+        try:
+            self.db.counters.update_one({'_id': 'services'}, {'$inc': {'version': 1}}, upsert=True)
+        except pymongo.errors.PyMongoError:
+            LOGGER.exception("Could not update version of services.")
+
+    def run(self):
+        use_change_streams = self.change_streams
+        while not self._stopped.is_set():
+            try:
+                if use_change_streams:
+                    self.watch()
+                else:
+                    self.poll()
+            except pymongo.errors.OperationFailure as err:
+                if use_change_streams:
+                    LOGGER.info("Change streams are not available (%s), polling services version.", err)
+                    use_change_streams = False
+                else:
+                    LOGGER.warning("Watching services failed: %s", err)
+                    self._stopped.wait(self.poll_interval)
+            except pymongo.errors.PyMongoError as err:
+                LOGGER.warning("Watching services failed: %s", err)
+                self.cache.invalidate()
+                self._stopped.wait(self.poll_interval)
+
+    def watch(self):
+        with self.db.services.watch(max_await_time_ms=int(self.poll_interval * 1000)) as stream:
+            # changes made before the stream was opened
+            self.cache.invalidate()
+            # the stream is closed by an invalidate event, e.g. when the collection is dropped
+            while stream.alive and not self._stopped.is_set():
+                if stream.try_next() is not None:
+                    LOGGER.debug("Services changed, invalidate cache.")
+                    self.cache.invalidate()
+        if not self._stopped.is_set():
+            LOGGER.debug("Services change stream closed, reopen it.")
+
+    def poll(self):
+        # changes made before the first poll are seen
+        self._version = self._read_version()
+        while not self._stopped.wait(self.poll_interval):
+            self.check_version()
+
+    def _read_version(self):
+        doc = self.db.counters.find_one({'_id': 'services'})
+        return doc['version'] if doc else 0
+
+    def check_version(self):
+        version = self._read_version()
+        if self._version is not None and version != self._version:
+            LOGGER.debug("Services version changed, invalidate cache.")
+            self.cache.invalidate()
+        self._version = version
+
+
+class CachedServiceStore(ServiceStore):
+    """
+    Wraps a :class:`twitcher.store.ServiceStore` and caches the services fetched by name.
+    """
+
+    def __init__(self, store, cache):
+        self.store = store
+        self.cache = cache
+
+    def save_service(self, service, overwrite=True):
+        service = self.store.save_service(service, overwrite=overwrite)
+        self.cache.changed(service.name)
+        return service
+
+    def delete_service(self, name):
+        result = self.store.delete_service(name)
+        self.cache.changed(name)
+        return result
+
+    def list_services(self):
+        return self.store.list_services()
+
+    def fetch_by_name(self, name):
+        service = self.cache.get(name)
+        if service is None:
+            try:
+                service = self.store.fetch_by_name(name)
+            except ServiceNotFound:
+                service = _NOT_FOUND
+            self.cache.set(name, service)
+        if service is _NOT_FOUND:
+            raise ServiceNotFound
+        return Service(service)
+
+    def fetch_by_url(self, url):
+        return self.store.fetch_by_url(url)
+
+    def clear_services(self):
+        result = self.store.clear_services()
+        self.cache.changed()
+        return result
+
+
+class TokenCache(object):
+    """
+    Process-level LRU cache of access tokens. Unknown tokens are cached for ``negative_ttl`` seconds.
+    """
+
+    def __init__(self, max_age=30, negative_ttl=5, maxsize=10000):
+        self.max_age = max_age
+        self.negative_ttl = negative_ttl
+        self._cache = LRUCache(maxsize=maxsize)
+
+    def get(self, token):
+        return self._cache.get(token)
+
+    def set(self, access_token):
+        ttl = min(access_token.expires_in, self.max_age)
+        if ttl > 0:
+            self._cache.set(access_token.token, access_token, ttl=ttl)
+
+    def set_not_found(self, token):
+        if self.negative_ttl > 0:
+            self._cache.set(token, _NOT_FOUND, ttl=self.negative_ttl)
+
+    def invalidate(self, token=None):
+        """
+        Removes ``token`` or all tokens from the cache.
+        """
+        if token is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(token)
+
+
+class CachedTokenStore(AccessTokenStore):
+    """
+    Wraps a :class:`twitcher.store.AccessTokenStore` and caches the tokens fetched by token string.
+    """
+
+    def __init__(self, store, cache):
+        self.store = store
+        self.cache = cache
+
+    def save_token(self, access_token):
+        result = self.store.save_token(access_token)
+        self.cache.invalidate(access_token.token)
+        return result
+
+    def delete_token(self, token):
+        result = self.store.delete_token(token)
+        self.cache.invalidate(token)
+        return result
+
+    def fetch_by_token(self, token):
+        access_token = self.cache.get(token)
+        if access_token is None:
+            try:
+                access_token = self.store.fetch_by_token(token)
+            except AccessTokenNotFound:
+                self.cache.set_not_found(token)
+                raise
+            self.cache.set(access_token)
+        elif access_token is _NOT_FOUND:
+            raise AccessTokenNotFound
+        return AccessToken(access_token)
+
+    def clear_tokens(self):
+        result = self.store.clear_tokens()
+        self.cache.invalidate()
+        return result
+
+    def purge_expired_tokens(self):
+        # expired tokens are never served from the cache
+        return self.store.purge_expired_tokens()
+
+
+def fetch_service_by_name(request, store, name):
+    """
+    Fetches service ``name`` once per request. The security tween and the proxy view share the result.
+    """
+    services = request.environ.setdefault('twitcher.services', {})
+    service = services.get(name)
+    if service is None:
+        start = time.perf_counter()
+        try:
+            service = services[name] = store.fetch_by_name(name)
+        finally:
+            elapsed = time.perf_counter() - start
+            # unregistered names are not used as label
+            label = name if name in services else ''
+            get_metrics(request.registry).store_seconds.labels(service=label, store='service').observe(elapsed)
+            record_timing(request, 'service_lookup', elapsed)
+    return service
+
+
+_lock = threading.Lock()
+
+
+def get_servicecache(registry, db=None):
+    """
+    Returns the :class:`ServiceCache` shared by this process or ``None`` when it is disabled
+    with the ``twitcher.service_cache`` setting.
+    """
+    try:
+        return registry.servicecache
+    except AttributeError:
+        pass
+    settings = registry.settings or {}
+    with _lock:
+        if not hasattr(registry, 'servicecache'):
+            cache = None
+            if asbool(settings.get('twitcher.service_cache', True)):
+                cache = ServiceCache(
+                    ttl=int(settings.get('twitcher.service_cache_ttl', 60)),
+                    maxsize=int(settings.get('twitcher.service_cache_max_size', 1024)),
+                    negative_ttl=int(settings.get('twitcher.service_cache_negative_ttl', 5)))
+                if db is not None:
+                    cache.watcher = MongodbServiceWatcher(
+                        db, cache,
+                        poll_interval=float(settings.get('twitcher.service_cache_poll_interval', 5)),
+                        change_streams=asbool(settings.get('twitcher.service_cache_change_streams', True)))
+                # services changed by other processes
+                cache.listeners.append(get_balancers(registry).remove)
+                capscache = get_capscache(registry)
+                if capscache is not None:
+                    cache.listeners.append(capscache.invalidate)
+            registry.servicecache = cache
+    return registry.servicecache
+
+
+def get_tokencache(registry):
+    """
+    Returns the :class:`TokenCache` shared by this process or ``None`` when it is disabled
+    with the ``twitcher.token_cache`` setting.
+    """
+    try:
+        return registry.tokencache
+    except AttributeError:
+        pass
+    settings = registry.settings or {}
+    with _lock:
+        if not hasattr(registry, 'tokencache'):
+            cache = None
+            if asbool(settings.get('twitcher.token_cache', True)):
+                cache = TokenCache(
+                    max_age=int(settings.get('twitcher.token_cache_ttl', 30)),
+                    negative_ttl=int(settings.get('twitcher.token_cache_negative_ttl', 5)),
+                    maxsize=int(settings.get('twitcher.token_cache_max_size', 10000)))
+            registry.tokencache = cache
+    return registry.tokencache
@@ -42,6 +42,12 @@ class MemoryTokenStore(AccessTokenStore):
     def clear_tokens(self):
         self.access_tokens = {}
 
+    def purge_expired_tokens(self):
+        expired = [token for token, access_token in self.access_tokens.items() if access_token.is_expired()]
+        for token in expired:
+            del self.access_tokens[token]
+        return len(expired)
+
 
 class MemoryServiceStore(ServiceStore):
     """
@@ -79,7 +85,16 @@ class MemoryServiceStore(ServiceStore):
             purl=service.purl,
             public=service.public,
             auth=service.auth,
-            verify=service.verify))
+            verify=service.verify,
+            cache_ttl=service.cache_ttl,
+            tile_cache_ttl=service.tile_cache_ttl,
+            max_concurrency=service.max_concurrency,
+            request_concurrency=service.request_concurrency,
+            max_queue=service.max_queue,
+            queue_timeout=service.queue_timeout,
+            urls=[baseurl(url) for url in service.urls],
+            balance=service.balance,
+            weights=service.weights))
         return self.fetch_by_name(name=name)
 
     def delete_service(self, name):
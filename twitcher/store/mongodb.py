@@ -1,6 +1,9 @@
 """
 Store adapters to read/write data to from/to mongodb using pymongo.
 """
+import calendar
+from datetime import datetime
+
 import pymongo
 
 from twitcher.store.base import AccessTokenStore
@@ -11,7 +14,7 @@ from twitcher.store.base import ServiceStore
 from twitcher.datatype import Service
 from twitcher.exceptions import ServiceNotFound
 from twitcher import namesgenerator
-from twitcher.utils import baseurl
+from twitcher.utils import baseurl, now_secs
 
 
 import logging
@@ -28,8 +31,16 @@ class MongodbStore(object):
 
 
 class MongodbTokenStore(AccessTokenStore, MongodbStore):
+    """
+    Stores access tokens in mongodb.
+
+    The expiry time ``expires_at`` is stored as a date, so that a TTL index can remove expired tokens.
+    """
+
     def save_token(self, access_token):
-        self.collection.insert_one(access_token)
+        doc = dict(access_token)
+        doc['expires_at'] = datetime.utcfromtimestamp(access_token.expires_at)
+        self.collection.insert_one(doc)
 
     def delete_token(self, token):
         self.collection.delete_one({'token': token})
@@ -38,10 +49,22 @@ class MongodbTokenStore(AccessTokenStore, MongodbStore):
         token = self.collection.find_one({'token': token})
         if not token:
             raise AccessTokenNotFound
+        if isinstance(token.get('expires_at'), datetime):
+            token['expires_at'] = calendar.timegm(token['expires_at'].utctimetuple())
         return AccessToken(token)
 
     def clear_tokens(self):
-        self.collection.drop()
+        # dropping the collection would also drop the token and TTL indexes
+        self.collection.delete_many({})
+
+    def purge_expired_tokens(self):
+        # tokens stored before expires_at was a date have an integer timestamp
+        result = self.collection.delete_many({'$or': [
+            {'expires_at': {'$lt': datetime.utcnow()}},
+            {'expires_at': {'$lt': now_secs()}},
+        ]})
+        LOGGER.debug("Purged %d expired tokens.", result.deleted_count)
+        return result.deleted_count
 
 
 class MongodbServiceStore(ServiceStore, MongodbStore):
@@ -71,7 +94,16 @@ class MongodbServiceStore(ServiceStore, MongodbStore):
             purl=service.purl,
             public=service.public,
             auth=service.auth,
-            verify=service.verify))
+            verify=service.verify,
+            cache_ttl=service.cache_ttl,
+            tile_cache_ttl=service.tile_cache_ttl,
+            max_concurrency=service.max_concurrency,
+            request_concurrency=service.request_concurrency,
+            max_queue=service.max_queue,
+            queue_timeout=service.queue_timeout,
+            urls=[baseurl(url) for url in service.urls],
+            balance=service.balance,
+            weights=service.weights))
         return self.fetch_by_name(name=name)
 
     def delete_service(self, name):
@@ -112,5 +144,6 @@ class MongodbServiceStore(ServiceStore, MongodbStore):
         """
         Removes all OWS services from mongodb storage.
         """
-        self.collection.drop()
+        # dropping the collection would also drop its indexes
+        self.collection.delete_many({})
         return True
@@ -0,0 +1,359 @@
+"""
+Disk cache of the WMS tiles (GetMap and GetLegendGraphic images) of the OWS proxy.
+
+Every tile is one file ``<directory>/<service>/<xx>/<sha1>.tile``: a JSON header line with the content type,
+the service url and the expiry time, followed by the image. A tile is written to a temporary file
+and renamed when the image is complete, so that other requests and worker processes never read
+a partial tile. Hits are served from the open file with the ``wsgi.file_wrapper`` of the server,
+or from a memory map of the file when the server has none.
+
+The tiles expire after the ``tile_cache_ttl`` of the service (``twitcher.ows_proxy_tile_cache_ttl``
+by default). Least recently used tiles are removed when the cache exceeds ``maxsize`` bytes.
+Each worker process keeps its own index of the tiles, filled with the tiles stored or served by the process.
+A background thread of each process reads the index from the directory at startup and again every
+``scan_interval`` seconds, so that the tiles of the other workers count against the limit.
+"""
+
+import os
+import json
+import mmap
+import time
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+from pyramid.settings import asbool
+
+import logging
+LOGGER = logging.getLogger("TWITCHER")
+
+# WMS request types whose images are cached
+TILE_REQUEST_TYPES = ('getmap', 'getlegendgraphic')
+
+BLOCK_SIZE = 64 * 1024
+
+# a header line is never longer
+MAX_HEADER_SIZE = 4096
+
+Tile = namedtuple('Tile', ['fh', 'offset', 'size', 'content_type'])
+
+
+class MappedFileIter(object):
+    """
+    Passes the body of a tile from a memory map of its file.
+    """
+
+    def __init__(self, fh, offset, block_size=BLOCK_SIZE):
+        self.fh = fh
+        self.offset = offset
+        self.block_size = block_size
+
+    def __iter__(self):
+        with mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for start in range(self.offset, len(mapped), self.block_size):
+                yield mapped[start:start + self.block_size]
+
+    def close(self):
+        self.fh.close()
+
+
+class TileWriter(object):
+    """
+    Writes a tile to a temporary file, :meth:`commit` adds the complete tile to the cache.
+    """
+
+    def __init__(self, cache, path, header):
+        self.cache = cache
+        self.path = path
+        self.size = 0
+        self._tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._fh = open(self._tmp, 'wb')
+        self._fh.write(header)
+
+    def write(self, chunk):
+        """
+        Writes a chunk of the image. Returns false, and drops the tile, when it is too big or can not be written.
+        """
+        self.size += len(chunk)
+        if self.size > self.cache.max_entry_size:
+            self.abort()
+            return False
+        try:
+            self._fh.write(chunk)
+        except OSError as e:
+            LOGGER.warning("Could not write tile %s: %s", self.path, e)
+            self.abort()
+            return False
+        return True
+
+    def commit(self):
+        try:
+            self._fh.close()
+            os.replace(self._tmp, self.path)
+        except OSError as e:
+            LOGGER.warning("Could not store tile %s: %s", self.path, e)
+            self.abort()
+        else:
+            self.cache._add(self.path, os.path.getsize(self.path))
+
+    def abort(self):
+        self._fh.close()
+        try:
+            os.remove(self._tmp)
+        except OSError:
+            pass
+
+
+SAFE_CHARS = frozenset(b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-')
+
+
+def _dirname(name):
+    # other bytes are escaped as _xx, so that two service names never share a directory
+    return ''.join(chr(byte) if byte in SAFE_CHARS else '_{:02x}'.format(byte) for byte in name.encode('utf-8')) or '_'
+
+
+class TileCache(object):
+    """
+    Caches the images of WMS GetMap and GetLegendGraphic requests in ``directory``.
+
+    Tiles are bounded by ``maxsize`` bytes in total and by ``max_entry_size`` per image.
+    The scan thread, started on first use in each worker process, reads the tiles in ``directory``
+    every ``scan_interval`` seconds.
+    """
+
+    def __init__(self, directory, ttl=3600, maxsize=1024 * 1024 * 1024, max_entry_size=4 * 1024 * 1024,
+                 scan_interval=300, clock=time.time):
+        self.directory = directory
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.max_entry_size = max_entry_size
+        self.scan_interval = scan_interval
+        self.clock = clock
+        self.currsize = 0
+        # tile path -> size in least recently used order
+        self._index = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stopped = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+    def ensure_started(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._stopped.clear()
+                    thread = threading.Thread(target=self.run, name='twitcher-tile-cache')
+                    thread.daemon = True
+                    thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        # the first scan finds the tiles stored before the start of the process
+        while True:
+            try:
+                self._rescan()
+            except Exception:
+                LOGGER.exception("Could not scan the tile cache %s.", self.directory)
+            if self._stopped.wait(self.scan_interval):
+                break
+
+    def _list_tiles(self):
+        """
+        Returns the paths and sizes of the tiles in the directory, the oldest first.
+        """
+        tiles = []
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if filename.endswith('.tile'):
+                    tiles.append((stat.st_mtime, path, stat.st_size))
+                elif filename.endswith('.tmp') and stat.st_mtime < self.clock() - 3600:
+                    # left by a stopped worker process
+                    self._remove(path)
+        return [(path, size) for _, path, size in sorted(tiles)]
+
+    def _rescan(self):
+        """
+        Reads the index again from the directory, with the tiles stored by other worker processes,
+        and removes the least recently used tiles above ``maxsize``.
+        """
+        tiles = self._list_tiles()
+        evicted = []
+        with self._lock:
+            index = OrderedDict(tiles)
+            # tiles used by this process are the most recently used ones
+            for path in self._index:
+                if path in index:
+                    index.move_to_end(path)
+            self._index = index
+            self.currsize = sum(index.values())
+            while self.currsize > self.maxsize:
+                evicted_path, evicted_size = self._index.popitem(last=False)
+                self.currsize -= evicted_size
+                evicted.append(evicted_path)
+        for evicted_path in evicted:
+            self._remove(evicted_path)
+        LOGGER.debug("Found %d cached tiles with %d bytes in %s, removed %d.",
+                     len(self._index), self.currsize, self.directory, len(evicted))
+
+    @staticmethod
+    def key(service, ows_params, public_url):
+        """
+        Returns the cache key for the service and the (lower-case) OWS request parameters.
+        """
+        params = dict(ows_params)
+        for name in ('token', 'access_token'):
+            params.pop(name, None)
+        return (service.name, public_url, tuple(sorted(params.items())))
+
+    def path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, _dirname(key[0]), digest[:2], digest + '.tile')
+
+    def get_ttl(self, service):
+        """
+        Time-to-live of the service tiles. The service can overwrite the configured default.
+        """
+        ttl = service.tile_cache_ttl
+        return self.ttl if ttl < 0 else ttl
+
+    def lookup(self, key, service):
+        """
+        Returns the open :class:`Tile` of the request or ``None`` when it is not cached or expired.
+        Tiles of a service registered with another url are ignored.
+        """
+        path = self.path(key)
+        try:
+            fh = open(path, 'rb')
+        except OSError:
+            return None
+        try:
+            header = json.loads(fh.readline(MAX_HEADER_SIZE).decode('utf-8'))
+            offset = fh.tell()
+            size = os.fstat(fh.fileno()).st_size
+        except (OSError, ValueError):
+            LOGGER.warning("Removing unreadable tile %s.", path)
+            fh.close()
+            self._discard(path)
+            return None
+        if header.get('service_url') != service.url or header.get('expires', 0) <= self.clock():
+            fh.close()
+            self._discard(path)
+            return None
+        # the body is read from the file position, also by file wrappers using its file descriptor
+        fh.seek(offset)
+        self._add(path, size)
+        return Tile(fh, offset, size - offset, header.get('content_type'))
+
+    def writer(self, key, service, content_type):
+        """
+        Returns a :class:`TileWriter` storing the image of the request or ``None`` when the tiles
+        of the service are not cached.
+        """
+        ttl = self.get_ttl(service)
+        if ttl <= 0:
+            return None
+        header = {'content_type': content_type, 'service_url': service.url, 'expires': self.clock() + ttl}
+        try:
+            return TileWriter(self, self.path(key), json.dumps(header).encode('utf-8') + b'\n')
+        except OSError as e:
+            LOGGER.warning("Could not store tile of service %s: %s", service.name, e)
+            return None
+
+    def _add(self, path, size):
+        evicted = []
+        with self._lock:
+            old = self._index.pop(path, None)
+            if old is not None:
+                self.currsize -= old
+            self._index[path] = size
+            self.currsize += size
+            while self.currsize > self.maxsize:
+                evicted_path, evicted_size = self._index.popitem(last=False)
+                self.currsize -= evicted_size
+                evicted.append(evicted_path)
+        for evicted_path in evicted:
+            self._remove(evicted_path)
+
+    def _discard(self, path):
+        with self._lock:
+            size = self._index.pop(path, None)
+            if size is not None:
+                self.currsize -= size
+        self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def purge(self, name=None):
+        """
+        Removes the tiles of service ``name``, or of all services when no name is given.
+        Returns the number of removed tiles.
+        """
+        if name:
+            prefix = os.path.join(self.directory, _dirname(name)) + os.sep
+        else:
+            prefix = os.path.join(self.directory, '')
+        with self._lock:
+            paths = [path for path in self._index if path.startswith(prefix)]
+            for path in paths:
+                self.currsize -= self._index.pop(path)
+        count = 0
+        directories = [prefix[:-1]] if name else [os.path.join(self.directory, entry)
+                                                  for entry in os.listdir(self.directory)]
+        for directory in directories:
+            for _, _, files in os.walk(directory):
+                count += sum(1 for filename in files if filename.endswith('.tile'))
+            shutil.rmtree(directory, ignore_errors=True)
+        LOGGER.info("Removed %d cached tiles of %s.", count, name or 'all services')
+        return count
+
+
+def tilecache_factory(registry):
+    """
+    Creates a :class:`TileCache` configured with the ``twitcher.ows_proxy_tile_cache_*`` settings.
+    Returns ``None`` when the cache is disabled.
+    """
+    settings = registry.settings or {}
+    if not asbool(settings.get('twitcher.ows_proxy_tile_cache', False)):
+        return None
+    directory = settings.get('twitcher.ows_proxy_tile_cache_dir')
+    if not directory:
+        LOGGER.warning("Tile cache disabled, twitcher.ows_proxy_tile_cache_dir is not set.")
+        return None
+    return TileCache(
+        directory,
+        ttl=int(settings.get('twitcher.ows_proxy_tile_cache_ttl', 3600)),
+        maxsize=int(settings.get('twitcher.ows_proxy_tile_cache_max_size', 1024 * 1024 * 1024)),
+        max_entry_size=int(settings.get('twitcher.ows_proxy_tile_cache_max_entry_size', 4 * 1024 * 1024)),
+        scan_interval=float(settings.get('twitcher.ows_proxy_tile_cache_scan_interval', 300)),
+    )
+
+
+_lock = threading.Lock()
+
+
+def get_tilecache(registry):
+    """
+    Returns the :class:`TileCache` shared by this process or ``None`` when it is disabled.
+    """
+    try:
+        return registry.tilecache
+    except AttributeError:
+        with _lock:
+            if not hasattr(registry, 'tilecache'):
+                registry.tilecache = tilecache_factory(registry)
+        return registry.tilecache
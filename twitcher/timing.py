@@ -0,0 +1,68 @@
+"""
+Timing of the stages of a proxied request.
+
+The timing tween (see :mod:`twitcher.tweens`) stores a :class:`RequestTiming` in the WSGI environ.
+The security checks and the OWS proxy add the duration of their stages with :func:`record_timing`:
+
+* ``parse``: parsing of the OWS request
+* ``service_lookup``: service lookup
+* ``token_lookup``: access token lookup and validation
+* ``esgf``: preparation of the ESGF credentials
+* ``upstream``: connect to the service and wait for the response headers
+* ``body``: wait for the response body of the service
+* ``rewrite``: replacing the service urls of the response
+
+The stages known when the response is returned are sent in a ``Server-Timing`` header.
+The body of a streamed response is read afterwards, so ``body`` and ``rewrite`` are only logged.
+"""
+
+import time
+
+ENVIRON_KEY = 'twitcher.timing'
+
+
+class RequestTiming(object):
+    """
+    Durations of the stages of one request, in seconds. Durations of a repeated stage are added up.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self, total=None):
+        """
+        Returns the value of the ``Server-Timing`` header, durations are given in milliseconds.
+        """
+        metrics = ['{};dur={:.3f}'.format(name, seconds * 1000) for name, seconds in self.stages.items()]
+        if total is not None:
+            metrics.append('total;dur={:.3f}'.format(total * 1000))
+        return ', '.join(metrics)
+
+    def log_fields(self):
+        """
+        Returns the stage durations as ``name=seconds`` pairs for a log line.
+        """
+        return ' '.join('{}={:.6f}'.format(name, seconds) for name, seconds in self.stages.items())
+
+
+def get_timing(request):
+    """
+    Returns the :class:`RequestTiming` of ``request`` or ``None`` when the timing tween is not used.
+    """
+    return request.environ.get(ENVIRON_KEY)
+
+
+def record_timing(request, name, seconds):
+    """
+    Adds the duration of stage ``name`` to the timing of ``request``, when it is timed.
+    """
+    timing = request.environ.get(ENVIRON_KEY)
+    if timing is not None:
+        timing.add(name, seconds)
@@ -2,16 +2,46 @@
 Provides various implementations of algorithms to generate an Access Token.
 """
 
+import base64
+import calendar
+import hashlib
+import hmac
+import json
+import threading
+import time
 import uuid
+from datetime import datetime
 
+import pymongo.errors
+from pyramid.settings import aslist, asbool
+
+from twitcher.db import mongodb as _mongodb
 from twitcher.datatype import AccessToken
-from twitcher.utils import expires_at
+from twitcher.exceptions import InvalidAccessToken
+from twitcher.utils import expires_at, now_secs
 
 import logging
 logger = logging.getLogger(__name__)
 
+# token data which must not be embedded in a signed token
+SECRET_DATA = ('esgf_access_token', 'esgf_credentials', 'esgf_credentials_pem')
+
 
 def tokengenerator_factory(registry):
+    """
+    Creates the token generator configured with the ``twitcher.token_type`` setting:
+    ``uuid`` (default) or ``signed``.
+    """
+    settings = registry.settings or {}
+    if settings.get('twitcher.token_type', 'uuid') == 'signed':
+        keys = {}
+        for item in aslist(settings.get('twitcher.token_signing_keys', '')):
+            kid, _, secret = item.partition(':')
+            keys[kid] = secret
+        return SignedTokenGenerator(
+            keys=keys,
+            kid=settings.get('twitcher.token_signing_kid'),
+            revoked=get_revocationlist(registry))
     return UuidTokenGenerator()
 
 
@@ -36,6 +66,28 @@ class TokenGenerator(object):
     def generate(self):
         raise NotImplementedError
 
+    def validate(self, token):
+        """
+        Validates a token without the token store.
+
+        :return: An instance of :class:`twitcher.datatype.AccessToken` or ``None``
+                 when the token store must be used.
+        :raises: :class:`twitcher.exceptions.InvalidAccessToken` if the token is invalid.
+        """
+        return None
+
+    def revoke(self, token):
+        """
+        Revokes a token which can be validated without the token store.
+        """
+        pass
+
+    def revoke_all(self):
+        """
+        Revokes all tokens which can be validated without the token store.
+        """
+        pass
+
 
 class UuidTokenGenerator(TokenGenerator):
     """
@@ -46,3 +98,196 @@ class UuidTokenGenerator(TokenGenerator):
         :return: A new token
         """
         return uuid.uuid4().hex
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    data = data.encode('ascii')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+class SignedTokenGenerator(TokenGenerator):
+    """
+    Generate a self-contained token signed with HMAC-SHA256 (a JSON Web Token).
+
+    The token contains its expiry time and the non-secret token data, so it can be validated by
+    a signature check only. Tokens with secret data (like an ESGF access token) carry a ``ref``
+    claim and are looked up in the token store.
+
+    ``keys`` maps key ids to secrets. New tokens are signed with the key ``kid`` and the ``kid`` header
+    selects the key to check a token, so keys can be rotated by adding a new key before removing the old one.
+    """
+    header_alg = 'HS256'
+
+    def __init__(self, keys, kid=None, revoked=None):
+        if not keys:
+            raise ValueError("signed tokens need at least one signing key")
+        self.keys = {kid_: secret.encode('utf-8') if isinstance(secret, str) else secret
+                     for kid_, secret in keys.items()}
+        self.kid = kid or sorted(self.keys)[0]
+        if self.kid not in self.keys:
+            raise ValueError("unknown signing key {}".format(self.kid))
+        self.revoked = revoked
+
+    def create_access_token(self, valid_in_hours=1, data=None):
+        data = data or {}
+        exp = expires_at(hours=valid_in_hours)
+        # issued at with sub-second precision, compared with the time of a revocation of all tokens
+        claims = {'jti': uuid.uuid4().hex, 'iat': time.time(), 'exp': exp}
+        public_data = {key: value for key, value in data.items() if key not in SECRET_DATA}
+        if public_data:
+            claims['data'] = public_data
+        if len(public_data) != len(data):
+            claims['ref'] = True
+        return AccessToken(token=self.encode(claims), expires_at=exp, data=data)
+
+    def generate(self):
+        return self.encode({'jti': uuid.uuid4().hex, 'iat': time.time(), 'exp': expires_at()})
+
+    def _sign(self, kid, signing_input):
+        return hmac.new(self.keys[kid], signing_input, hashlib.sha256).digest()
+
+    def encode(self, claims):
+        header = {'alg': self.header_alg, 'typ': 'JWT', 'kid': self.kid}
+        signing_input = '.'.join([
+            _b64encode(json.dumps(header, separators=(',', ':')).encode('utf-8')),
+            _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))]).encode('ascii')
+        return '{}.{}'.format(signing_input.decode('ascii'), _b64encode(self._sign(self.kid, signing_input)))
+
+    def decode(self, token):
+        """
+        Checks the signature of ``token`` and returns its claims.
+        """
+        try:
+            header_b64, claims_b64, signature_b64 = token.split('.')
+            header = json.loads(_b64decode(header_b64))
+            kid = header.get('kid')
+            if header.get('alg') != self.header_alg or kid not in self.keys:
+                raise InvalidAccessToken("Unknown signing key.")
+            signing_input = '{}.{}'.format(header_b64, claims_b64).encode('ascii')
+            if not hmac.compare_digest(self._sign(kid, signing_input), _b64decode(signature_b64)):
+                raise InvalidAccessToken("Invalid signature.")
+            return json.loads(_b64decode(claims_b64))
+        except InvalidAccessToken:
+            raise
+        except Exception as err:
+            raise InvalidAccessToken("Malformed token: {}".format(err))
+
+    def validate(self, token):
+        if not token or token.count('.') != 2:
+            return None
+        claims = self.decode(token)
+        if self.revoked is not None and self.revoked.is_revoked(claims.get('jti'), claims.get('iat', 0)):
+            raise InvalidAccessToken("Access token is revoked.")
+        if claims.get('ref'):
+            return None
+        return AccessToken(token=token, expires_at=claims.get('exp', 0), data=claims.get('data') or {})
+
+    def revoke(self, token):
+        if self.revoked is None or not token or token.count('.') != 2:
+            return
+        try:
+            claims = self.decode(token)
+        except InvalidAccessToken:
+            return
+        self.revoked.revoke(claims.get('jti'), claims.get('exp', 0))
+
+    def revoke_all(self):
+        if self.revoked is not None:
+            self.revoked.revoke_all()
+
+
+class RevocationList(object):
+    """
+    Small list of revoked signed tokens (by token id) and the time before which all tokens are revoked.
+
+    Revoked ids are kept until the token expires. When a mongodb ``db`` is given the list is shared by
+    all worker processes and reloaded at most every ``refresh_interval`` seconds.
+    """
+
+    def __init__(self, db=None, refresh_interval=10):
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.revoked_before = 0
+        self._revoked = {}
+        self._refreshed = 0
+        self._lock = threading.Lock()
+
+    def revoke(self, jti, expires_at):
+        with self._lock:
+            self._revoked[jti] = expires_at
+        if self.db is not None:
+            try:
+                self.db.revoked_tokens.replace_one(
+                    {'_id': jti}, {'_id': jti, 'expires': datetime.utcfromtimestamp(expires_at)}, upsert=True)
+            except pymongo.errors.PyMongoError:
+                logger.exception("Could not store revoked token.")
+
+    def revoke_all(self):
+        # tokens issued later in the same second stay valid
+        revoked_before = time.time()
+        with self._lock:
+            self.revoked_before = revoked_before
+            self._revoked = {}
+        if self.db is not None:
+            try:
+                self.db.counters.update_one(
+                    {'_id': 'tokens'}, {'$max': {'revoked_before': revoked_before}}, upsert=True)
+            except pymongo.errors.PyMongoError:
+                logger.exception("Could not store revocation of all tokens.")
+
+    def is_revoked(self, jti, issued_at):
+        self.refresh()
+        if issued_at < self.revoked_before:
+            return True
+        return jti in self._revoked
+
+    def refresh(self):
+        if self.db is None or time.monotonic() - self._refreshed < self.refresh_interval:
+            return
+        if not self._lock.acquire(False):
+            return  # another thread is refreshing
+        try:
+            self._refreshed = time.monotonic()
+            now = datetime.utcnow()
+            revoked = {doc['_id']: calendar.timegm(doc['expires'].utctimetuple())
+                       for doc in self.db.revoked_tokens.find({'expires': {'$gt': now}})}
+            doc = self.db.counters.find_one({'_id': 'tokens'}) or {}
+            # keep local revocations which are not yet expired
+            now_secs_ = now_secs()
+            revoked.update((jti, exp) for jti, exp in self._revoked.items() if exp > now_secs_)
+            self._revoked = revoked
+            self.revoked_before = max(self.revoked_before, doc.get('revoked_before', 0))
+        except pymongo.errors.PyMongoError:
+            logger.exception("Could not refresh revoked tokens.")
+        finally:
+            self._lock.release()
+
+
+_lock = threading.Lock()
+
+
+def get_revocationlist(registry):
+    """
+    Returns the :class:`RevocationList` shared by this process or ``None`` when it is disabled
+    with the ``twitcher.token_revocation_list`` setting.
+    """
+    try:
+        return registry.revocationlist
+    except AttributeError:
+        pass
+    settings = registry.settings or {}
+    with _lock:
+        if not hasattr(registry, 'revocationlist'):
+            revoked = None
+            if asbool(settings.get('twitcher.token_revocation_list', True)):
+                db = None
+                if 'mongodb.host' in settings:
+                    db = _mongodb(registry)
+                revoked = RevocationList(
+                    db=db, refresh_interval=float(settings.get('twitcher.token_revocation_refresh_interval', 10)))
+            registry.revocationlist = revoked
+    return registry.revocationlist
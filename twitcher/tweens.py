@@ -3,6 +3,8 @@ from pyramid.tweens import EXCVIEW
 
 from twitcher.owsexceptions import OWSException, OWSNoApplicableCode
 from twitcher.owssecurity import owssecurity_factory
+from twitcher.timing import RequestTiming, ENVIRON_KEY
+from twitcher.metrics import request_labels
 
 import logging
 logger = logging.getLogger(__name__)
@@ -15,6 +17,10 @@ def includeme(config):
         logger.info('Add OWS security tween')
         config.add_tween(OWS_SECURITY, under=EXCVIEW)
 
+    if asbool(settings.get('twitcher.timing', False)):
+        logger.info('Add request timing tween')
+        config.add_tween(TIMING, over=EXCVIEW)
+
 
 def ows_security_tween_factory(handler, registry):
     """A tween factory which produces a tween which raises an exception
@@ -36,4 +42,64 @@ def ows_security_tween_factory(handler, registry):
     return ows_security_tween
 
 
+class TimedAppIter(object):
+    """
+    Passes the body of a streamed response through and calls ``on_close`` when it is closed.
+    """
+    def __init__(self, app_iter, on_close):
+        self.app_iter = app_iter
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.on_close()
+
+
+def timing_tween_factory(handler, registry):
+    """A tween factory which produces a tween which times the stages of proxied requests
+    (see :mod:`twitcher.timing`), adds a ``Server-Timing`` header and logs slow requests."""
+
+    settings = registry.settings
+    protected_path = settings.get('twitcher.ows_proxy_protected_path', '/ows')
+    header = asbool(settings.get('twitcher.timing_header', True))
+    slow_threshold = float(settings.get('twitcher.timing_slow_threshold', 1))
+
+    def timing_tween(request):
+        if not request.path.startswith(protected_path):
+            return handler(request)
+        timing = request.environ[ENVIRON_KEY] = RequestTiming()
+        response = handler(request)
+        if header:
+            response.headers['Server-Timing'] = timing.server_timing(total=timing.elapsed())
+
+        def log_slow_request():
+            total = timing.elapsed()
+            if total >= slow_threshold:
+                # the path is not logged, it may contain the access token
+                labels = request_labels(request)
+                logger.warning("slow request: method=%s service=%s request=%s status=%s total=%.6f %s",
+                               request.method, labels['service'], labels['request'], response.status_code,
+                               total, timing.log_fields())
+
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if isinstance(response.app_iter, (list, tuple)):
+            log_slow_request()
+        elif isinstance(file_wrapper, type) and isinstance(response.app_iter, file_wrapper):
+            # wrapping the file would keep the server from sending it directly
+            log_slow_request()
+        else:
+            # the body is streamed after the tween returned
+            response.app_iter = TimedAppIter(response.app_iter, log_slow_request)
+        return response
+
+    return timing_tween
+
+
 OWS_SECURITY = 'twitcher.tweens.ows_security_tween_factory'
+TIMING = 'twitcher.tweens.timing_tween_factory'
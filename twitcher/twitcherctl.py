@@ -4,6 +4,7 @@ import argcomplete
 import argparse
 
 from twitcher.client import TwitcherService
+from twitcher.balancer import STRATEGIES
 
 import logging
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.WARN)
@@ -55,6 +56,8 @@ class TwitcherCtl(object):
                                help="ESGF access token to retrieve a certificate from ESGF SLCS service.")
         subparser.add_argument('-C', '--esgf-credentials',
                                help="URL pointing to ESGF credentials.")
+        subparser.add_argument('-F', '--fetch-credentials', action='store_true',
+                               help="Fetch the ESGF credentials now and store them with the token.")
         subparser.add_argument('-e', '--env', nargs='*', default=[],
                                help="Set environment variable (key=value).")
 
@@ -64,6 +67,9 @@ class TwitcherCtl(object):
         subparser.add_argument('-A', '--all', action="store_true",
                                help="Remove all access tokens.")
 
+        # purge
+        subparser = subparsers.add_parser('purge', help="Remove all expired access tokens.")
+
         # service registry
         # ----------------
 
@@ -73,10 +79,17 @@ class TwitcherCtl(object):
         # clear
         subparser = subparsers.add_parser('clear', help="Removes all OWS services from the registry.")
 
+        # breakers
+        subparser = subparsers.add_parser('breakers', help="Lists the circuit breaker states of the OWS services.")
+
+        # purgetiles
+        subparser = subparsers.add_parser('purgetiles', help="Removes the cached WMS tiles.")
+        subparser.add_argument('name', nargs='?', default='', help="Service name. Default: all services.")
+
         # register
         subparser = subparsers.add_parser('register',
                                           help="Adds OWS service to the registry to be used by the OWS proxy.")
-        subparser.add_argument('url', help="Service url.")
+        subparser.add_argument('url', nargs='+', help="Service url. Several urls are backends of one service.")
         subparser.add_argument('--name', help="Service name. If not set then a name will be generated.")
         subparser.add_argument('--type', default='wps',
                                help="Service type (wps, wms). Default: wps.")
@@ -88,6 +101,26 @@ class TwitcherCtl(object):
                                help="Authentication method (token, cert). Default: token.")
         subparser.add_argument('--verify', default='true',
                                help="Verify SSL service certificate (true, false, /path/to/cert). Default: true.")
+        subparser.add_argument('--cache-ttl', type=int, default=-1,
+                               help="Seconds to cache capabilities documents (0 disables caching). "
+                                    "Default: -1 (use server setting).")
+        subparser.add_argument('--tile-cache-ttl', type=int, default=-1,
+                               help="Seconds to cache WMS tiles (0 disables caching). "
+                                    "Default: -1 (use server setting).")
+        subparser.add_argument('--max-concurrency', type=int, default=0,
+                               help="Maximum number of concurrent requests to the service. Default: 0 (unlimited).")
+        subparser.add_argument('--request-concurrency', nargs='*', default=[],
+                               help="Maximum number of concurrent requests of an OWS request type, "
+                                    "e.g. execute=2.")
+        subparser.add_argument('--max-queue', type=int, default=0,
+                               help="Number of requests waiting for a free slot when a concurrency limit is reached. "
+                                    "Default: 0 (reject at once).")
+        subparser.add_argument('--queue-timeout', type=float, default=-1,
+                               help="Seconds a request waits for a free slot. Default: -1 (use server setting).")
+        subparser.add_argument('--balance', default='round_robin', choices=STRATEGIES,
+                               help="Load balancing strategy of several service urls. Default: round_robin.")
+        subparser.add_argument('--weights', nargs='*', type=int, default=[],
+                               help="Weights of the service urls used by the weighted strategy.")
 
         # unregister
         subparser = subparsers.add_parser('unregister', help="Removes OWS service from the registry.")
@@ -123,15 +156,27 @@ class TwitcherCtl(object):
                         'purl': args.purl,
                         'public': args.public,
                         'auth': args.auth,
-                        'verify': args.verify}
+                        'verify': args.verify,
+                        'cache_ttl': args.cache_ttl,
+                        'tile_cache_ttl': args.tile_cache_ttl,
+                        'max_concurrency': args.max_concurrency,
+                        'request_concurrency': {k: int(v) for k, v in (x.split('=') for x in args.request_concurrency)},
+                        'max_queue': args.max_queue,
+                        'queue_timeout': args.queue_timeout,
+                        'balance': args.balance,
+                        'weights': args.weights}
                 result = service.register_service(
-                    url=args.url,
+                    url=args.url[0] if len(args.url) == 1 else args.url,
                     data=data,
                 )
             elif args.cmd == 'unregister':
                 result = service.unregister_service(name=args.name)
             elif args.cmd == 'clear':
                 result = service.clear_services()
+            elif args.cmd == 'breakers':
+                result = service.list_breakers()
+            elif args.cmd == 'purgetiles':
+                result = service.purge_tile_cache(name=args.name)
             elif args.cmd == 'gentoken':
                 data = {k: v for k, v in (x.split('=') for x in args.env)}
                 if args.esgf_access_token:
@@ -139,12 +184,15 @@ class TwitcherCtl(object):
                     data['esgf_slcs_service_url'] = args.esgf_slcs_service_url
                 if args.esgf_credentials:
                     data['esgf_credentials'] = args.esgf_credentials
-                result = service.generate_token(valid_in_hours=args.valid_in_hours, data=data)
+                result = service.generate_token(valid_in_hours=args.valid_in_hours, data=data,
+                                                fetch_credentials=args.fetch_credentials)
             elif args.cmd == 'revoke':
                 if args.all is True:
                     result = service.revoke_all_tokens()
                 else:
                     result = service.revoke_token(token=args.token)
+            elif args.cmd == 'purge':
+                result = service.purge_expired_tokens()
         except Exception as e:
             LOGGER.error("Error: {}".format(e))
         else:
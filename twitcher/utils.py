@@ -1,5 +1,7 @@
+import re
 import time
 from datetime import datetime
+from xml.sax.saxutils import escape as xml_escape
 import pytz
 from lxml import etree
 
@@ -123,3 +125,165 @@ def replace_caps_url(xml, url, prev_url=None):
         xml = xml.decode('utf-8', 'ignore')
         xml = xml.replace(prev_url, url)
     return xml
+
+
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+OWS_NS = 'http://www.opengis.net/ows/1.1'
+WMS_NS = 'http://www.opengis.net/wms'
+
+# start or end tag, quoted attribute values may contain ">"
+_TAG_RE = re.compile(rb'<(/?)([A-Za-z_][\w.\-]*(?::[\w.\-]+)?)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>')
+_ATTR_RE = re.compile(rb'([A-Za-z_][\w.\-]*(?::[\w.\-]+)?)(\s*=\s*)("[^"]*"|\'[^\']*\')')
+
+
+class _CapsUrlRewriter(object):
+    """
+    Byte-level rewriter of capabilities URLs used by :func:`iter_replace_caps_url`.
+
+    The document is not parsed. Only complete tags are scanned, the incomplete tail of a chunk
+    is kept until the next chunk arrives.
+    """
+    max_prolog_size = 1024 * 1024
+
+    def __init__(self, url, prev_url=None):
+        self.url = url
+        self.href = xml_escape(url, {'"': '&quot;'}).encode('ascii', 'xmlcharrefreplace')
+        self.prev_url = prev_url.encode('utf-8') if prev_url else None
+        self.mode = None
+        self.nsmap = {}
+        self.in_operations = False
+        self.buf = b''
+
+    def feed(self, chunk):
+        self.buf += chunk
+        if self.mode is None:
+            match = _TAG_RE.search(self.buf)
+            if match:
+                self._detect(match)
+            elif len(self.buf) > self.max_prolog_size:
+                self.mode = 'raw'
+            else:
+                return b''
+        if self.mode == 'raw':
+            data, self.buf = self.buf, b''
+            return data
+        elif self.mode == 'text':
+            return self._replace_text()
+        return self._rewrite_tags()
+
+    def close(self):
+        data, self.buf = self.buf, b''
+        if self.mode in ('wms111', 'wms130', 'wps'):
+            data = _TAG_RE.sub(self._rewrite_tag, data)
+        elif self.mode == 'text':
+            data = data.replace(self.prev_url, self.url.encode('utf-8'))
+        return data
+
+    def _namespaces(self, attrs):
+        nsmap = None
+        for name, _, value in _ATTR_RE.findall(attrs):
+            if name == b'xmlns' or name.startswith(b'xmlns:'):
+                if nsmap is None:
+                    nsmap = dict(self.nsmap)
+                prefix = name[6:] if name.startswith(b'xmlns:') else b''
+                nsmap[prefix] = value[1:-1].decode('utf-8')
+        return self.nsmap if nsmap is None else nsmap
+
+    @staticmethod
+    def _clark(qname, nsmap):
+        prefix, _, local = qname.rpartition(b':')
+        ns = nsmap.get(prefix)
+        local = local.decode('utf-8')
+        return '{%s}%s' % (ns, local) if ns else local
+
+    def _detect(self, match):
+        self.nsmap = self._namespaces(match.group(3))
+        tag = self._clark(match.group(2), self.nsmap)
+        if 'WMT_MS_Capabilities' in tag:
+            logger.debug("replace proxy urls in wms 1.1.1")
+            self.mode = 'wms111'
+        elif 'WMS_Capabilities' in tag:
+            logger.debug("replace proxy urls in wms 1.3.0")
+            self.mode = 'wms130'
+        elif 'Capabilities' in tag:
+            self.mode = 'wps'
+        elif self.prev_url:
+            self.mode = 'text'
+        else:
+            self.mode = 'raw'
+
+    def _rewrite_tags(self):
+        # keep an incomplete tag at the end of the buffer for the next chunk
+        end = len(self.buf)
+        pos = self.buf.rfind(b'<')
+        if pos >= 0 and not _TAG_RE.match(self.buf, pos):
+            end = pos
+        data, self.buf = self.buf[:end], self.buf[end:]
+        return _TAG_RE.sub(self._rewrite_tag, data)
+
+    def _rewrite_tag(self, match):
+        closing, qname, attrs = match.groups()
+        if closing:
+            if self.mode == 'wps' and self._clark(qname, self.nsmap) == '{%s}OperationsMetadata' % OWS_NS:
+                self.in_operations = False
+            return match.group(0)
+        nsmap = self._namespaces(attrs)
+        tag = self._clark(qname, nsmap)
+        if self.mode == 'wps':
+            if tag == '{%s}OperationsMetadata' % OWS_NS:
+                self.in_operations = not attrs.rstrip().endswith(b'/')
+                return match.group(0)
+            elif not self.in_operations:
+                return match.group(0)
+        elif self.mode == 'wms111' and tag != 'OnlineResource':
+            return match.group(0)
+        elif self.mode == 'wms130' and tag != '{%s}OnlineResource' % WMS_NS:
+            return match.group(0)
+
+        def _rewrite_attr(attr):
+            name, sep, value = attr.groups()
+            if self._clark(name, nsmap) != '{%s}href' % XLINK_NS:
+                return attr.group(0)
+            href = self.href
+            if self.mode != 'wps':
+                # keep the (already escaped) query string of wms urls
+                query = value[1:-1].partition(b'#')[0].partition(b'?')[2]
+                if query:
+                    href += b'?' + query
+            return name + sep + b'"' + href + b'"'
+        return b'<' + qname + _ATTR_RE.sub(_rewrite_attr, attrs) + b'>'
+
+    def _replace_text(self):
+        # replace complete occurrences, keep a possibly incomplete match at the end
+        prev_url, new_url = self.prev_url, self.url.encode('utf-8')
+        out = []
+        pos = 0
+        while True:
+            found = self.buf.find(prev_url, pos)
+            if found < 0:
+                break
+            out.append(self.buf[pos:found])
+            out.append(new_url)
+            pos = found + len(prev_url)
+        keep = max(pos, len(self.buf) - len(prev_url) + 1)
+        out.append(self.buf[pos:keep])
+        self.buf = self.buf[keep:]
+        return b''.join(out)
+
+
+def iter_replace_caps_url(chunks, url, prev_url=None):
+    """
+    Streaming variant of :func:`replace_caps_url`.
+
+    Rewrites the service URLs of the XML document given as an iterable of byte ``chunks``
+    and yields the rewritten chunks. Only an incomplete tag at the end of a chunk is held back,
+    so memory stays bounded by the chunk size.
+    """
+    rewriter = _CapsUrlRewriter(url, prev_url)
+    for chunk in chunks:
+        data = rewriter.feed(chunk)
+        if data:
+            yield data
+    data = rewriter.close()
+    if data:
+        yield data
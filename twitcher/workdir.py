@@ -0,0 +1,181 @@
+"""
+Workdirs created for proxied requests, e.g. with the ESGF credentials of an access token.
+
+Every workdir is created by :func:`create_workdir` in the configured ``twitcher.workdir`` and is marked
+with a small file holding the expiry time of its access token. The :class:`WorkdirReaper` removes marked
+workdirs which expired or were not used for ``max_age`` seconds and enforces a quota on their
+number and size, removing the least recently used workdirs first.
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+from pyramid.settings import asbool
+
+import logging
+LOGGER = logging.getLogger("TWITCHER")
+
+WORKDIR_MARKER = '.twitcher_workdir'
+
+
+def base_workdir(settings):
+    return settings.get('twitcher.workdir') or tempfile.gettempdir()
+
+
+def workdir_prefix(settings):
+    return settings.get('twitcher.prefix') or 'twitcher_'
+
+
+def create_workdir(request, expires_at=None):
+    """
+    Creates a new workdir for ``request``, which is removed by the reaper after ``expires_at``
+    (seconds since epoch) at the latest.
+    """
+    workdir = tempfile.mkdtemp(prefix=request.prefix, dir=request.workdir)
+    with open(os.path.join(workdir, WORKDIR_MARKER), 'w') as fh:
+        json.dump({'expires_at': expires_at}, fh)
+    reaper = get_workdirreaper(request.registry)
+    if reaper is not None:
+        reaper.ensure_started()
+    return workdir
+
+
+def touch_workdir(workdir):
+    """
+    Marks the workdir as used. Returns false when it has been removed.
+    """
+    try:
+        os.utime(workdir)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+class WorkdirReaper(object):
+    """
+    Removes the marked workdirs in ``workdir`` which expired, are older than ``max_age`` seconds
+    or exceed the ``max_count``/``max_bytes`` quota (0 is unlimited).
+    The reaper thread is started on first use in each worker process and runs every ``interval`` seconds.
+    """
+
+    def __init__(self, workdir, prefix='twitcher_', max_age=86400, max_count=0, max_bytes=0, interval=300):
+        self.workdir = workdir
+        self.prefix = prefix
+        self.max_age = max_age
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self._pid = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._stopped.clear()
+                    thread = threading.Thread(target=self.run, name='twitcher-workdir-reaper')
+                    thread.daemon = True
+                    thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.reap()
+            except Exception:
+                LOGGER.exception("Could not remove workdirs.")
+
+    def _workdirs(self):
+        """
+        Returns the marked workdirs as a list of ``(path, last used, expires_at, size)`` tuples.
+        """
+        workdirs = []
+        with os.scandir(self.workdir) as entries:
+            for entry in entries:
+                if not entry.name.startswith(self.prefix) or not entry.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    with open(os.path.join(entry.path, WORKDIR_MARKER)) as fh:
+                        expires_at = json.load(fh).get('expires_at')
+                    size = 0
+                    for dirpath, _, filenames in os.walk(entry.path):
+                        for filename in filenames:
+                            size += os.lstat(os.path.join(dirpath, filename)).st_size
+                    workdirs.append((entry.path, entry.stat(follow_symlinks=False).st_mtime, expires_at, size))
+                except (OSError, ValueError):
+                    # not created by twitcher or removed meanwhile
+                    continue
+        return workdirs
+
+    def reap(self):
+        """
+        Removes expired workdirs and enforces the quota. Returns the number of removed workdirs.
+        """
+        now = time.time()
+        keep = []
+        removed = 0
+        for workdir in self._workdirs():
+            path, used, expires_at, _ = workdir
+            if (expires_at and expires_at <= now) or (self.max_age and used + self.max_age <= now):
+                removed += self._remove(path)
+            else:
+                keep.append(workdir)
+        # least recently used workdirs first
+        keep.sort(key=lambda workdir: workdir[1])
+        count = len(keep)
+        size = sum(workdir[3] for workdir in keep)
+        for path, _, _, workdir_size in keep:
+            if (not self.max_count or count <= self.max_count) and (not self.max_bytes or size <= self.max_bytes):
+                break
+            removed += self._remove(path)
+            count -= 1
+            size -= workdir_size
+        if removed:
+            LOGGER.info("Removed %d workdirs in %s.", removed, self.workdir)
+        return removed
+
+    def _remove(self, path):
+        try:
+            shutil.rmtree(path)
+        except FileNotFoundError:
+            return 0
+        except OSError as err:
+            LOGGER.warning("Could not remove workdir %s: %s", path, err)
+            return 0
+        return 1
+
+
+_lock = threading.Lock()
+
+
+def get_workdirreaper(registry):
+    """
+    Returns the :class:`WorkdirReaper` shared by this process or ``None`` when it is disabled
+    with the ``twitcher.workdir_reaper`` setting.
+    """
+    try:
+        return registry.workdirreaper
+    except AttributeError:
+        pass
+    settings = registry.settings or {}
+    with _lock:
+        if not hasattr(registry, 'workdirreaper'):
+            reaper = None
+            if asbool(settings.get('twitcher.workdir_reaper', True)):
+                reaper = WorkdirReaper(
+                    base_workdir(settings),
+                    prefix=workdir_prefix(settings),
+                    max_age=int(settings.get('twitcher.workdir_max_age', 86400)),
+                    max_count=int(settings.get('twitcher.workdir_max_count', 0)),
+                    max_bytes=int(settings.get('twitcher.workdir_max_bytes', 0)),
+                    interval=float(settings.get('twitcher.workdir_reap_interval', 300)))
+            registry.workdirreaper = reaper
+    return registry.workdirreaper